@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import re
+import secrets
+import time
+from pathlib import Path
+
+from blobstore import BlobStore, COPY_CHUNK_SIZE
+from db import Database
+from staging import STAGING_TTL
+
+# Sliced G-code, compressed, with the statistics parsed from it
+ARTIFACT_DIR = Path(os.getenv("ARTIFACT_DIR", "uploads/gcode"))
+# G-code shrinks ~10x even at a fast level, and quotes wait for nothing slower
+GCODE_ZSTD_LEVEL = int(os.getenv("GCODE_ZSTD_LEVEL", "3"))
+# G-code of quotes nobody saved is kept as long as their staged upload
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", str(STAGING_TTL)))
+# Files younger than this may still be written by a slice or a request
+STALE_SECONDS = 3600
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def byte_range(header, size):
+    """
+    (start, end) inclusive of a single-range Range header, or None to send the
+    whole file (no header, or several ranges, which we don't split up).
+    Raises RangeNotSatisfiable when the range lies outside the file.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N: the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable(header)
+    return start, end
+
+
+class ArtifactStore:
+    """
+    G-code and print statistics of slices, keyed like the quote cache (mesh
+    digest and print settings), so an order can be printed without slicing it
+    again. Artifacts expire after `ttl` unless keep() attaches them to a saved
+    model. The G-code itself lives in a BlobStore of its own.
+    """
+
+    def __init__(self, directory=ARTIFACT_DIR, ttl=ARTIFACT_TTL):
+        self.directory = Path(directory)
+        self.blobs = BlobStore(self.directory / "blobs", level=GCODE_ZSTD_LEVEL)
+        self.incoming = self.directory / "incoming"
+        self.incoming.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.db = Database(self.directory / "artifacts.sqlite3")
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    key TEXT PRIMARY KEY,
+                    gcode TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    stats TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_expires_at ON artifacts (expires_at)")
+            # Saves that came before their slice's G-code was stored
+            conn.execute("CREATE TABLE IF NOT EXISTS keep_requests (key TEXT PRIMARY KEY, created_at REAL NOT NULL)")
+
+    def _prefix(self, key):
+        return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+    def incoming_path(self, key):
+        """
+        A new, empty file for a slicer to write the G-code for `key` to before
+        it is put(); pending() sees it from now on.
+        """
+        path = self.incoming / f"{self._prefix(key)}.{secrets.token_hex(4)}.gcode"
+        path.touch()
+        return path
+
+    def pending(self, key):
+        """Whether some slice is writing or storing G-code for `key` right now."""
+        return any(self.incoming.glob(f"{self._prefix(key)}.*.gcode"))
+
+    def put(self, key, gcode_path, stats):
+        """Compress and store a slice's G-code (removing the file) with its statistics."""
+        gcode_path = Path(gcode_path)
+        try:
+            digest, size = self.blobs.put(gcode_path)
+            now = time.time()
+            with self.db.transaction() as conn:
+                kept = conn.execute("DELETE FROM keep_requests WHERE key = ?", (key,)).rowcount
+                previous = conn.execute("SELECT expires_at FROM artifacts WHERE key = ?", (key,)).fetchone()
+                expires_at = None if kept or (previous and previous[0] is None) else now + self.ttl
+                conn.execute(
+                    "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, digest, size, json.dumps(stats), now, expires_at),
+                )
+        finally:
+            # Only now, so pending() covers the whole time until the row exists
+            gcode_path.unlink(missing_ok=True)
+        return digest, size
+
+    def keep(self, key):
+        """
+        Keep the artifact for `key` for good. Returns False when there is none
+        yet; one stored later (see pending()) is then kept as well.
+        """
+        with self.db.transaction() as conn:
+            if conn.execute("UPDATE artifacts SET expires_at = NULL WHERE key = ?", (key,)).rowcount:
+                return True
+            conn.execute("INSERT OR REPLACE INTO keep_requests VALUES (?, ?)", (key, time.time()))
+        return False
+
+    def get(self, key):
+        with self.db.read() as conn:
+            row = conn.execute(
+                "SELECT gcode, size, stats, created_at, expires_at FROM artifacts WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        gcode, size, stats, created_at, expires_at = row
+        return {"key": key, "digest": gcode, "size": size, "stats": json.loads(stats), "created_at": created_at, "kept": expires_at is None}
+
+    def read(self, digest, start=0, end=None):
+        """Yield the decompressed G-code from byte `start` to `end` inclusive, in chunks."""
+        remaining = None if end is None else end - start + 1
+        with self.blobs.open(digest) as reader:
+            # Compressed streams can't seek; decompressing what we skip is still far cheaper than slicing
+            while start > 0:
+                skipped = reader.read(min(start, COPY_CHUNK_SIZE))
+                if not skipped:
+                    return
+                start -= len(skipped)
+            while remaining is None or remaining > 0:
+                chunk = reader.read(COPY_CHUNK_SIZE if remaining is None else min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def sweep(self):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM artifacts WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM keep_requests WHERE created_at <= ?", (now - self.ttl,))
+            referenced = {row[0] for row in conn.execute("SELECT DISTINCT gcode FROM artifacts")}
+        removed = 0
+        for path in self.blobs.paths():
+            if path.name.split(".", 1)[0] not in referenced and path.stat().st_mtime < now - STALE_SECONDS:
+                path.unlink(missing_ok=True)
+                removed += 1
+        for path in self.incoming.iterdir():
+            # Left behind by slices that died before storing their G-code
+            if path.stat().st_mtime < now - STALE_SECONDS:
+                path.unlink(missing_ok=True)
+        return removed
+
+    def stats(self):
+        with self.db.read() as conn:
+            artifacts, kept = conn.execute("SELECT COUNT(*), COUNT(*) - COUNT(expires_at) FROM artifacts").fetchone()
+        return {"artifacts": artifacts, "kept": kept, **self.blobs.stats()}
+
+
+artifact_store = ArtifactStore()
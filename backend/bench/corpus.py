@@ -0,0 +1,114 @@
+"""
+Procedural STL corpus for benchmarks: cubes and plates of a dozen triangles up
+to bumpy spheres of millions, each in binary and ASCII. Generation is
+deterministic, so a corpus directory can be reused across runs and commits;
+files that already exist are kept.
+
+    cd backend && python bench/corpus.py --dir /tmp/quote-bench-corpus --sizes tiny,small,medium,large
+"""
+import argparse
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+from mesh import write_binary_stl
+
+DEFAULT_DIR = Path(tempfile.gettempdir()) / "quote-bench-corpus"
+
+# name -> (size class, generator)
+MODELS = {
+    "cube-10": ("tiny", lambda: box(10, 10, 10)),
+    "plate-80x60x3": ("tiny", lambda: box(80, 60, 3)),
+    "tower-20x20x120": ("tiny", lambda: box(20, 20, 120)),
+    "sphere-5k": ("small", lambda: bumpy_sphere(5_000, radius=15)),
+    "sphere-50k": ("small", lambda: bumpy_sphere(50_000, radius=25)),
+    "sphere-400k": ("medium", lambda: bumpy_sphere(400_000, radius=40)),
+    "sphere-1m": ("large", lambda: bumpy_sphere(1_000_000, radius=50)),
+    "sphere-3m": ("huge", lambda: bumpy_sphere(3_000_000, radius=60)),
+}
+SIZE_CLASSES = ("tiny", "small", "medium", "large", "huge")
+# ASCII copies of the biggest meshes run to gigabytes, which measures the disk rather than us
+MAX_ASCII_TRIANGLES = 1_000_000
+
+
+def box(x, y, z):
+    corners = np.array([[0, 0, 0], [x, 0, 0], [x, y, 0], [0, y, 0], [0, 0, z], [x, 0, z], [x, y, z], [0, y, z]], dtype=np.float32)
+    faces = [(0, 2, 1), (0, 3, 2), (4, 5, 6), (4, 6, 7), (0, 1, 5), (0, 5, 4),
+             (1, 2, 6), (1, 6, 5), (2, 3, 7), (2, 7, 6), (3, 0, 4), (3, 4, 7)]
+    return corners[np.array(faces)]
+
+
+def bumpy_sphere(triangles, radius=40.0):
+    """A closed UV sphere with surface detail, roughly `triangles` faces."""
+    rings = max(8, int(np.sqrt(triangles / 4)))
+    segments = 2 * rings
+    theta = np.linspace(0, np.pi, rings + 1)
+    phi = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing="ij")
+    r = radius * (1 + 0.03 * np.sin(7 * t) * np.cos(9 * p) + 0.01 * np.sin(31 * t) * np.sin(29 * p))
+    points = np.stack([r * np.sin(t) * np.cos(p), r * np.sin(t) * np.sin(p), r * np.cos(t)], axis=-1)
+    points[0, :] = [0, 0, radius]
+    points[-1, :] = [0, 0, -radius]
+
+    i, j = np.meshgrid(np.arange(rings), np.arange(segments), indexing="ij")
+    j_next = (j + 1) % segments
+    a, b, c, d = points[i, j], points[i + 1, j], points[i + 1, j_next], points[i, j_next]
+    faces = np.concatenate([np.stack([a, b, c], axis=-2).reshape(-1, 3, 3), np.stack([a, c, d], axis=-2).reshape(-1, 3, 3)])
+    # Drop the zero-area faces at the poles
+    area = np.linalg.norm(np.cross(faces[:, 1] - faces[:, 0], faces[:, 2] - faces[:, 0]), axis=1)
+    return faces[area > 1e-12].astype(np.float32)
+
+
+def write_ascii_stl(triangles, path):
+    with open(path, "w") as f:
+        f.write("solid bench\n")
+        for tri in triangles:
+            f.write("facet normal 0 0 0\n outer loop\n")
+            for v in tri:
+                f.write(f"  vertex {v[0]:.6e} {v[1]:.6e} {v[2]:.6e}\n")
+            f.write(" endloop\nendfacet\n")
+        f.write("endsolid bench\n")
+
+
+def build_corpus(directory=DEFAULT_DIR, sizes=("tiny", "small", "medium"), ascii=True):
+    """
+    Write the models of the given size classes to `directory` (skipping files
+    already there) and return their descriptions, also saved as corpus.json.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    entries = []
+    for name, (size_class, generate) in MODELS.items():
+        if size_class not in sizes:
+            continue
+        binary_path = directory / f"{name}.stl"
+        ascii_path = directory / f"{name}.ascii.stl"
+        triangles = None
+        if not binary_path.exists():
+            triangles = generate()
+            write_binary_stl(triangles, binary_path)
+        count = (binary_path.stat().st_size - 84) // 50
+        entries.append({"name": name, "size_class": size_class, "format": "binary", "triangles": count,
+                        "path": str(binary_path), "bytes": binary_path.stat().st_size})
+        if ascii and count <= MAX_ASCII_TRIANGLES:
+            if not ascii_path.exists():
+                write_ascii_stl(generate() if triangles is None else triangles, ascii_path)
+            entries.append({"name": f"{name}.ascii", "size_class": size_class, "format": "ascii", "triangles": count,
+                            "path": str(ascii_path), "bytes": ascii_path.stat().st_size})
+    (directory / "corpus.json").write_text(json.dumps(entries, indent=2))
+    return entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=str(DEFAULT_DIR))
+    parser.add_argument("--sizes", default="tiny,small,medium", help=f"comma-separated, from {', '.join(SIZE_CLASSES)}")
+    parser.add_argument("--no-ascii", action="store_true")
+    args = parser.parse_args()
+    for entry in build_corpus(args.dir, args.sizes.split(","), ascii=not args.no_ascii):
+        print(f"{entry['name']:>24} {entry['triangles']:>9} triangles {entry['bytes'] / 1e6:9.1f} MB")
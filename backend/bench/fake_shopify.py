@@ -0,0 +1,240 @@
+"""
+Minimal stand-in for the Shopify Admin API endpoints the backend uses.
+
+Run standalone with `uvicorn bench.fake_shopify:app --port 8900` (from backend/)
+and set SHOPIFY_BASE_URL=http://127.0.0.1:8900, or start it in-process with
+`start_server()` from a benchmark.
+
+With FAKE_SHOPIFY_THROTTLE=1 (or start_server(throttle=True)) it enforces
+Shopify-style rate limits: a leaky bucket for REST calls reported in
+X-Shopify-Shop-Api-Call-Limit and answered with 429, and a GraphQL cost budget
+reported in extensions.cost and answered with THROTTLED errors.
+
+start_server(tls=True) serves HTTPS with a throwaway self-signed certificate
+(made with the openssl command), so benchmarks pay for handshakes as they do
+against the real Shopify.
+"""
+import asyncio
+import itertools
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCY_MS = float(os.getenv("FAKE_SHOPIFY_LATENCY_MS", "40"))
+THROTTLE = os.getenv("FAKE_SHOPIFY_THROTTLE", "0") == "1"
+REST_BUCKET_SIZE = int(os.getenv("FAKE_SHOPIFY_REST_BUCKET", "40"))
+REST_LEAK_RATE = float(os.getenv("FAKE_SHOPIFY_REST_LEAK_RATE", "2"))
+GRAPHQL_BUCKET_SIZE = int(os.getenv("FAKE_SHOPIFY_GRAPHQL_BUCKET", "2000"))
+GRAPHQL_RESTORE_RATE = float(os.getenv("FAKE_SHOPIFY_GRAPHQL_RESTORE_RATE", "100"))
+# Rough requested costs of the documents the backend sends
+QUERY_COSTS = {"products(": 150, "productSet": 30, "stagedUploadsCreate": 10, "publishablePublish": 10}
+DEFAULT_QUERY_COST = 2
+
+
+class Bucket:
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.available = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self, cost):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.available < cost:
+            return False
+        self.available -= cost
+        return True
+
+
+app = FastAPI()
+app.state.latency_ms = LATENCY_MS
+app.state.requests = 0
+app.state.throttled = 0
+_ids = itertools.count(1000)
+
+
+def configure_throttling(enabled, rest_bucket=REST_BUCKET_SIZE, rest_leak_rate=REST_LEAK_RATE,
+                         graphql_bucket=GRAPHQL_BUCKET_SIZE, graphql_restore_rate=GRAPHQL_RESTORE_RATE):
+    app.state.throttle = enabled
+    app.state.rest_bucket = Bucket(rest_bucket, rest_leak_rate)
+    app.state.graphql_bucket = Bucket(graphql_bucket, graphql_restore_rate)
+
+
+configure_throttling(THROTTLE)
+
+
+@app.middleware("http")
+async def rest_call_limit(request: Request, call_next):
+    if not request.url.path.endswith(".json") or request.url.path.endswith("graphql.json"):
+        return await call_next(request)
+    bucket = request.app.state.rest_bucket
+    if request.app.state.throttle and not bucket.take(1):
+        request.app.state.throttled += 1
+        return JSONResponse(
+            status_code=429,
+            content={"errors": "Exceeded 2 calls per second for api client. Reduce request rates to resume uninterrupted service."},
+            headers={"Retry-After": "1.0"},
+        )
+    response = await call_next(request)
+    if request.app.state.throttle:
+        response.headers["X-Shopify-Shop-Api-Call-Limit"] = f"{bucket.capacity - int(bucket.available)}/{bucket.capacity}"
+    return response
+
+
+def _query_cost(query):
+    return next((cost for marker, cost in QUERY_COSTS.items() if marker in query), DEFAULT_QUERY_COST)
+
+
+def _cost_extension(requested, actual, bucket):
+    return {"cost": {
+        "requestedQueryCost": requested,
+        "actualQueryCost": actual,
+        "throttleStatus": {
+            "maximumAvailable": float(bucket.capacity),
+            "currentlyAvailable": int(bucket.available),
+            "restoreRate": bucket.rate,
+        },
+    }}
+
+
+async def _respond(request, body):
+    app.state.requests += 1
+    await asyncio.sleep(request.app.state.latency_ms / 1000)
+    return body
+
+
+@app.get("/admin/api/{version}/variants/{variant_id}.json")
+async def get_variant(variant_id: str, request: Request):
+    return await _respond(request, {"variant": {"id": int(variant_id), "price": "0.08", "title": "Black"}})
+
+
+@app.get("/admin/api/{version}/variants/{variant_id}/metafields.json")
+async def get_variant_metafields(variant_id: str, request: Request):
+    return await _respond(request, {"metafields": [{"namespace": "custom", "key": "density", "value": "1.24"}]})
+
+
+@app.get("/admin/api/{version}/products/{product_id}.json")
+async def get_product(product_id: str, request: Request):
+    return await _respond(request, {"product": {"id": int(product_id), "title": "PLA", "variants": [{"price": "0.08"}]}})
+
+
+@app.get("/admin/api/{version}/products/{product_id}/metafields.json")
+async def get_product_metafields(product_id: str, request: Request):
+    return await _respond(request, {"metafields": [{"namespace": "custom", "key": "density", "value": "1.24"}]})
+
+
+@app.post("/staged-uploads/{upload_id}")
+async def staged_upload(upload_id: str, request: Request):
+    # Stands in for the storage bucket a stagedUploadsCreate target points at
+    await request.form()
+    return await _respond(request, {})
+
+
+@app.post("/admin/api/{version}/graphql.json")
+async def graphql(request: Request):
+    payload = await request.json()
+    query = payload.get("query", "")
+    cost = _query_cost(query)
+    bucket = request.app.state.graphql_bucket
+    if request.app.state.throttle and not bucket.take(cost):
+        request.app.state.throttled += 1
+        return await _respond(request, {
+            "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+            "extensions": _cost_extension(cost, None, bucket),
+        })
+    if "productSet" in query:
+        product_id = next(_ids)
+        handle = payload["variables"]["input"].get("handle", f"product-{product_id}")
+        data = {"productSet": {"product": {
+            "id": f"gid://shopify/Product/{product_id}",
+            "handle": handle,
+            "variants": {"nodes": [{"id": f"gid://shopify/ProductVariant/{next(_ids)}"}]},
+        }, "userErrors": []}}
+    elif "stagedUploadsCreate" in query:
+        upload_id = next(_ids)
+        data = {"stagedUploadsCreate": {"stagedTargets": [{
+            "url": f"{str(request.base_url).rstrip('/')}/staged-uploads/{upload_id}",
+            "resourceUrl": f"https://shopify-staged-uploads.example.com/{upload_id}",
+            "parameters": [{"name": "key", "value": f"tmp/{upload_id}"}],
+        }], "userErrors": []}}
+    elif "publishablePublish" in query:
+        data = {"publishablePublish": {"userErrors": []}}
+    elif "productVariant(" in query:
+        data = {"productVariant": {
+            "title": "Black", "price": "0.08", "metafield": {"value": "1.24"}, "product": {"title": "PLA"},
+        }}
+    elif "products(" in query:
+        data = {"products": {"nodes": [_material(1, "PLA", "1.24"), _material(3, "PETG", "1.27")]}}
+    elif "product(" in query:
+        data = {"product": {"title": "PLA", "metafield": {"value": "1.24"}, "variants": {"nodes": [{"price": "0.08"}]}}}
+    else:
+        data = {}
+    body = {"data": data}
+    if request.app.state.throttle:
+        body["extensions"] = _cost_extension(cost, cost, bucket)
+    return await _respond(request, body)
+
+
+def _material(product_id, title, density):
+    return {
+        "id": f"gid://shopify/Product/{product_id}",
+        "title": title,
+        "metafield": {"value": density},
+        "variants": {"nodes": [
+            {"id": f"gid://shopify/ProductVariant/{product_id}{n}", "title": color, "price": "0.08", "metafield": {"value": density}}
+            for n, color in enumerate(["Black", "White"])
+        ]},
+    }
+
+
+class _Server(uvicorn.Server):
+    def install_signal_handlers(self):
+        pass
+
+
+def _self_signed_cert(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-keyout", key, "-out", cert,
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+def start_server(port=8900, latency_ms=LATENCY_MS, throttle=THROTTLE, tls=False, **limits):
+    """
+    Run the fake server in a background thread and return (base_url, stop).
+    `limits` are passed to configure_throttling. With tls=True it serves HTTPS,
+    and SSL_CERT_FILE is pointed at its certificate so httpx clients trust it.
+    """
+    app.state.latency_ms = latency_ms
+    configure_throttling(throttle, **limits)
+    config = {}
+    certs = None
+    if tls:
+        certs = tempfile.mkdtemp(prefix="fake-shopify-")
+        config["ssl_certfile"], config["ssl_keyfile"] = _self_signed_cert(certs)
+        os.environ["SSL_CERT_FILE"] = config["ssl_certfile"]
+    server = _Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", **config))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+        if certs:
+            shutil.rmtree(certs, ignore_errors=True)
+
+    return f"{'https' if tls else 'http'}://127.0.0.1:{port}", stop
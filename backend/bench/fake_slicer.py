@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in for the prusa-slicer CLI, for load tests on machines
+without PrusaSlicer or where its run-to-run variance would hide regressions.
+Accepts the arguments slicer.py passes, reports progress the same way, and
+writes a small G-code file ending in PrusaSlicer's statistics block. Usage
+comes from the mesh estimate; the time taken is a fixed startup plus a cost
+per triangle and per cm3, so the same model always takes as long.
+
+    PRUSA_SLICER_BIN=bench/fake_slicer.py uvicorn main:app
+
+FAKE_SLICER_STARTUP_SECONDS, FAKE_SLICER_SECONDS_PER_MTRI and
+FAKE_SLICER_SECONDS_PER_CM3 tune the timing; FAKE_SLICER_BUSY=1 spins the
+CPU for that long instead of sleeping, like a real slicer would.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mesh import analyse_stl, estimate_filament
+
+STARTUP_SECONDS = float(os.getenv("FAKE_SLICER_STARTUP_SECONDS", "0.3"))
+SECONDS_PER_MTRI = float(os.getenv("FAKE_SLICER_SECONDS_PER_MTRI", "8"))
+SECONDS_PER_CM3 = float(os.getenv("FAKE_SLICER_SECONDS_PER_CM3", "0.02"))
+BUSY = os.getenv("FAKE_SLICER_BUSY", "0") == "1"
+# Volumetric flow used for the print time estimate
+FLOW_MM3_PER_S = 8.0
+PROGRESS_STEPS = [(10, "Processing triangulated mesh"), (30, "Generating perimeters"), (60, "Generating infill"),
+                  (80, "Generating support material"), (90, "Exporting G-code")]
+
+
+def parse_args(argv):
+    options = {"layer-height": "0.2", "fill-density": "20%", "nozzle-diameter": "0.4", "filament-diameter": "1.75"}
+    model = output = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "-g":
+            model = argv[i + 1]
+            i += 1
+        elif arg == "--output":
+            output = argv[i + 1]
+            i += 1
+        elif arg.startswith("--") and "=" in arg:
+            key, value = arg[2:].split("=", 1)
+            options[key] = value
+        i += 1
+    if model is None or output is None:
+        sys.exit("usage: fake_slicer.py -g model.stl --output out.gcode [--key=value ...]")
+    return model, output, options
+
+
+def wait(seconds):
+    deadline = time.perf_counter() + seconds
+    if BUSY:
+        while time.perf_counter() < deadline:
+            pass
+    else:
+        time.sleep(max(0.0, seconds))
+
+
+def main(argv):
+    model, output, options = parse_args(argv)
+    layer_height = float(options["layer-height"])
+    infill = float(options["fill-density"].rstrip("%"))
+    nozzle = float(options["nozzle-diameter"])
+
+    wait(STARTUP_SECONDS)
+    try:
+        stats = analyse_stl(model)
+    except Exception as e:
+        print(f"Loading of a model file failed: {e}", file=sys.stderr)
+        return 1
+    usage = estimate_filament(stats, infill_density=infill, nozzle_diameter=nozzle)
+
+    work = stats["triangles"] / 1e6 * SECONDS_PER_MTRI + usage["volume_cm3"] * SECONDS_PER_CM3
+    previous = 0
+    for percent, message in PROGRESS_STEPS:
+        print(f"{percent} => {message}", flush=True)
+        wait(work * (percent - previous) / 100)
+        previous = percent
+    wait(work * (100 - previous) / 100)
+
+    height = stats["bbox_max"][2] - stats["bbox_min"][2]
+    layers = max(1, round(height / layer_height))
+    print_seconds = int(usage["volume_cm3"] * 1000 / FLOW_MM3_PER_S)
+    hours, rest = divmod(print_seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    with open(output, "w") as f:
+        f.write("; generated by bench/fake_slicer.py\nG28\nG1 Z0.2 F3000\n")
+        f.write(f"; filament used [mm] = {usage['length_mm']:.2f}\n")
+        f.write(f"; filament used [cm3] = {usage['volume_cm3']:.2f}\n")
+        f.write(f"; estimated printing time (normal mode) = {hours}h {minutes}m {seconds}s\n")
+        f.write(f"; total layers count = {layers}\n\n")
+        f.write("; prusaslicer_config = begin\n; support_material = 1\n; prusaslicer_config = end\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,389 @@
+"""
+Load test of the quote pipeline: /api/get-quote, and /api/save-model for a
+share of the quotes, against a real backend process (uvicorn) with the fake
+Shopify server and, unless --real-slicer, the deterministic fake slicer.
+Models come from the procedural corpus (bench/corpus.py).
+
+Reports throughput and p50/p95/p99 latency per endpoint, per model size and
+per request stage (from the backend's own stage timings), plus peak RSS of
+the backend and of the backend together with its slicer processes. Results
+are written as JSON tagged with the git commit; --compare checks them
+against an earlier run and exits with 1 when something got slower.
+
+With --slice-workers N the backend slices on N local worker.py processes,
+like a cluster on one machine; their memory isn't counted.
+
+    cd backend && python bench/load.py --concurrency 8 --requests 200 --output load.json
+    cd backend && python bench/load.py --sizes tiny,small,medium,large --real-slicer
+    cd backend && python bench/load.py --output new.json --compare load.json
+    cd backend && python bench/load.py --slice-workers 3 --slicers 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import httpx
+
+from bench.corpus import DEFAULT_DIR, build_corpus
+from bench.fake_shopify import start_server
+
+MATERIAL = "gid://shopify/Product/1"
+VARIANT = "gid://shopify/ProductVariant/2"
+FAKE_SLICER = Path(__file__).resolve().parent / "fake_slicer.py"
+PERCENTILES = (50, 95, 99)
+# Called by the harness itself, not part of the load
+IGNORED_ENDPOINTS = {"/api/ping", "/api/slicer-stats"}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))]
+
+
+def summarise(timings_ms):
+    timings_ms = sorted(timings_ms)
+    summary = {"count": len(timings_ms)}
+    for pct in PERCENTILES:
+        value = percentile(timings_ms, pct)
+        summary[f"p{pct}_ms"] = round(value, 2) if value is not None else None
+    summary["max_ms"] = round(timings_ms[-1], 2) if timings_ms else None
+    return summary
+
+
+class RssSampler:
+    """Samples the summed RSS of a process and all its descendants (slicers included)."""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_total = max(self.peak_total, sum(_rss(pid) for pid in _descendants(self.pid)))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def _status_field(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return 0
+
+
+def _rss(pid):
+    return _status_field(pid, "VmRSS")
+
+
+def _descendants(root):
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (FileNotFoundError, ProcessLookupError, IndexError, ValueError):
+                continue
+            children[ppid].append(int(entry))
+    found, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        found.append(pid)
+        stack.extend(children.get(pid, ()))
+    return found
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def slicer_env(args):
+    env = {}
+    if not args.real_slicer:
+        env["PRUSA_SLICER_BIN"] = str(FAKE_SLICER)
+    if args.slicers:
+        env["SLICE_CONCURRENCY"] = str(args.slicers)
+    return env
+
+
+def start_uvicorn(app, port, cwd, env):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--app-dir", str(BACKEND_DIR),
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd, env={**os.environ, **env},
+    )
+
+
+def wait_until_up(proc, url, what):
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"{what} exited with status {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.terminate()
+    sys.exit(f"{what} did not start within 60s")
+
+
+def start_slice_workers(args, workdir):
+    """--slice-workers worker processes on this machine, each with its own mesh store."""
+    procs, urls = [], []
+    for i in range(args.slice_workers):
+        port = args.port + 10 + i
+        cwd = workdir / f"slice-worker-{i}"
+        cwd.mkdir()
+        procs.append(start_uvicorn("worker:app", port, cwd, {**slicer_env(args), "LOG_LEVEL": "WARNING"}))
+        urls.append(f"http://127.0.0.1:{port}")
+    for proc, url in zip(procs, urls):
+        wait_until_up(proc, f"{url}/internal/health", f"Slice worker {url}")
+    return procs, urls
+
+
+def start_backend(args, workdir, shopify_url, slice_workers=()):
+    env = {
+        "SHOPIFY_BASE_URL": shopify_url,
+        "SHOPIFY_TOKEN": os.getenv("SHOPIFY_TOKEN", "bench"),
+        # Every request is traced to the slow log, which is where stage timings come from
+        "SLOW_REQUEST_SECONDS": "1e-9",
+        "SLOW_REQUEST_LOG": str(workdir / "traces.jsonl"),
+        "LOG_LEVEL": "WARNING",
+        "SLICE_QUEUE_SIZE": os.getenv("SLICE_QUEUE_SIZE", str(max(16, args.concurrency * 2))),
+        **slicer_env(args),
+    }
+    if slice_workers:
+        env["SLICE_WORKERS"] = ",".join(slice_workers)
+    # Started from the scratch directory so caches, staging and uploads start empty
+    proc = start_uvicorn("main:app", args.port, workdir, env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    wait_until_up(proc, f"{base_url}/api/ping", "Backend")
+    return proc, base_url
+
+
+def plan_requests(corpus, args):
+    """The same sequence of (model, infill, save) for a given seed and corpus."""
+    rng = random.Random(args.seed)
+    return [
+        (corpus[i % len(corpus)], rng.choice(args.infills), rng.random() < args.save_ratio)
+        for i in range(args.requests)
+    ]
+
+
+async def drive(base_url, plan, args):
+    contents = {entry["path"]: Path(entry["path"]).read_bytes() for entry, _, _ in plan}
+    results = []  # (endpoint, size_class, status, ms)
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    async def timed(client, endpoint, size_class, **kwargs):
+        started = time.perf_counter()
+        try:
+            resp = await client.post(f"{base_url}{endpoint}", **kwargs)
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            resp, status = None, type(e).__name__
+        results.append((endpoint, size_class, status, (time.perf_counter() - started) * 1000))
+        return resp
+
+    async def worker(client, n):
+        while not queue.empty():
+            entry, infill, save = queue.get_nowait()
+            form = {"material": MATERIAL, "variant": VARIANT, "infill": str(infill), "layerHeight": str(args.layer_height), "nozzleSize": "0.4"}
+            filename = Path(entry["path"]).name
+            resp = await timed(client, "/api/get-quote", entry["size_class"], files={"file": (filename, contents[entry["path"]])}, data=form)
+            if save and resp is not None and resp.status_code == 200:
+                token = resp.json().get("quote_token")
+                await timed(client, "/api/save-model", entry["size_class"], data={
+                    "quote_token": token, "name": f"Bench {entry['name']}", "email": f"load{n}@example.com",
+                })
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client, n) for n in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def endpoint_report(results, elapsed):
+    report = {}
+    by_endpoint = defaultdict(list)
+    for endpoint, size_class, status, ms in results:
+        by_endpoint[endpoint].append((size_class, status, ms))
+    for endpoint, rows in by_endpoint.items():
+        errors = defaultdict(int)
+        for _, status, _ in rows:
+            if status != 200 and not (endpoint == "/api/save-model" and status == 202):
+                errors[str(status)] += 1
+        ok = [ms for _, status, ms in rows if str(status) not in errors]
+        by_size = defaultdict(list)
+        for size_class, status, ms in rows:
+            if str(status) not in errors:
+                by_size[size_class].append(ms)
+        report[endpoint] = {
+            **summarise(ok),
+            "requests": len(rows),
+            "throughput_rps": round(len(rows) / elapsed, 2),
+            "errors": dict(errors),
+            "by_size_class": {size: summarise(ms) for size, ms in sorted(by_size.items())},
+        }
+    return report
+
+
+def stage_report(trace_log):
+    """p50/p95/p99 of every stage, per endpoint, from the backend's traced requests."""
+    stages = defaultdict(lambda: defaultdict(list))
+    if not trace_log.exists():
+        return {}
+    for line in trace_log.read_text().splitlines():
+        trace = json.loads(line)
+        endpoint = trace.get("endpoint", "unknown")
+        if endpoint in IGNORED_ENDPOINTS:
+            continue
+        stages[endpoint]["total"].append(trace["seconds"] * 1000)
+        for stage, seconds in trace.get("stages", {}).items():
+            stages[endpoint][stage].append(seconds * 1000)
+    return {endpoint: {stage: summarise(ms) for stage, ms in by_stage.items()} for endpoint, by_stage in stages.items()}
+
+
+def compare(result, baseline, tolerance):
+    """Print how endpoint latencies, throughput and memory moved; True if anything regressed."""
+    regressed = False
+    print(f"\nAgainst {baseline.get('commit') or 'baseline'} (tolerance {tolerance:.0%}):")
+    rows = []
+    for endpoint, now in result["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(endpoint)
+        if not before:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            rows.append((f"{endpoint} {key}", before.get(key), now.get(key), True))
+        rows.append((f"{endpoint} throughput_rps", before.get("throughput_rps"), now.get("throughput_rps"), False))
+    for key in ("backend_peak_mb", "total_peak_mb"):
+        rows.append((f"rss {key}", baseline.get("rss", {}).get(key), result["rss"].get(key), True))
+    for label, before, now, lower_is_better in rows:
+        if not before or now is None:
+            continue
+        change = (now - before) / before
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        regressed |= worse
+        print(f"  {label:<36} {before:>10.1f} -> {now:>10.1f}  {change:+7.1%}{'  REGRESSION' if worse else ''}")
+    return regressed
+
+
+def main(args):
+    corpus = build_corpus(args.corpus_dir, args.sizes, ascii=not args.no_ascii)
+    if args.formats != "both":
+        corpus = [entry for entry in corpus if entry["format"] == args.formats]
+    if not corpus:
+        sys.exit("No models selected")
+    plan = plan_requests(corpus, args)
+
+    shopify_url, stop_shopify = start_server(port=args.shopify_port, latency_ms=args.latency_ms, throttle=args.throttle)
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        workers, worker_urls = start_slice_workers(args, workdir)
+        backend, base_url = start_backend(args, workdir, shopify_url, worker_urls)
+        sampler = RssSampler(backend.pid)
+        sampler.start()
+        try:
+            results, elapsed = asyncio.run(drive(base_url, plan, args))
+            # Let the outbox create the products of the saves before reading the traces
+            time.sleep(args.drain_seconds)
+            slicer_stats = httpx.get(f"{base_url}/api/slicer-stats").json()
+            backend_peak = _status_field(backend.pid, "VmHWM")
+        finally:
+            sampler.stop()
+            for proc in (backend, *workers):
+                proc.terminate()
+                proc.wait()
+            stop_shopify()
+        stages = stage_report(workdir / "traces.jsonl")
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "corpus": [{k: entry[k] for k in ("name", "size_class", "format", "triangles", "bytes")} for entry in corpus],
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "endpoints": endpoint_report(results, elapsed),
+        "stages": stages,
+        "rss": {"backend_peak_mb": round(backend_peak / 2**20, 1), "total_peak_mb": round(sampler.peak_total / 2**20, 1)},
+        "slicer": slicer_stats,
+    }
+
+    print(f"{len(results)} requests in {elapsed:.1f}s ({result['throughput_rps']} req/s), "
+          f"{'PrusaSlicer' if args.real_slicer else 'fake slicer'}, concurrency {args.concurrency}")
+    for endpoint, report in result["endpoints"].items():
+        print(f"  {endpoint:<18} p50 {report['p50_ms']} ms  p95 {report['p95_ms']} ms  p99 {report['p99_ms']} ms  errors {report['errors'] or 0}")
+    for endpoint, by_stage in stages.items():
+        print(f"  stages of {endpoint}:")
+        for stage, summary in sorted(by_stage.items(), key=lambda item: -(item[1]["p50_ms"] or 0)):
+            print(f"    {stage:<20} p50 {summary['p50_ms']:>9} ms  p95 {summary['p95_ms']:>9} ms  p99 {summary['p99_ms']:>9} ms")
+    print(f"  peak RSS: backend {result['rss']['backend_peak_mb']} MB, with slicers {result['rss']['total_peak_mb']} MB")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+        print(f"Wrote {args.output}")
+    if args.compare and compare(result, json.loads(Path(args.compare).read_text()), args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100, help="quote requests; saves come on top")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--save-ratio", type=float, default=0.2, help="share of successful quotes that are saved")
+    parser.add_argument("--infills", type=lambda s: [int(v) for v in s.split(",")], default=[15, 20, 30],
+                        help="infills to draw from; fewer values mean more quote cache hits")
+    parser.add_argument("--layer-height", type=float, default=0.2)
+    parser.add_argument("--sizes", type=lambda s: s.split(","), default=["tiny", "small", "medium"])
+    parser.add_argument("--formats", choices=("binary", "ascii", "both"), default="both")
+    parser.add_argument("--no-ascii", action="store_true", help="don't generate ASCII copies")
+    parser.add_argument("--corpus-dir", default=str(DEFAULT_DIR))
+    parser.add_argument("--real-slicer", action="store_true", help="use PRUSA_SLICER_BIN/prusa-slicer instead of bench/fake_slicer.py")
+    parser.add_argument("--slicers", type=int, help="SLICE_CONCURRENCY for the backend, or for each slice worker")
+    parser.add_argument("--slice-workers", type=int, default=0, help="slice on this many local worker processes (worker.py)")
+    parser.add_argument("--latency-ms", type=float, default=40, help="fake Shopify latency")
+    parser.add_argument("--throttle", action="store_true", help="enforce Shopify rate limits in the fake")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--drain-seconds", type=float, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8950)
+    parser.add_argument("--shopify-port", type=int, default=8951)
+    parser.add_argument("--output")
+    parser.add_argument("--compare", help="earlier --output file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    main(parser.parse_args())
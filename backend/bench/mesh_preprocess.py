@@ -0,0 +1,71 @@
+"""
+Quote-time mesh preprocessing: how much a decimated binary copy speeds up
+slicing, against the volume error it introduces. Generates a bumpy sphere
+("scan") at the requested resolution, then for each triangle budget reports
+preparation time, slicing time and relative volume error. Slicing is timed
+with PRUSA_SLICER_BIN (prusa-slicer) when it exists; otherwise only mesh timings are shown.
+
+    cd backend && python bench/mesh_preprocess.py --triangles 2000000 --budgets 100000,400000,1000000
+    cd backend && python bench/mesh_preprocess.py --triangles 500000 --ascii
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.corpus import bumpy_sphere, write_ascii_stl
+from mesh import analyse_stl, prepare_for_quote, write_binary_stl
+from slicer import backends, slice_filament
+
+
+def time_slice(path):
+    if not backends["prusa"].available():
+        return None
+    started = time.perf_counter()
+    asyncio.run(slice_filament(str(path)))
+    return time.perf_counter() - started
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        triangles = bumpy_sphere(args.triangles)
+        original = workdir / "scan.stl"
+        if args.ascii:
+            write_ascii_stl(triangles, original)
+        else:
+            write_binary_stl(triangles, original)
+        volume = analyse_stl(original)["volume_mm3"]
+        print(f"{len(triangles)} triangles, {original.stat().st_size / 1e6:.1f} MB {'ASCII' if args.ascii else 'binary'}, volume {volume / 1000:.2f} cm3")
+
+        full = time_slice(original)
+        if full is not None:
+            print(f"{'original':>10}: slice {full:6.2f}s")
+
+        for budget in args.budgets:
+            out = workdir / f"quote-{budget}.stl"
+            started = time.perf_counter()
+            _, prepared = prepare_for_quote(original, out, budget=budget, tolerance=args.tolerance)
+            prepare = time.perf_counter() - started
+            if prepared is None:
+                print(f"{budget:>10}: prepare {prepare:6.2f}s  kept the original (under budget or over tolerance)")
+                continue
+            sliced = time_slice(out)
+            slice_text = f"slice {sliced:6.2f}s ({full / sliced:4.1f}x faster)  " if sliced and full else ""
+            print(
+                f"{budget:>10}: prepare {prepare:6.2f}s  {slice_text}"
+                f"{prepared['triangles']:>9} triangles  volume error {prepared['volume_error']:.3%}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--triangles", type=int, default=2_000_000)
+    parser.add_argument("--budgets", type=lambda s: [int(b) for b in s.split(",")], default=[50_000, 200_000, 400_000, 1_000_000])
+    parser.add_argument("--tolerance", type=float, default=0.05, help="accept larger errors than production so they are visible")
+    parser.add_argument("--ascii", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,109 @@
+"""
+Per-quote Shopify latency of a material price lookup, against the local fake
+Shopify server over TLS. The two changes to the lookup are measured as separate
+variables: connection pooling (a fresh client per quote, the old behaviour,
+versus one shared client) for each query shape (the old two REST calls versus
+one GraphQL query). The backend's own path, with its rate-limit scheduler, is
+measured last.
+
+    cd backend && python bench/shopify_client.py --quotes 200 --latency-ms 40
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fake_shopify import start_server
+
+MATERIAL = "gid://shopify/Product/1"
+VARIANT = "gid://shopify/ProductVariant/2"
+
+
+async def rest_lookup(client):
+    # What get_shopify_price used to send: the variant, then its metafields
+    resp = await client.get("/admin/api/2023-10/variants/2.json?fields=price,metafields")
+    resp.raise_for_status()
+    meta_resp = await client.get("/admin/api/2023-10/variants/2/metafields.json")
+    meta_resp.raise_for_status()
+
+
+async def graphql_lookup(client):
+    import helpers
+
+    resp = await client.post(helpers.GRAPHQL_URL, json={"query": helpers.VARIANT_QUERY, "variables": {"id": VARIANT}})
+    resp.raise_for_status()
+
+
+def fresh_client(lookup):
+    # A new client, so a new connection and TLS handshake, per quote
+    async def quote():
+        import helpers
+
+        async with helpers.create_shopify_client() as client:
+            await lookup(client)
+    return quote
+
+
+def shared_client(lookup, client):
+    async def quote():
+        await lookup(client)
+    return quote
+
+
+async def measure(label, quote, quotes, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await quote()
+            timings.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(quotes)))
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    print(
+        f"{label:>18}: p50 {statistics.median(timings):7.2f} ms  "
+        f"p95 {timings[int(len(timings) * 0.95) - 1]:7.2f} ms  "
+        f"throughput {quotes / elapsed:7.1f} quotes/s"
+    )
+
+
+async def main(args):
+    base_url, stop = start_server(port=args.port, latency_ms=args.latency_ms, tls=True)
+    os.environ["SHOPIFY_BASE_URL"] = base_url
+    os.environ.setdefault("SHOPIFY_TOKEN", "bench")
+    import helpers
+
+    try:
+        for shape, lookup in (("REST x2", rest_lookup), ("GraphQL", graphql_lookup)):
+            await measure(f"fresh, {shape}", fresh_client(lookup), args.quotes, args.concurrency)
+            async with helpers.create_shopify_client() as client:
+                await measure(f"shared, {shape}", shared_client(lookup, client), args.quotes, args.concurrency)
+
+        await helpers.open_shopify_client()
+        # Clear the material cache so quotes really talk to Shopify; concurrent misses
+        # for the same material still share one fetch, as they do in production
+        async def backend_quote():
+            await asyncio.to_thread(helpers.material_cache.invalidate)
+            await helpers.get_shopify_price(MATERIAL, VARIANT)
+        await measure("backend", backend_quote, args.quotes, args.concurrency)
+        await helpers.close_shopify_client()
+    finally:
+        stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quotes", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--port", type=int, default=8900)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,105 @@
+"""
+A burst of product creations (background writes) and price lookups (quote
+reads) against the fake Shopify server with rate limiting switched on.
+Reports latency per kind, failed calls and how often Shopify throttled us.
+--unpaced sends requests blindly and gives up on throttling, as helpers.py
+used to.
+
+    cd backend && python bench/shopify_throttle.py --saves 40 --quotes 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench import fake_shopify
+from bench.fake_shopify import start_server
+
+MATERIAL = "gid://shopify/Product/1"
+
+
+def summarise(label, timings, failures):
+    if not timings:
+        print(f"{label:>7}: all {failures} failed")
+        return
+    timings.sort()
+    print(
+        f"{label:>7}: p50 {statistics.median(timings):8.1f} ms  "
+        f"p95 {timings[max(0, int(len(timings) * 0.95) - 1)]:8.1f} ms  "
+        f"max {timings[-1]:8.1f} ms  failed {failures}"
+    )
+
+
+async def main(args):
+    base_url, stop = start_server(
+        port=args.port, latency_ms=args.latency_ms, throttle=True,
+        graphql_bucket=args.graphql_bucket, graphql_restore_rate=args.restore_rate,
+    )
+    os.environ["SHOPIFY_BASE_URL"] = base_url
+    os.environ.setdefault("SHOPIFY_TOKEN", "bench")
+    import helpers
+    from shopify_limits import shopify_scheduler
+
+    if args.unpaced:
+        async def send_immediately(query, priority):
+            return 0
+        shopify_scheduler.before_graphql = send_immediately
+        helpers.SHOPIFY_RETRIES = 0
+
+    timings = {"quote": [], "save": []}
+    failures = {"quote": 0, "save": 0}
+
+    async def timed(kind, call):
+        started = time.perf_counter()
+        try:
+            await call()
+        except Exception:
+            failures[kind] += 1
+            return
+        timings[kind].append((time.perf_counter() - started) * 1000)
+
+    async def quote(n):
+        # A different variant each time so every quote really asks Shopify
+        await helpers.get_shopify_price(MATERIAL, f"gid://shopify/ProductVariant/{10_000 + n}")
+
+    async def save(n):
+        await helpers.create_customer_product(
+            email="bench@example.com", product_name=f"Bench {n}", material=MATERIAL,
+            variant=f"gid://shopify/ProductVariant/{20_000 + n}", infill=20, layer_height=0.2,
+            nozzle_size=0.4, filename="bench.stl", file_path="bench.stl", weight=12, price=3,
+        )
+
+    await helpers.open_shopify_client()
+    try:
+        started = time.perf_counter()
+        # Saves arrive first, as in a burst of orders, then customers keep asking for quotes
+        saves = [asyncio.create_task(timed("save", lambda n=n: save(n))) for n in range(args.saves)]
+        await asyncio.sleep(0.05)
+        quotes = [asyncio.create_task(timed("quote", lambda n=n: quote(n))) for n in range(args.quotes)]
+        await asyncio.gather(*saves, *quotes)
+        elapsed = time.perf_counter() - started
+    finally:
+        await helpers.close_shopify_client()
+        stop()
+
+    print(f"{'unpaced' if args.unpaced else 'scheduled'}: {args.saves} saves + {args.quotes} quotes in {elapsed:.1f}s, "
+          f"{fake_shopify.app.state.throttled} throttled responses")
+    summarise("quotes", timings["quote"], failures["quote"])
+    summarise("saves", timings["save"], failures["save"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--saves", type=int, default=40)
+    parser.add_argument("--quotes", type=int, default=200)
+    parser.add_argument("--graphql-bucket", type=int, default=400)
+    parser.add_argument("--restore-rate", type=float, default=50)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--unpaced", action="store_true")
+    parser.add_argument("--port", type=int, default=8900)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+"""
+Latency and grams accuracy of the Kiri:Moto worker pool against PrusaSlicer.
+Slices each model with both backends (after warming the Kiri pool, so its
+numbers don't include engine startup) and reports median latency and grams,
+and how far Kiri's grams are from PrusaSlicer's. Uses generated models unless
+STL files are given.
+
+    cd backend && python bench/slicer_backends.py --repeat 3
+    cd backend && python bench/slicer_backends.py --infill 15 models/*.stl
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.corpus import box, bumpy_sphere
+from mesh import write_binary_stl
+from slicer import backends
+
+PLA_DENSITY = 1.24
+
+
+def generated_models(workdir):
+    models = {
+        "cube-20": box(20, 20, 20),
+        "plate-80x60x3": box(80, 60, 3),
+        "sphere-40k": bumpy_sphere(40_000, radius=25),
+        "sphere-400k": bumpy_sphere(400_000, radius=40),
+    }
+    paths = []
+    for name, triangles in models.items():
+        path = workdir / f"{name}.stl"
+        write_binary_stl(triangles, path)
+        paths.append(path)
+    return paths
+
+
+async def time_backend(backend, path, args):
+    timings = []
+    usage = None
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        usage = await backend.slice(str(path), args.infill, args.layer_height, args.nozzle)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), usage["volume_cm3"] * PLA_DENSITY
+
+
+async def main(args):
+    prusa, kiri = backends["prusa"], backends["kiri"]
+    if not kiri.available():
+        sys.exit("Kiri backend unavailable: node or slicer/src/kiri-run/quote-worker.js is missing")
+    if not prusa.available():
+        print("prusa-slicer is not on PATH; its column is the mesh estimate used in development\n")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = [Path(p) for p in args.models] or generated_models(Path(workdir))
+        started = time.perf_counter()
+        await kiri.warm()
+        print(f"Kiri pool of {kiri.size} workers ready in {time.perf_counter() - started:.2f}s\n")
+
+        print(f"{'model':>16} {'prusa s':>9} {'kiri s':>9} {'speedup':>8} {'prusa g':>9} {'kiri g':>9} {'grams diff':>11}")
+        errors = []
+        try:
+            for path in paths:
+                prusa_seconds, prusa_grams = await time_backend(prusa, path, args)
+                kiri_seconds, kiri_grams = await time_backend(kiri, path, args)
+                error = (kiri_grams - prusa_grams) / prusa_grams
+                errors.append(abs(error))
+                print(
+                    f"{path.stem[:16]:>16} {prusa_seconds:9.2f} {kiri_seconds:9.2f} {prusa_seconds / kiri_seconds:7.1f}x "
+                    f"{prusa_grams:9.2f} {kiri_grams:9.2f} {error:+10.1%}"
+                )
+        finally:
+            await kiri.close()
+        print(f"\nmean absolute grams difference {statistics.mean(errors):.1%}, worst {max(errors):.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("models", nargs="*", help="STL files to slice instead of the generated ones")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--infill", type=int, default=20)
+    parser.add_argument("--layer-height", type=float, default=0.2)
+    parser.add_argument("--nozzle", type=float, default=0.4)
+    asyncio.run(main(parser.parse_args()))
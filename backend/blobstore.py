@@ -0,0 +1,218 @@
+import gzip
+import hashlib
+import os
+import secrets
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:  # gzip is slower and compresses less, but always available
+    zstandard = None
+
+from db import Database
+from mesh import MeshError, is_binary_stl, read_stl, write_binary_stl
+
+# Saved models live here once, keyed by the SHA-256 of their (normalised) contents
+BLOB_DIR = Path(os.getenv("BLOB_DIR", "uploads/blobs"))
+MANIFEST_PATH = Path(os.getenv("MANIFEST_PATH", "uploads/manifest.sqlite3"))
+ZSTD_LEVEL = int(os.getenv("BLOB_ZSTD_LEVEL", "10"))
+GZIP_LEVEL = 6
+COPY_CHUNK_SIZE = 1024 * 1024
+# Blobs are decompressed here for the slicer; /dev/shm keeps that off the disk when it exists
+MATERIALIZE_DIR = Path(os.getenv("MATERIALIZE_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()))
+
+# Compressed blobs are preferred; ".raw" ones were stored uncompressed until compress() gets to them
+BLOB_SUFFIXES = (".zst", ".gz", ".raw")
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+    Write-once, content-addressed store of compressed files. ASCII STLs are
+    converted to binary before hashing, so the same mesh is stored once
+    however it was exported.
+    """
+
+    def __init__(self, directory=BLOB_DIR, level=ZSTD_LEVEL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.level = level
+
+    def _blob_path(self, digest, suffix):
+        return self.directory / digest[:2] / f"{digest}{suffix}"
+
+    def find(self, digest):
+        """Path of the stored blob for `digest`, whichever compression it was written with, or None."""
+        for suffix in BLOB_SUFFIXES:
+            path = self._blob_path(digest, suffix)
+            if path.exists():
+                return path
+        return None
+
+    def has(self, digest):
+        return self.find(digest) is not None
+
+    def put(self, path, digest=None, compress=True):
+        """
+        Store the file at `path` and return (digest, size) of the stored contents.
+        `digest` may be passed when the caller already hashed the file (e.g. while
+        uploading); it is ignored for ASCII STLs, whose contents change on normalisation.
+        With compress=False the bytes are stored as they are, for compress() to do later.
+        """
+        path = Path(path)
+        with tempfile.TemporaryDirectory(dir=self.directory) as workdir:
+            if path.suffix.lower() == ".stl" and not is_binary_stl(path):
+                try:
+                    triangles = read_stl(path)
+                except MeshError:
+                    pass  # Not a mesh we understand; keep the bytes as they are
+                else:
+                    normalised = Path(workdir) / "normalised.stl"
+                    write_binary_stl(triangles, normalised)
+                    path, digest = normalised, None
+            digest = digest or _sha256_file(path)
+            size = path.stat().st_size
+            if not self.has(digest):
+                self._write(path, digest, Path(workdir), compress)
+        return digest, size
+
+    def compress(self, digest):
+        """Compress a blob that was stored uncompressed. Returns whether there was anything to do."""
+        path = self.find(digest)
+        if path is None or path.suffix != ".raw":
+            return False
+        with tempfile.TemporaryDirectory(dir=self.directory) as workdir:
+            self._write(path, digest, Path(workdir))
+        # Readers that already opened the raw file keep reading it
+        path.unlink(missing_ok=True)
+        return True
+
+    def _write(self, path, digest, workdir, compress=True):
+        suffix = (".zst" if zstandard else ".gz") if compress else ".raw"
+        target = self._blob_path(digest, suffix)
+        target.parent.mkdir(exist_ok=True)
+        tmp = workdir / f"{digest}{suffix}.tmp"
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            if not compress:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            elif zstandard:
+                zstandard.ZstdCompressor(level=self.level).copy_stream(src, dst)
+            else:
+                with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, COPY_CHUNK_SIZE)
+        # Another writer may have stored the same content meanwhile; either copy is fine
+        os.replace(tmp, target)
+
+    @contextmanager
+    def open(self, digest):
+        """Readable, decompressing file object for a blob."""
+        path = self.find(digest)
+        if path is None:
+            raise FileNotFoundError(f"No blob {digest}")
+        with open(path, "rb") as raw:
+            if path.suffix == ".raw":
+                yield raw
+            elif path.suffix == ".zst":
+                if zstandard is None:
+                    raise RuntimeError(f"Blob {digest} is zstd-compressed but zstandard is not installed")
+                with zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+                    yield reader
+            else:
+                with gzip.GzipFile(fileobj=raw, mode="rb") as reader:
+                    yield reader
+
+    @contextmanager
+    def materialized(self, digest, suffix=".stl"):
+        """
+        Decompress a blob to a private file in MATERIALIZE_DIR for tools that need a
+        real path (the slicer), and remove it again afterwards.
+        """
+        path = MATERIALIZE_DIR / f"{digest}.{secrets.token_hex(4)}{suffix}"
+        try:
+            with self.open(digest) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            yield path
+        finally:
+            path.unlink(missing_ok=True)
+
+    def paths(self):
+        return [p for p in self.directory.glob("*/*") if p.suffix in BLOB_SUFFIXES]
+
+    def stats(self):
+        blobs = self.paths()
+        return {"blobs": len(blobs), "bytes": sum(p.stat().st_size for p in blobs)}
+
+
+class Manifest:
+    """Which customer saved which blob under what name; the only record of the original filenames."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.db = Database(path)
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS models (
+                    id INTEGER PRIMARY KEY,
+                    customer TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    order_id TEXT,
+                    created_at REAL NOT NULL,
+                    gcode_key TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS models_customer ON models (customer)")
+            conn.execute("CREATE INDEX IF NOT EXISTS models_digest ON models (digest)")
+            conn.execute("CREATE INDEX IF NOT EXISTS models_order_id ON models (order_id)")
+
+    def add(self, customer, name, filename, digest, size, order_id=None, created_at=None, gcode_key=None):
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO models (customer, name, filename, digest, size, order_id, created_at, gcode_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (customer, name, filename, digest, size, order_id, created_at or time.time(), gcode_key),
+            )
+        return cursor.lastrowid
+
+    def remove(self, model_id):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM models WHERE id = ?", (model_id,))
+
+    def for_customer(self, customer):
+        with self.db.read() as conn:
+            rows = conn.execute(
+                "SELECT id, name, filename, digest, size, order_id, created_at FROM models WHERE customer = ? ORDER BY created_at",
+                (customer,),
+            ).fetchall()
+        keys = ("id", "name", "filename", "digest", "size", "order_id", "created_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def for_order(self, order_id):
+        with self.db.read() as conn:
+            row = conn.execute(
+                "SELECT id, name, filename, digest, size, created_at, gcode_key FROM models WHERE order_id = ?", (order_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("id", "name", "filename", "digest", "size", "created_at", "gcode_key"), row))
+
+    def has_file(self, customer, filename):
+        with self.db.read() as conn:
+            return conn.execute(
+                "SELECT 1 FROM models WHERE customer = ? AND filename = ?", (customer, filename)
+            ).fetchone() is not None
+
+
+blob_store = BlobStore()
+model_manifest = Manifest()
@@ -0,0 +1,324 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from pathlib import Path
+
+import httpx
+
+import metrics
+from slice_pool import slice_pool, SlicerBusy, SLICE_CONCURRENCY
+from slicer import SliceBackend, SliceOutOfMemory, SliceTimeout, SLICE_BACKEND, SLICE_TIMEOUT_SECONDS, backends
+
+# Base URLs of slice workers (`uvicorn worker:app`), comma-separated; when empty we slice locally
+SLICE_WORKERS = [url.strip().rstrip("/") for url in os.getenv("SLICE_WORKERS", "").split(",") if url.strip()]
+SLICE_WORKER_TOKEN = os.getenv("SLICE_WORKER_TOKEN")
+SLICE_WORKER_HEALTH_SECONDS = float(os.getenv("SLICE_WORKER_HEALTH_SECONDS", "5"))
+# Nodes a slice is tried on before giving up on the cluster
+SLICE_WORKER_ATTEMPTS = int(os.getenv("SLICE_WORKER_ATTEMPTS", "3"))
+# Meshes each node is remembered to hold, so repeat slices skip even asking
+KNOWN_MESHES_PER_NODE = 1000
+MESH_CHUNK_SIZE = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+class WorkerUnavailable(Exception):
+    """A node couldn't take or finish a slice for reasons that have nothing to do with the model."""
+
+
+class WorkerBusy(WorkerUnavailable):
+    """A node's own queue was full; it is healthy, just not free."""
+
+
+class WorkerNode:
+    """A slice worker as the front API sees it: health, load, and which meshes it holds."""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.slots = 0
+        self.inflight = 0  # slices we have running there
+        self.external = 0  # running or queued there for other front processes, as of the last health check
+        self.meshes = collections.OrderedDict()
+        self.last_error = None
+        self.last_seen = None
+        self.completed = 0
+        self.failures = 0  # times it went from healthy to down
+        self.mesh_uploads = 0
+        self.mesh_bytes = 0
+        self.mesh_reuses = 0
+
+    @property
+    def load(self):
+        return (self.inflight + self.external) / max(1, self.slots)
+
+    def remember(self, name):
+        self.meshes[name] = True
+        self.meshes.move_to_end(name)
+        while len(self.meshes) > KNOWN_MESHES_PER_NODE:
+            self.meshes.popitem(last=False)
+
+    def mark_down(self, error):
+        if self.healthy:
+            log.warning("Slice worker down", extra={"node": self.url, "error": str(error)})
+            self.failures += 1
+        self.healthy = False
+        self.last_error = str(error)
+
+    async def check(self, client):
+        try:
+            resp = await client.get(f"{self.url}/internal/health", timeout=min(5.0, SLICE_WORKER_HEALTH_SECONDS))
+            resp.raise_for_status()
+            health = resp.json()
+            slots = int(health["slots"])
+            busy = int(health["running"]) + int(health["queued"])
+        except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+            self.mark_down(e)
+            return
+        if not self.healthy:
+            log.info("Slice worker up", extra={"node": self.url, "slots": slots})
+        self.healthy = True
+        self.slots = slots
+        self.external = max(0, busy - self.inflight)
+        self.last_seen = time.time()
+
+    async def send_mesh(self, client, name, path, size):
+        """Make sure the node holds the mesh, uploading it only when it doesn't."""
+        resp = await client.head(f"{self.url}/internal/meshes/{name}")
+        if resp.status_code == 404:
+            resp = await client.put(
+                f"{self.url}/internal/meshes/{name}", content=_read_chunks(path), headers={"Content-Length": str(size)}
+            )
+            if resp.status_code == 400:
+                # Our own file doesn't hash to its name: another node won't take it either
+                raise RuntimeError(f"Slice worker rejected the mesh: {resp.text[:200]}")
+            self.mesh_uploads += 1
+            self.mesh_bytes += size
+        else:
+            self.mesh_reuses += 1
+        resp.raise_for_status()
+        self.remember(name)
+
+    async def slice(self, client, name, path, size, job, on_progress):
+        for attempt in range(2):
+            if name in self.meshes:
+                self.mesh_reuses += 1
+            else:
+                with metrics.span("mesh_transfer"):
+                    await self.send_mesh(client, name, path, size)
+            async with client.stream("POST", f"{self.url}/internal/slice", json={"mesh": name, **job}) as resp:
+                if resp.status_code == 404 and attempt == 0:
+                    # Evicted from the node since we last sent it
+                    self.meshes.pop(name, None)
+                    continue
+                if resp.status_code != 200:
+                    await resp.aread()
+                    raise WorkerUnavailable(f"Slice worker answered {resp.status_code}: {resp.text[:200]}")
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    message = json.loads(line)
+                    if "progress" in message:
+                        if on_progress:
+                            on_progress(message["progress"], message["message"])
+                    elif "usage" in message:
+                        return message
+                    else:
+                        raise _slice_error(message)
+            raise WorkerUnavailable("Slice worker closed the stream without a result")
+        raise WorkerUnavailable("Slice worker keeps losing the mesh")
+
+    async def fetch_gcode(self, client, token, dest):
+        """Download the G-code a slice left on the node (which deletes it once sent)."""
+        async with client.stream("GET", f"{self.url}/internal/gcode/{token}") as resp:
+            resp.raise_for_status()
+            with open(dest, "wb") as f:
+                async for chunk in resp.aiter_bytes(MESH_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "slots": self.slots,
+            "inflight": self.inflight,
+            "load": round(self.load, 3),
+            "completed": self.completed,
+            "failures": self.failures,
+            "mesh_uploads": self.mesh_uploads,
+            "mesh_bytes": self.mesh_bytes,
+            "mesh_reuses": self.mesh_reuses,
+            "last_error": self.last_error,
+            "last_seen": self.last_seen,
+        }
+
+
+def _slice_error(message):
+    if message.get("type") == "timeout":
+        return SliceTimeout(message.get("seconds", SLICE_TIMEOUT_SECONDS))
+    if message.get("type") == "busy":
+        return WorkerBusy(message.get("error"))
+    if message.get("type") == "memory":
+        return SliceOutOfMemory(message.get("error"))
+    # Kept as the node's slicer worded it, so invalid models are still told apart from crashes
+    return RuntimeError(message.get("error", "Slice worker failed"))
+
+
+async def _read_chunks(path):
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, MESH_CHUNK_SIZE):
+            yield chunk
+
+
+def _fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(MESH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RemoteBackend(SliceBackend):
+    """
+    Slices on a set of slice workers instead of this machine. Each slice goes to
+    the healthy node with the least work per slot (preferring one that already
+    has the mesh), and moves to another node if that one fails or disappears.
+    Meshes are streamed to a node once and then referred to by their SHA-256.
+    With every node down, slices run on `local` if it can.
+    """
+
+    def __init__(self, urls, local):
+        self.name = local.name
+        self.gcode = local.gcode
+        self.nodes = [WorkerNode(url) for url in urls]
+        self.local = local
+        self._client = None
+        self._monitor = None
+        self._fingerprints = collections.OrderedDict()
+        self.retries = 0
+        self.local_fallbacks = 0
+
+    def available(self):
+        return any(node.healthy for node in self.nodes) or self.local.available()
+
+    def capacity(self):
+        return sum(node.slots for node in self.nodes if node.healthy) or SLICE_CONCURRENCY
+
+    async def warm(self):
+        if self._client is None:
+            headers = {"X-Worker-Token": SLICE_WORKER_TOKEN} if SLICE_WORKER_TOKEN else None
+            # Slices report progress as they go, but a big one can be quiet for a while in between
+            self._client = httpx.AsyncClient(headers=headers, timeout=httpx.Timeout(SLICE_TIMEOUT_SECONDS + 60, connect=5.0))
+        await self.check()
+        if self._monitor is None:
+            self._monitor = asyncio.create_task(self._watch())
+        await self.local.warm()
+
+    async def close(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        await self.local.close()
+
+    async def check(self):
+        await asyncio.gather(*(node.check(self._client) for node in self.nodes))
+        slice_pool.resize(self.capacity())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(SLICE_WORKER_HEALTH_SECONDS)
+            try:
+                await self.check()
+            except Exception:
+                log.exception("Slice worker health check failed")
+
+    def _pick(self, name, tried):
+        nodes = [node for node in self.nodes if node.healthy and node not in tried]
+        if not nodes:
+            return None
+        return min(nodes, key=lambda node: (node.load, name not in node.meshes, node.inflight))
+
+    async def _mesh_name(self, stl_path):
+        path = Path(stl_path)
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._fingerprints.get(key)
+        if digest is None:
+            digest = await asyncio.to_thread(_fingerprint, path)
+            self._fingerprints[key] = digest
+            if len(self._fingerprints) > 64:
+                self._fingerprints.popitem(last=False)
+        return f"{digest}{path.suffix.lower()}", stat.st_size
+
+    async def slice(self, stl_path, infill_density, layer_height, nozzle_diameter, on_progress=None, gcode_path=None):
+        if self._client is None:
+            await self.warm()
+        name, size = await self._mesh_name(stl_path)
+        job = {
+            "infill_density": infill_density, "layer_height": layer_height, "nozzle_diameter": nozzle_diameter,
+            "backend": self.local.name, "gcode": gcode_path is not None,
+        }
+        tried = set()
+        for _ in range(SLICE_WORKER_ATTEMPTS):
+            node = self._pick(name, tried)
+            if node is None:
+                break
+            if tried:
+                self.retries += 1
+            tried.add(node)
+            node.inflight += 1
+            try:
+                with metrics.span("remote_slicing"):
+                    result = await node.slice(self._client, name, stl_path, size, job, on_progress)
+                node.completed += 1
+            except WorkerBusy as e:
+                log.info("Slice worker busy, trying another", extra={"node": node.url, "error": str(e)})
+                continue
+            except (WorkerUnavailable, httpx.HTTPError, ValueError) as e:
+                node.mark_down(e)
+                slice_pool.resize(self.capacity())
+                continue
+            finally:
+                node.inflight -= 1
+            if gcode_path is not None and result.get("gcode"):
+                try:
+                    with metrics.span("gcode_transfer"):
+                        await node.fetch_gcode(self._client, result["gcode"], gcode_path)
+                except httpx.HTTPError as e:
+                    # The quote stands; the order just won't have its G-code archived. Left empty
+                    # rather than deleted, like the file of a slice that wrote none
+                    log.warning("Couldn't fetch G-code from slice worker", extra={"node": node.url, "error": str(e)})
+                    Path(gcode_path).write_bytes(b"")
+            return result["usage"]
+
+        if self.local.available():
+            self.local_fallbacks += 1
+            log.warning("No slice worker could take the job, slicing locally", extra={"tried": [node.url for node in tried]})
+            return await self.local.slice(stl_path, infill_density, layer_height, nozzle_diameter, on_progress, gcode_path)
+        raise SlicerBusy(math.ceil(SLICE_WORKER_HEALTH_SECONDS))
+
+    def stats(self):
+        return {
+            "available": self.available(),
+            "capacity": self.capacity(),
+            "retries": self.retries,
+            "local_fallbacks": self.local_fallbacks,
+            "nodes": [node.stats() for node in self.nodes],
+        }
+
+
+def use_slice_workers(urls=SLICE_WORKERS):
+    """Send the quoting backend's slices to the SLICE_WORKERS nodes, when there are any."""
+    if not urls:
+        return None
+    remote = RemoteBackend(urls, backends[SLICE_BACKEND])
+    backends[SLICE_BACKEND] = remote
+    return remote
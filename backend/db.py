@@ -0,0 +1,50 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class Database:
+    """
+    SQLite database in WAL mode, shareable by several uvicorn worker processes.
+    Each thread gets its own connection, opened lazily so it is never shared across a fork.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def transaction(self):
+        return _Transaction(self._connection(), "BEGIN IMMEDIATE")
+
+    def read(self):
+        """A transaction for lookups only: a consistent snapshot that doesn't wait for or block writers."""
+        return _Transaction(self._connection(), "BEGIN")
+
+
+class _Transaction:
+    """
+    Wraps a statement group in BEGIN/COMMIT. Writes begin IMMEDIATE, taking the write lock
+    up front, so concurrent workers serialize cleanly instead of failing to upgrade a read.
+    """
+
+    def __init__(self, conn, begin):
+        self.conn = conn
+        self.begin = begin
+
+    def __enter__(self):
+        self.conn.execute(self.begin)
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
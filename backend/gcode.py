@@ -0,0 +1,79 @@
+import os
+import re
+
+# PrusaSlicer writes print statistics and its config as a block of comments at the
+# very end of the file, so only the tail needs reading
+TAIL_BLOCK_SIZE = 64 * 1024
+MAX_TAIL_BYTES = 4 * 1024 * 1024
+STATS_MARKER = b"; filament used [mm]"
+# Also keep a little of what precedes the marker, where some versions put layer counts
+LEAD_BYTES = 4096
+
+TIME_PART_RE = re.compile(r"(\d+)\s*([dhms])")
+TIME_UNITS = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+
+
+def read_tail(path, marker=STATS_MARKER, block_size=TAIL_BLOCK_SIZE, max_bytes=MAX_TAIL_BYTES):
+    """
+    Read the file backwards in blocks until `marker` has been seen, returning the
+    bytes from shortly before the marker to the end of the file. Without the
+    marker in the last max_bytes, returns those bytes, from the first full line.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        tail = b""
+        position = size
+        while position > 0 and size - position < max_bytes:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            tail = f.read(read_size) + tail
+            found = tail.rfind(marker)
+            if found != -1 and (found >= LEAD_BYTES or position == 0):
+                line_start = tail.rfind(b"\n", 0, max(0, found - LEAD_BYTES)) + 1
+                return tail[line_start:]
+        if position == 0:
+            return tail
+        # Not PrusaSlicer's footer (or a huge config block); parse what we have rather than load the whole file
+        return tail[tail.find(b"\n") + 1:]
+
+
+def parse_duration(text):
+    """'1d 2h 3m 4s' -> seconds"""
+    seconds = sum(int(value) * TIME_UNITS[unit] for value, unit in TIME_PART_RE.findall(text))
+    return seconds if TIME_PART_RE.search(text) else None
+
+
+def _sum_values(value):
+    # Multi-extruder prints report a comma-separated value per extruder
+    return sum(float(v) for v in re.findall(r"[\d.]+", value))
+
+
+def parse_stats(text):
+    """Parse the comment footer of a PrusaSlicer G-code file into print statistics."""
+    comments = {}
+    for line in text.splitlines():
+        if line.startswith(";") and "=" in line:
+            key, value = line[1:].split("=", 1)
+            comments[key.strip()] = value.strip()
+
+    def number(key):
+        return _sum_values(comments[key]) if key in comments else None
+
+    layers = comments.get("total layers count") or comments.get("total layer number")
+    support = comments.get("support_material")
+    return {
+        "grams": number("total filament used [g]") or number("filament used [g]"),
+        "length_mm": number("filament used [mm]"),
+        "volume_cm3": number("filament used [cm3]"),
+        "print_time_s": parse_duration(comments.get("estimated printing time (normal mode)", "")),
+        "first_layer_time_s": parse_duration(comments.get("estimated first layer printing time (normal mode)", "")),
+        "layers": int(layers) if layers and layers.isdigit() else None,
+        # Whether supports were enabled for the slice, from the embedded config. The footer has no
+        # per-feature usage; the support share would mean summing ;TYPE:Support material moves over the whole file
+        "support_material": support == "1" if support is not None else None,
+    }
+
+
+def read_gcode_stats(path):
+    return parse_stats(read_tail(path).decode("utf-8", errors="replace"))
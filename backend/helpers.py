@@ -1,3 +1,11 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import mimetypes
+import time
 import httpx
 import os
 from dotenv import load_dotenv
@@ -5,74 +13,443 @@ import re
 import uuid
 from pathlib import Path
 
-SHOPIFY_DOMAIN = "jvvkum-8d.myshopify.com"  # Replace with your shop domain
+import metrics
+from db import Database
+from leases import leases
+from shopify_limits import shopify_scheduler, retry_after_seconds, PRIORITY_QUOTE, PRIORITY_BACKGROUND
+
+log = logging.getLogger(__name__)
+
+SHOPIFY_DOMAIN = os.getenv("SHOPIFY_DOMAIN", "jvvkum-8d.myshopify.com")  # Replace with your shop domain
+# Point this at a local fake Shopify server for benchmarks
+SHOPIFY_BASE_URL = os.getenv("SHOPIFY_BASE_URL", f"https://{SHOPIFY_DOMAIN}")
+# Resends of one request, shared by throttling (after waiting for the budget to refill)
+# and, for idempotent requests, by server errors and dropped connections
+SHOPIFY_RETRIES = 5
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+GRAPHQL_URL = "/admin/api/2025-10/graphql.json"
+# Material prices change rarely: serve cached values for an hour, and stale ones
+# (while refreshing in the background) for up to a day
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "3600"))
+PRICE_CACHE_STALE_TTL = int(os.getenv("PRICE_CACHE_STALE_TTL", "86400"))
+# Shared by all uvicorn workers of a deployment, like the quote cache
+PRICE_CACHE_PATH = Path(os.getenv("PRICE_CACHE_PATH", "cache/prices.sqlite3"))
+# Same product type the storefront uses to list materials
+MATERIAL_CATALOGUE_QUERY = os.getenv("MATERIAL_CATALOGUE_QUERY", "product_type:'3D Print material'")
 
 # Load environment variables from .env file in the same directory
 env_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
 SHOPIFY_TOKEN = os.getenv("SHOPIFY_TOKEN")
-print(f"SHOPIFY_TOKEN loaded: {SHOPIFY_TOKEN is not None}")
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+log.info("Shopify token loaded", extra={"loaded": SHOPIFY_TOKEN is not None})
 
 if not SHOPIFY_TOKEN:
     raise ValueError("SHOPIFY_TOKEN environment variable is not set. Please check your .env file.")
 
+_client = None
+
+def create_shopify_client():
+    """One pooled keep-alive client so quotes and saves reuse TCP/TLS connections to Shopify."""
+    return httpx.AsyncClient(
+        base_url=SHOPIFY_BASE_URL,
+        headers={
+            "X-Shopify-Access-Token": SHOPIFY_TOKEN,
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        },
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120),
+        timeout=httpx.Timeout(20.0, connect=5.0),
+    )
+
+async def open_shopify_client():
+    global _client
+    if _client is None:
+        _client = create_shopify_client()
+    return _client
+
+async def close_shopify_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def shopify_client():
+    # Created lazily for scripts that don't go through the FastAPI lifespan
+    global _client
+    if _client is None:
+        _client = create_shopify_client()
+    return _client
+
+async def shopify_request(method, url, priority=PRIORITY_BACKGROUND, **kwargs):
+    return await _send(method, url, priority, **kwargs)
+
+async def shopify_get(url, priority=PRIORITY_QUOTE, **kwargs):
+    """GET with retries on connection errors and 5xx, since GETs are idempotent."""
+    return await _send("GET", url, priority, retry=True, **kwargs)
+
+async def shopify_graphql(query, variables=None, retry=False, priority=None):
+    """
+    Run a GraphQL document and return its `data`. Pass retry=True only for
+    queries; mutations are not safe to repeat. Queries default to quote
+    priority and mutations to background priority.
+    """
+    payload = {"query": query, "variables": variables or {}}
+    if priority is None:
+        priority = PRIORITY_QUOTE if retry else PRIORITY_BACKGROUND
+    resp = await _send("POST", GRAPHQL_URL, priority, retry=retry, json=payload)
+    resp.raise_for_status()
+    data = resp.json()
+    if "errors" in data:
+        raise Exception(f"GraphQL errors: {data['errors']}")
+    return data.get("data", {})
+
+async def _send(method, url, priority, retry=False, **kwargs):
+    """
+    Send one Admin API request once the rate-limit scheduler has room for it.
+    Throttled requests are not executed by Shopify, so they are resent (even
+    mutations) after waiting for the budget to refill. With retry=True, server
+    errors and dropped connections are resent too. All resends share SHOPIFY_RETRIES.
+    """
+    query = kwargs["json"]["query"] if url == GRAPHQL_URL else None
+    for attempt in range(SHOPIFY_RETRIES + 1):
+        last = attempt == SHOPIFY_RETRIES
+        waiting = time.perf_counter()
+        try:
+            if query is None:
+                await shopify_scheduler.before_rest(priority)
+                metrics.observe_stage("shopify_rate_wait", time.perf_counter() - waiting)
+                with metrics.span("shopify_call"):
+                    resp = await shopify_client().request(method, url, **kwargs)
+                await shopify_scheduler.after_rest(resp)
+                throttled = resp.status_code == 429
+            else:
+                reserved = await shopify_scheduler.before_graphql(query, priority)
+                metrics.observe_stage("shopify_rate_wait", time.perf_counter() - waiting)
+                try:
+                    with metrics.span("shopify_call"):
+                        resp = await shopify_client().request(method, url, **kwargs)
+                except BaseException:
+                    await shopify_scheduler.graphql.update(refund=reserved)
+                    raise
+                try:
+                    body = resp.json()
+                except ValueError:
+                    body = None
+                throttled = await shopify_scheduler.after_graphql(query, reserved, body)
+        except httpx.TransportError:
+            if not retry or last:
+                raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            continue
+        if last:
+            return resp
+        if throttled:
+            # The scheduler holds the next attempt until the budget has refilled
+            continue
+        if retry and resp.status_code in RETRYABLE_STATUS_CODES:
+            await asyncio.sleep(retry_after_seconds(resp.headers.get("Retry-After"), 0.5 * 2 ** attempt))
+            continue
+        return resp
+
+
+class TTLCache:
+    """
+    Cache with stale-while-revalidate: entries younger than `ttl` are served as
+    is, entries younger than `stale_ttl` are served while a background refresh
+    runs, and concurrent misses for the same key share one fetch. Entries live
+    in SQLite (WAL), so every uvicorn worker sees what any of them fetched or
+    invalidated. The database methods block; call them off the event loop.
+    """
+
+    def __init__(self, ttl, stale_ttl, path=PRICE_CACHE_PATH):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.db = Database(path)
+        with self.db.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, fetched_at REAL NOT NULL)")
+        self._fetches = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def _load(self, key):
+        with self.db.read() as conn:
+            row = conn.execute("SELECT value, fetched_at FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    async def get(self, key, fetch):
+        entry = await asyncio.to_thread(self._load, key)
+        if entry is not None:
+            value, fetched_at = entry
+            # Wall-clock time: the entry may have been fetched by another process
+            age = time.time() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return value
+            if age < self.stale_ttl:
+                self.stale_hits += 1
+                self._fetch(key, fetch)
+                return value
+        self.misses += 1
+        return await asyncio.shield(self._fetch(key, fetch))
+
+    def _fetch(self, key, fetch):
+        task = self._fetches.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run_fetch(key, fetch))
+            self._fetches[key] = task
+            task.add_done_callback(lambda t: self._fetches.pop(key, None))
+            # Background refreshes may fail unobserved; that's fine, the stale value stays
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _run_fetch(self, key, fetch):
+        value = await fetch()
+        await asyncio.to_thread(self.set, key, value)
+        return value
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                [(key, json.dumps(value), now) for key, value in values.items()],
+            )
+
+    def invalidate(self, keys=None):
+        with self.db.transaction() as conn:
+            if keys is None:
+                conn.execute("DELETE FROM entries")
+            else:
+                conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+
+    def stats(self):
+        with self.db.read() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses}
+
+
+material_cache = TTLCache(PRICE_CACHE_TTL, PRICE_CACHE_STALE_TTL)
+
+DENSITY_FIELD = 'metafield(namespace: "custom", key: "density") { value }'
+
+VARIANT_QUERY = f"""
+query materialVariant($id: ID!) {{
+    productVariant(id: $id) {{
+        title
+        price
+        {DENSITY_FIELD}
+        product {{ title }}
+    }}
+}}
+"""
+
+PRODUCT_QUERY = f"""
+query materialProduct($id: ID!) {{
+    product(id: $id) {{
+        title
+        {DENSITY_FIELD}
+        variants(first: 1) {{ nodes {{ price }} }}
+    }}
+}}
+"""
+
+CATALOGUE_QUERY = f"""
+query materialCatalogue($query: String!) {{
+    products(first: 50, query: $query) {{
+        nodes {{
+            id
+            title
+            {DENSITY_FIELD}
+            variants(first: 50) {{
+                nodes {{
+                    id
+                    title
+                    price
+                    {DENSITY_FIELD}
+                }}
+            }}
+        }}
+    }}
+}}
+"""
+
+def _parse_density(metafield):
+    try:
+        return float(metafield["value"])
+    except Exception:
+        return 1.24  # Default density if not found or invalid
+
+def _product_info(product):
+    variants = product["variants"]["nodes"]
+    return {
+        "price": float(variants[0]["price"]) if variants else 0.0,
+        "density": _parse_density(product.get("metafield")),
+        "material_title": product["title"],
+        "variant_title": "",
+    }
+
+def _variant_info(variant, product_title):
+    return {
+        "price": float(variant["price"]),
+        "density": _parse_density(variant.get("metafield")),
+        "material_title": product_title,
+        # Don't show "Default Title" as it's not meaningful
+        "variant_title": "" if variant["title"] == "Default Title" else variant["title"],
+    }
+
+async def get_material_info(material_gid, variant_gid=None):
+    """
+    Price per gram, density and display names for a material (or one of its
+    variants), fetched with a single GraphQL query and cached by GID.
+    """
+    if variant_gid and variant_gid.startswith("gid://shopify/ProductVariant/"):
+        async def fetch():
+            data = await shopify_graphql(VARIANT_QUERY, {"id": variant_gid}, retry=True)
+            variant = data.get("productVariant")
+            if not variant:
+                raise ValueError(f"Variant {variant_gid} not found")
+            return _variant_info(variant, variant["product"]["title"])
+        return await material_cache.get(variant_gid, fetch)
+
+    async def fetch():
+        data = await shopify_graphql(PRODUCT_QUERY, {"id": material_gid}, retry=True)
+        product = data.get("product")
+        if not product:
+            raise ValueError(f"Material {material_gid} not found")
+        return _product_info(product)
+    return await material_cache.get(material_gid, fetch)
+
 async def get_shopify_price(material_gid, variant_gid=None):
     if not SHOPIFY_TOKEN:
         raise ValueError("SHOPIFY_TOKEN is not available")
-        
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_TOKEN,
-        "Content-Type": "application/json",
-        "Accept": "application/json"
+
+    info = await get_material_info(material_gid, variant_gid)
+    return info["price"], info["density"]
+
+async def warm_material_cache():
+    """
+    Load every material and variant from the catalogue so the first quotes are
+    cache hits. The cache is shared, so only one worker does this per
+    PRICE_CACHE_TTL; returns False when another already has.
+    """
+    token = await asyncio.to_thread(leases.acquire, "warm:materials", PRICE_CACHE_TTL)
+    if token is None:
+        return False
+    try:
+        data = await shopify_graphql(CATALOGUE_QUERY, {"query": MATERIAL_CATALOGUE_QUERY}, retry=True, priority=PRIORITY_BACKGROUND)
+    except BaseException:
+        # Let the next worker (or the next start) try again
+        await asyncio.to_thread(leases.release, "warm:materials", token)
+        raise
+    products = data.get("products", {}).get("nodes", [])
+    entries = {}
+    for product in products:
+        entries[product["id"]] = _product_info(product)
+        for variant in product["variants"]["nodes"]:
+            entries[variant["id"]] = _variant_info(variant, product["title"])
+    await asyncio.to_thread(material_cache.set_many, entries)
+    log.info("Warmed material cache", extra={"entries": len(entries), "materials": len(products)})
+    return True
+
+def verify_webhook(body: bytes, hmac_header: str):
+    """Check Shopify's X-Shopify-Hmac-Sha256 signature; without a secret configured nothing is accepted."""
+    if not SHOPIFY_WEBHOOK_SECRET or not hmac_header:
+        return False
+    digest = hmac.new(SHOPIFY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), hmac_header)
+
+def invalidate_material(product_payload):
+    """Drop a product and its variants from the material cache, given a products/update webhook payload."""
+    gids = [product_payload.get("admin_graphql_api_id")]
+    gids += [v.get("admin_graphql_api_id") for v in product_payload.get("variants", [])]
+    gids = [gid for gid in gids if gid]
+    material_cache.invalidate(gids)
+    return gids
+
+ONLINE_STORE_PUBLICATION_ID = "gid://shopify/Publication/261868257584"
+
+STAGED_UPLOAD_MUTATION = """
+mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
+    stagedUploadsCreate(input: $input) {
+        stagedTargets {
+            url
+            resourceUrl
+            parameters { name value }
+        }
+        userErrors { field message }
     }
-    
-    print(f"Getting price for material_gid: {material_gid}, variant_gid: {variant_gid}")
-    
-    # Extract numeric IDs from GIDs
-    def extract_id(gid):
-        return gid.split("/")[-1] if gid and gid.startswith("gid://shopify/") else None
-    product_id = extract_id(material_gid)
-    variant_id = extract_id(variant_gid) if variant_gid and variant_gid.startswith("gid://shopify/ProductVariant/") else None
-    
-    print(f"Extracted product_id: {product_id}, variant_id: {variant_id}")
-
-    async with httpx.AsyncClient() as client:
-        if variant_id:
-            url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/variants/{variant_id}.json?fields=price,metafields"
-            resp = await client.get(url, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()["variant"]
-            price = float(data["price"])
-            # Fetch metafields for the variant
-            meta_url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/variants/{variant_id}/metafields.json"
-            meta_resp = await client.get(meta_url, headers=headers)
-            meta_resp.raise_for_status()
-            metafields = meta_resp.json().get("metafields", [])
-        else:
-            url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/products/{product_id}.json?fields=variants,metafields"
-            resp = await client.get(url, headers=headers)
-            resp.raise_for_status()
-            product = resp.json()["product"]
-            variants = product["variants"]
-            price = float(variants[0]["price"]) if variants else 0.0
-            # Fetch metafields for the product
-            meta_url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/products/{product_id}/metafields.json"
-            meta_resp = await client.get(meta_url, headers=headers)
-            meta_resp.raise_for_status()
-            metafields = meta_resp.json().get("metafields", [])
-        # Find custom.density metafield
-        density = None
-        for mf in metafields:
-            if mf.get("namespace") == "custom" and mf.get("key") == "density":
-                try:
-                    density = float(mf.get("value"))
-                except Exception:
-                    density = None
-                break
-        if density is None:
-            density = 1.24  # Default density if not found or invalid
-        return price, density
+}
+"""
+
+# Product, owner metafield, default variant price/weight and the screenshot in one mutation
+PRODUCT_SET_MUTATION = """
+mutation productSet($identifier: ProductSetIdentifiers, $input: ProductSetInput!) {
+    productSet(identifier: $identifier, input: $input, synchronous: true) {
+        product {
+            id
+            handle
+            variants(first: 1) { nodes { id } }
+        }
+        userErrors { field message }
+    }
+}
+"""
+
+PUBLISH_MUTATION = """
+mutation publishablePublish($id: ID!, $input: [PublicationInput!]!) {
+    publishablePublish(id: $id, input: $input) {
+        userErrors { field message }
+    }
+}
+"""
+
+class ShopifyUserError(Exception):
+    """Shopify rejected the input of a mutation; sending it again won't help."""
+
+def make_product_handle(product_name, email, suffix=None):
+    suffix = suffix or uuid.uuid4().hex[:8]
+    return re.sub(r'[^\w\-]', '-', f"{product_name}-{email.split('@')[0]}-{suffix}").lower()
+
+async def _material_names(material, variant):
+    try:
+        info = await get_material_info(material, variant)
+        return info["material_title"], info["variant_title"]
+    except Exception as e:
+        log.warning("Failed to fetch material/variant names: %s", e)
+        return "Unknown Material", ""
+
+async def stage_image(path, filename, mime_type="image/png"):
+    """
+    Upload an image to Shopify's staged upload storage and return its resourceUrl,
+    which can then be attached to a product by reference. The file is streamed
+    from disk rather than base64-encoded into a JSON body.
+    """
+    size = os.path.getsize(path)
+    data = await shopify_graphql(STAGED_UPLOAD_MUTATION, {"input": [{
+        "resource": "IMAGE",
+        "filename": filename,
+        "mimeType": mime_type,
+        "fileSize": str(size),
+        "httpMethod": "POST",
+    }]})
+    result = data["stagedUploadsCreate"]
+    if result["userErrors"]:
+        raise Exception(f"Staged upload errors: {result['userErrors']}")
+    target = result["stagedTargets"][0]
+    form = {p["name"]: p["value"] for p in target["parameters"]}
+    # The target is Shopify's storage bucket, not the Admin API, so don't send the access token there
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=5.0)) as client:
+        with open(path, "rb") as f:
+            resp = await client.post(target["url"], data=form, files={"file": (filename, f, mime_type)})
+    resp.raise_for_status()
+    return target["resourceUrl"]
 
 async def create_customer_product(
         email: str, 
@@ -87,275 +464,109 @@ async def create_customer_product(
         weight: float = None, 
         price: float = None,
         screenshot_path: str = None,
-        complex: bool = False
+        complex: bool = False,
+        handle: str = None
     ):
     """
     Create a product in Shopify with custom.owner metafield set to customer email.
     This allows filtering products by customer in the storefront.
+
+    The product is upserted by `handle`, so calling again with the same handle
+    (e.g. retrying after a timeout) updates the product instead of duplicating it.
+
+    The material names (usually cached) and the screenshot upload run concurrently,
+    then a single productSet creates the product with its variant and image, and
+    publishablePublish makes it visible: three round trips on the critical path.
+    """
+    safe_handle = handle or make_product_handle(product_name, email)
+
+    image = None
+    if screenshot_path and os.path.exists(screenshot_path):
+        suffix = Path(screenshot_path).suffix or ".png"
+        mime_type = mimetypes.guess_type(f"image{suffix}")[0] or "image/png"
+        image = asyncio.create_task(stage_image(screenshot_path, f"{safe_handle}_screenshot{suffix}", mime_type))
+    material_name, variant_name = await _material_names(material, variant)
+
+    # Create detailed description with all parameters
+    description = f"""
+    <p><strong>Customer:</strong>{email}</p>
+    <p><strong>File:</strong> {filename}</p>
+    <p><strong>Material:</strong> {material_name}{" - " + variant_name if variant_name else ""}</p>
+    <p><strong>Infill:</strong> {infill}%</p>
+    <p><strong>Layer Height:</strong> {layer_height}mm</p>
+    <p><strong>Nozzle Size:</strong> {nozzle_size}mm</p>
     """
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_TOKEN,
-        "Content-Type": "application/json",
-        "Accept": "application/json"
+
+    default_variant = {
+        "optionValues": [{"optionName": "Title", "name": "Default Title"}],
+        # Always set price (default to 0.00 if not provided)
+        "price": str(price + 1) if price is not None else "0.00",
     }
-    
-    # Create a unique product handle
-    safe_handle = re.sub(r'[^\w\-]', '-', f"{product_name}-{email.split('@')[0]}-{uuid.uuid4().hex[:8]}").lower()
-    
-    async with httpx.AsyncClient() as client:
-        # Create the product - Shopify will automatically create a default variant
-        product_mutation = """
-        mutation productCreate($product: ProductCreateInput!) {
-            productCreate(product: $product) {
-                product {
-                    id
-                    title
-                    handle
-                    variants(first: 1) {
-                        edges {
-                            node {
-                                id
-                            }
-                        }
-                    }
-                }
-                userErrors {
-                    field
-                    message
-                }
+    if weight is not None:
+        default_variant["inventoryItem"] = {"measurement": {"weight": {"value": weight, "unit": "GRAMS"}}}
+
+    product_input = {
+        "title": product_name,
+        "descriptionHtml": description,
+        "handle": safe_handle,
+        "vendor": "AD-Customs",
+        "status": "UNLISTED",
+        "metafields": [
+            {
+                "namespace": "custom",
+                "key": "owner",
+                "value": email,
+                "type": "single_line_text_field"
             }
-        }
-        """
-            
-        # Fetch material and variant names from Shopify
-        material_name = "Unknown Material"
-        variant_name = ""
-        
-        try:
-            # Extract numeric IDs from GIDs
-            def extract_id(gid):
-                return gid.split("/")[-1] if gid and gid.startswith("gid://shopify/") else None
-            
-            material_id = extract_id(material)
-            variant_id = extract_id(variant) if variant and variant.startswith("gid://shopify/ProductVariant/") else None
-            
-            if material_id:
-                # Fetch material (product) name
-                material_url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/products/{material_id}.json?fields=title"
-                material_resp = await client.get(material_url, headers=headers)
-                if material_resp.status_code == 200:
-                    material_data = material_resp.json()
-                    material_name = material_data["product"]["title"]
-            
-            if variant_id:
-                # Fetch variant name
-                variant_url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/variants/{variant_id}.json?fields=title"
-                variant_resp = await client.get(variant_url, headers=headers)
-                if variant_resp.status_code == 200:
-                    variant_data = variant_resp.json()
-                    variant_name = variant_data["variant"]["title"]
-                    # Don't show "Default Title" as it's not meaningful
-                    if variant_name == "Default Title":
-                        variant_name = ""
-        
-        except Exception as e:
-            print(f"Failed to fetch material/variant names: {str(e)}")
-            # Continue with fallback values
-
-        # Create detailed description with all parameters
-        description = f"""
-        <p><strong>Customer:</strong>{email}</p>
-        <p><strong>File:</strong> {filename}</p>
-        <p><strong>Material:</strong> {material_name}{" - " + variant_name if variant_name else ""}</p>
-        <p><strong>Infill:</strong> {infill}%</p>
-        <p><strong>Layer Height:</strong> {layer_height}mm</p>
-        <p><strong>Nozzle Size:</strong> {nozzle_size}mm</p>
-        """
-        
-        # Create product input (without variants)
-        product_input = {
-            "title": product_name,
-            "descriptionHtml": description,
-            "handle": safe_handle,
-            "vendor": "AD-Customs",
-            "status": "UNLISTED",  # Make product active on online store
-            # "publications": [
-            #     {
-            #         "publicationId": "gid://shopify/Publication/261868257584"  # Online Store publication ID
-            #     }
-            # ],
-            "metafields": [
-                {
-                    "namespace": "custom",
-                    "key": "owner",
-                    "value": email,
-                    "type": "single_line_text_field"
-                }
-            ]
-        }
-        
-        # Add manual-review tag if the model is complex
-        if complex:
-            product_input["tags"] = ["manual-review"]
-        
-        variables = {
-            "product": product_input
-        }
-        
-        payload = {
-            "query": product_mutation,
-            "variables": variables
-        }
-        
-        # Debug: Print what we're actually sending
-        print(f"DEBUG: Sending GraphQL mutation with variables: {variables}")
-        print(f"DEBUG: Product input keys: {list(product_input.keys())}")
-        
-        url = f"https://{SHOPIFY_DOMAIN}/admin/api/2025-10/graphql.json"
-        
-        # Create the product - Shopify automatically creates a default variant
-        resp = await client.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        if "errors" in data:
-            raise Exception(f"GraphQL errors: {data['errors']}")
-        
-        user_errors = data.get("data", {}).get("productCreate", {}).get("userErrors", [])
-        if user_errors:
-            raise Exception(f"Product creation errors: {user_errors}")
-        
-        product = data.get("data", {}).get("productCreate", {}).get("product")
-        if not product:
-            raise Exception("Failed to create product")
-        
-        product_id = product["id"]
-        product_handle = product["handle"]
-        
-        # Now publish the product to the online store using the new publishablePublish mutation
+        ],
+        "productOptions": [{"name": "Title", "values": [{"name": "Default Title"}]}],
+        "variants": [default_variant],
+    }
+
+    # Add manual-review tag if the model is complex
+    if complex:
+        product_input["tags"] = ["manual-review"]
+
+    if image is not None:
         try:
-            publish_mutation = """
-            mutation publishablePublish($id: ID!, $input: [PublicationInput!]!) {
-                publishablePublish(id: $id, input: $input) {
-                    userErrors {
-                        field
-                        message
-                    }
-                }
-            }
-            """
-            
-            publish_variables = {
-                "id": product_id,
-                "input": [
-                    {
-                        "publicationId": "gid://shopify/Publication/261868257584"
-                    }
-                ]
-            }
-            
-            publish_payload = {
-                "query": publish_mutation,
-                "variables": publish_variables
-            }
-            
-            print(f"Publishing product {product_id} to online store...")
-            publish_resp = await client.post(url, headers=headers, json=publish_payload)
-            publish_resp.raise_for_status()
-            publish_data = publish_resp.json()
-            
-            if "errors" in publish_data:
-                print(f"Failed to publish product: {publish_data['errors']}")
-                # Don't fail the entire operation if publishing fails
-            else:
-                publish_user_errors = publish_data.get("data", {}).get("publishablePublish", {}).get("userErrors", [])
-                if publish_user_errors:
-                    print(f"Publish errors: {publish_user_errors}")
-                else:
-                    print(f"Successfully published product {product_id} to online store")
-                    
+            product_input["files"] = [{
+                "originalSource": await image,
+                "alt": f"3D render of {product_name}",
+                "contentType": "IMAGE",
+            }]
         except Exception as e:
-            print(f"Failed to publish product {product_id}: {str(e)}")
-            # Don't fail the entire operation if publishing fails
-        
-        # Get the default variant ID that Shopify automatically created
-        variant_id = None
-        variants = product.get("variants", {}).get("edges", [])
-        if variants:
-            variant_id = variants[0]["node"]["id"]
-        
-        # Update the default variant with price and weight using REST API
-        if variant_id:
-            try:
-                # Extract numeric IDs
-                numeric_product_id = product_id.split("/")[-1]
-                numeric_variant_id = variant_id.split("/")[-1]
-                
-                # Update variant using REST API
-                variant_url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/variants/{numeric_variant_id}.json"
-                
-                variant_data = {"variant": {}}
-                
-                # Always set price (default to 0.00 if not provided)
-                variant_data["variant"]["price"] = str(price + 1) if price is not None else "0.00"
-                
-                # Set weight if provided
-                if weight is not None:
-                    variant_data["variant"]["weight"] = weight
-                    variant_data["variant"]["weight_unit"] = "g"
-                
-                print(f"Updating variant {variant_id} with data: {variant_data}")
-                
-                variant_resp = await client.put(variant_url, headers=headers, json=variant_data)
-                variant_resp.raise_for_status()
-                variant_result = variant_resp.json()
-                print(f"Successfully updated variant {variant_id}")
-                
-            except Exception as e:
-                print(f"Failed to update variant {variant_id}: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                # Don't fail the entire operation if variant update fails
-        
-        print(f"Created product for customer {email}: {product_id} (handle: {product_handle})")
-        
-        # Add screenshot as product image if provided (use REST API)
-        if screenshot_path and os.path.exists(screenshot_path):
-            try:
-                # Convert screenshot to base64 for Shopify
-                import base64
-                with open(screenshot_path, "rb") as img_file:
-                    img_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-                
-                # Extract numeric product ID from GraphQL ID
-                numeric_product_id = product_id.split("/")[-1]
-                
-                # Use REST API to upload product image
-                image_url = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/products/{numeric_product_id}/images.json"
-                
-                image_data = {
-                    "image": {
-                        "attachment": img_base64,
-                        "filename": f"{product_name}_screenshot.png",
-                        "alt": f"3D render of {product_name}"
-                    }
-                }
-                
-                img_resp = await client.post(image_url, headers=headers, json=image_data)
-                img_resp.raise_for_status()
-                img_result = img_resp.json()
-                
-                if "image" in img_result:
-                    print(f"Successfully uploaded screenshot for product {product_id}")
-                    print(f"Image URL: {img_result['image'].get('src', 'N/A')}")
-                else:
-                    print(f"Unexpected response when uploading image: {img_result}")
-                        
-            except Exception as e:
-                print(f"Failed to upload screenshot for product {product_id}: {str(e)}")
-                # Don't fail the entire operation if image upload fails
-        
-        if variant_id:
-            print(f"Default variant ID: {variant_id}")
-                
-        return product_id, product_handle, variant_id
+            log.warning("Failed to upload screenshot: %s", e, extra={"handle": safe_handle})
+            # Don't fail the entire operation if image upload fails
+
+    data = await shopify_graphql(PRODUCT_SET_MUTATION, {"identifier": {"handle": safe_handle}, "input": product_input})
+    result = data.get("productSet") or {}
+    if result.get("userErrors"):
+        raise ShopifyUserError(f"Product creation errors: {result['userErrors']}")
+
+    product = result.get("product")
+    if not product:
+        raise Exception("Failed to create product")
+
+    product_id = product["id"]
+    product_handle = product["handle"]
+    variants = product.get("variants", {}).get("nodes", [])
+    variant_id = variants[0]["id"] if variants else None
+
+    # Now publish the product to the online store
+    try:
+        publish = await shopify_graphql(PUBLISH_MUTATION, {
+            "id": product_id,
+            "input": [{"publicationId": ONLINE_STORE_PUBLICATION_ID}],
+        })
+        publish_user_errors = publish.get("publishablePublish", {}).get("userErrors", [])
+        if publish_user_errors:
+            log.warning("Publish errors", extra={"product": product_id, "errors": publish_user_errors})
+        else:
+            log.info("Published product to the online store", extra={"product": product_id})
+    except Exception as e:
+        log.warning("Failed to publish product: %s", e, extra={"product": product_id})
+        # Don't fail the entire operation if publishing fails
+
+    log.info("Created product", extra={"product": product_id, "handle": product_handle, "variant": variant_id})
+
+    return product_id, product_handle, variant_id
@@ -0,0 +1,233 @@
+import os
+import secrets
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from mesh import CHUNK_TRIANGLES, read_stl
+
+# Screenshots are downsized to fit this many pixels per side before going to Shopify
+SCREENSHOT_MAX_PX = int(os.getenv("SCREENSHOT_MAX_PX", "1200"))
+# "webp" or "jpeg"; WebP is about a third smaller at the same quality
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "82"))
+# Rendered product images for orders without a screenshot, by mesh digest
+THUMBNAIL_DIR = Path(os.getenv("THUMBNAIL_DIR", "uploads/thumbnails"))
+THUMBNAIL_PX = int(os.getenv("THUMBNAIL_PX", "600"))
+# Rendered at this many times the size and averaged down, which smooths the edges
+THUMBNAIL_SUPERSAMPLE = 2
+# Pixels tested per rasterizer batch, which bounds its temporary memory (~100 bytes each)
+RASTER_BATCH_PIXELS = 1_000_000
+
+BACKGROUND = np.array([255, 255, 255], dtype=np.float64)
+MODEL_COLOUR = np.array([96, 150, 205], dtype=np.float64)
+# Towards the upper left of the viewer; faces are lit from both sides, as STL windings are often inconsistent
+LIGHT = np.array([-0.35, 0.45, 1.0]) / np.linalg.norm([-0.35, 0.45, 1.0])
+AMBIENT = 0.3
+
+SUFFIXES = {"webp": ".webp", "jpeg": ".jpg"}
+MAGIC = ((b"\x89PNG\r\n\x1a\n", ".png"), (b"\xff\xd8\xff", ".jpg"), (b"GIF8", ".gif"))
+
+
+def image_suffix(path):
+    """The file suffix matching an image's content, or None if it isn't a PNG, JPEG, GIF or WebP."""
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    for magic, suffix in MAGIC:
+        if head.startswith(magic):
+            return suffix
+    return None
+
+
+def shrink_screenshot(src, dest_stem, max_px=SCREENSHOT_MAX_PX):
+    """
+    Downsize a customer's screenshot to fit max_px and re-encode it as
+    IMAGE_FORMAT at dest_stem plus its suffix, replacing src. The original is
+    kept (renamed) when it already fits and the re-encoded copy isn't smaller.
+    Returns the path, or None (with src removed) when the file isn't an image.
+    """
+    src = Path(src)
+    suffix = image_suffix(src)
+    if suffix is None:
+        src.unlink(missing_ok=True)
+        return None
+    try:
+        shrunk, fitted = _reencode(src, dest_stem, max_px)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        src.unlink(missing_ok=True)
+        return None
+    if not fitted or shrunk.stat().st_size < src.stat().st_size:
+        src.unlink()
+        return shrunk
+    shrunk.unlink()
+    dest = Path(dest_stem).with_suffix(suffix)
+    os.replace(src, dest)
+    return dest
+
+
+def _reencode(src, dest_stem, max_px):
+    with Image.open(src) as image:
+        fitted = max(image.size) <= max_px
+        # Lets JPEG decode straight at a fraction of its size
+        image.draft("RGB", (max_px, max_px))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_px, max_px), Image.LANCZOS)
+        dest = Path(dest_stem).with_suffix(SUFFIXES.get(IMAGE_FORMAT, ".webp"))
+        _save(image, dest)
+    return dest, fitted
+
+
+def _save(image, dest):
+    tmp = dest.with_name(f"{dest.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        if IMAGE_FORMAT == "jpeg":
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                flat = Image.new("RGB", image.size, tuple(BACKGROUND.astype(int)))
+                flat.paste(image, mask=image.getchannel("A"))
+                image = flat
+            image.convert("RGB").save(tmp, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        else:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            image.save(tmp, "WEBP", quality=IMAGE_QUALITY, method=4)
+        os.replace(tmp, dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def thumbnail_path(digest):
+    return THUMBNAIL_DIR / digest[:2] / f"{digest}{SUFFIXES.get(IMAGE_FORMAT, '.webp')}"
+
+
+def cached_thumbnail(digest):
+    path = thumbnail_path(digest)
+    return path if path.exists() else None
+
+
+def save_thumbnail(digest, stl_path, size=THUMBNAIL_PX):
+    """Render the STL at stl_path into the thumbnail cache under its digest and return the path."""
+    pixels = render_thumbnail(read_stl(stl_path), size)
+    path = thumbnail_path(digest)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _save(Image.fromarray(pixels), path)
+    return path
+
+
+def _view_rotation(azimuth=np.radians(-35), elevation=np.radians(-60)):
+    # Spin about the vertical (Z) axis, then tip it away from the viewer: a three-quarter view from above
+    ca, sa = np.cos(azimuth), np.sin(azimuth)
+    ce, se = np.cos(elevation), np.sin(elevation)
+    spin = np.array([[ca, -sa, 0], [sa, ca, 0], [0, 0, 1]])
+    tilt = np.array([[1, 0, 0], [0, ce, -se], [0, se, ce]])
+    return tilt @ spin
+
+
+def render_thumbnail(triangles, size=THUMBNAIL_PX, supersample=THUMBNAIL_SUPERSAMPLE):
+    """
+    Shade an (n, 3, 3) triangle array into a size x size RGB image (uint8 array)
+    with a z-buffered software rasterizer. Everything is vectorized over
+    triangles and the pixels their bounding boxes cover, in bounded batches.
+    """
+    side = size * supersample
+    image = np.empty((side * side, 3))
+    image[:] = BACKGROUND
+    if len(triangles) == 0:
+        return image.reshape(side, side, 3).astype(np.uint8)[::supersample, ::supersample]
+
+    rotation = _view_rotation()
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for start in range(0, len(triangles), CHUNK_TRIANGLES):
+        view = np.asarray(triangles[start:start + CHUNK_TRIANGLES], dtype=np.float64).reshape(-1, 3) @ rotation.T
+        lower = np.minimum(lower, view.min(axis=0))
+        upper = np.maximum(upper, view.max(axis=0))
+    centre = (lower + upper) / 2
+    # A 6% margin on each side
+    scale = side * 0.88 / max(upper[0] - lower[0], upper[1] - lower[1], 1e-9)
+
+    depth = np.full(side * side, -np.inf)
+    for start in range(0, len(triangles), CHUNK_TRIANGLES):
+        view = np.asarray(triangles[start:start + CHUNK_TRIANGLES], dtype=np.float64) @ rotation.T
+        _rasterize(view, centre, scale, side, depth, image)
+
+    # Average supersample x supersample blocks down to the output size
+    image = image.reshape(size, supersample, size, supersample, 3).mean(axis=(1, 3))
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+
+def _rasterize(view, centre, scale, side, depth, image):
+    # Screen space: x right, y down, z towards the viewer
+    x = (view[:, :, 0] - centre[0]) * scale + side / 2
+    y = side / 2 - (view[:, :, 1] - centre[1]) * scale
+    z = view[:, :, 2]
+
+    normals = np.cross(view[:, 1] - view[:, 0], view[:, 2] - view[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    visible = (lengths > 0) & (np.abs(area) > 1e-12)
+    x, y, z, area = x[visible], y[visible], z[visible], area[visible]
+    light = AMBIENT + (1 - AMBIENT) * np.abs(normals[visible] @ LIGHT) / lengths[visible]
+
+    # Pixel centres (i + 0.5) inside each triangle's bounding box
+    x0 = np.clip(np.ceil(x.min(axis=1) - 0.5), 0, side).astype(np.int64)
+    x1 = np.clip(np.floor(x.max(axis=1) - 0.5), -1, side - 1).astype(np.int64)
+    y0 = np.clip(np.ceil(y.min(axis=1) - 0.5), 0, side).astype(np.int64)
+    y1 = np.clip(np.floor(y.max(axis=1) - 0.5), -1, side - 1).astype(np.int64)
+    widths = np.maximum(x1 - x0 + 1, 0)
+    counts = widths * np.maximum(y1 - y0 + 1, 0)
+    # Slivers and triangles smaller than a pixel often cover no pixel centre at all
+    covering = counts > 0
+    x, y, z, area, light = x[covering], y[covering], z[covering], area[covering], light[covering]
+    x0, y0, widths, counts = x0[covering], y0[covering], widths[covering], counts[covering]
+
+    # Barycentric weights, and so depth, are affine in the pixel position: w = a * px + b * py + c.
+    # Only w0, w1 and z are evaluated per pixel (w2 = 1 - w0 - w1), from one row of coefficients per triangle
+    a = np.stack([y[:, 1] - y[:, 2], y[:, 2] - y[:, 0], y[:, 0] - y[:, 1]], axis=1) / area[:, None]
+    b = np.stack([x[:, 2] - x[:, 1], x[:, 0] - x[:, 2], x[:, 1] - x[:, 0]], axis=1) / area[:, None]
+    c = np.stack([
+        x[:, 1] * y[:, 2] - x[:, 2] * y[:, 1],
+        x[:, 2] * y[:, 0] - x[:, 0] * y[:, 2],
+        x[:, 0] * y[:, 1] - x[:, 1] * y[:, 0],
+    ], axis=1) / area[:, None]
+    coefficients = np.stack([
+        a[:, 0], b[:, 0], c[:, 0], a[:, 1], b[:, 1], c[:, 1], (a * z).sum(axis=1), (b * z).sum(axis=1), (c * z).sum(axis=1),
+    ], axis=1)
+
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        # At least one triangle per batch, however many pixels it covers
+        base = ends[first - 1] if first else 0
+        last = max(first + 1, int(np.searchsorted(ends, base + RASTER_BATCH_PIXELS, side="right")))
+        _fill(slice(first, last), counts, widths, x0, y0, coefficients, light, side, depth, image)
+        first = last
+
+
+def _fill(batch, counts, widths, x0, y0, coefficients, light, side, depth, image):
+    counts = counts[batch]
+    total = int(counts.sum())
+    if total == 0:
+        return
+    tri = np.repeat(np.arange(batch.start, batch.stop), counts)
+    offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    width = widths[tri]
+    px = x0[tri] + offset % width
+    py = y0[tri] + offset // width
+    k = coefficients[tri]
+    cx, cy = px + 0.5, py + 0.5
+    w0 = k[:, 0] * cx + k[:, 1] * cy + k[:, 2]
+    w1 = k[:, 3] * cx + k[:, 4] * cy + k[:, 5]
+    inside = (w0 >= -1e-9) & (w1 >= -1e-9) & (w0 + w1 <= 1 + 1e-9)
+    k, tri, cx, cy = k[inside], tri[inside], cx[inside], cy[inside]
+    pixel = py[inside] * side + px[inside]
+    z = k[:, 6] * cx + k[:, 7] * cy + k[:, 8]
+
+    # Z-buffer: the nearest fragment per pixel wins, against this batch and earlier ones
+    np.maximum.at(depth, pixel, z)
+    nearest = z >= depth[pixel]
+    image[pixel[nearest]] = light[tri[nearest], None] * MODEL_COLOUR
+
@@ -0,0 +1,445 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+import metrics
+from db import Database
+from quotes import QuoteError
+
+# Finished jobs are kept this long so reconnecting clients get the result without a re-slice
+QUOTE_JOB_TTL = int(os.getenv("QUOTE_JOB_TTL", "900"))
+# Jobs, their watchers and each session's current quote as every worker process sees them, so a
+# request landing on another worker still finds its job, joins an identical one or supersedes the old one
+QUOTE_JOB_DB_PATH = Path(os.getenv("QUOTE_JOB_DB_PATH", "cache/jobs.sqlite3"))
+# Progress-only changes are written to the snapshot at most this often; state changes always are.
+# Also how often workers check for their quotes being superseded or left unwatched by another worker
+JOB_PUBLISH_SECONDS = float(os.getenv("JOB_PUBLISH_SECONDS", "0.5"))
+
+log = logging.getLogger(__name__)
+
+
+class QuoteJob:
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.state = "queued"  # queued -> slicing -> done | error | cancelled
+        self.progress = 0
+        self.message = "Waiting for a slicer"
+        self.provisional = None
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self._changed = asyncio.Event()
+        self.task = None
+        # Browser sessions of this worker still interested in the result; None stands for clients without one
+        self.watchers = set()
+        self.watched = False  # whether its watchers have been recorded, so it may be cancelled for having none
+        self.store = None
+        self._published_at = 0
+        self._unpublished = None
+        self._publisher = None
+
+    @property
+    def finished(self):
+        return self.state in ("done", "error", "cancelled")
+
+    def update(self, **fields):
+        progress_only = fields.keys() <= {"state", "progress", "message"} and fields.get("state", self.state) == self.state
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.version += 1
+        # Wake everyone waiting on the current event and start a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+        self._publish(progress_only)
+
+    def _publish(self, progress_only=False):
+        if self.store is None:
+            return
+        now = time.monotonic()
+        if progress_only and now - self._published_at < JOB_PUBLISH_SECONDS:
+            return
+        self._published_at = now
+        # Written off the event loop by one task per job, so snapshots land in order and a
+        # burst of changes while one is being written collapses into the next write
+        self._unpublished = (json.dumps(self.key), self.state, json.dumps(self.to_dict()), self.version, self.finished_at)
+        if self._publisher is None:
+            self._publisher = asyncio.create_task(self._write_snapshots())
+
+    async def _write_snapshots(self):
+        try:
+            while self._unpublished is not None:
+                snapshot, self._unpublished = self._unpublished, None
+                try:
+                    await asyncio.to_thread(self.store.save, self.id, *snapshot)
+                except Exception as e:
+                    # Other workers just see an older snapshot; this worker's clients are unaffected
+                    log.warning("Failed to publish quote job snapshot: %s", e, extra={"job": self.id})
+        finally:
+            self._publisher = None
+
+    def report_progress(self, percent, message):
+        self.update(state="slicing", progress=max(self.progress, percent), message=message)
+
+    def report_provisional(self, quote):
+        self.update(provisional=quote)
+
+    async def wait_for_change(self, version, timeout):
+        if self.version != version:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "progress": self.progress,
+            "message": self.message,
+            "provisional": self.provisional,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobStore:
+    """
+    Quote jobs in SQLite, shared by every worker process: the latest snapshot of
+    each job, the sessions watching it, and the quote each browser session is on.
+    """
+
+    def __init__(self, path=QUOTE_JOB_DB_PATH):
+        self.db = Database(path)
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    snapshot TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finished_at REAL,
+                    key TEXT,
+                    state TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+            # session is "" for clients without one, which keep a job alive until it finishes
+            conn.execute("CREATE TABLE IF NOT EXISTS watchers (job_id TEXT NOT NULL, session TEXT NOT NULL, PRIMARY KEY (job_id, session))")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, owner TEXT NOT NULL, claimed_at REAL NOT NULL)")
+
+    def save(self, job_id, key, state, snapshot, version, finished_at):
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, snapshot, version, updated_at, finished_at, key, state) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, snapshot, version, time.time(), finished_at, key, state),
+            )
+
+    def get(self, job_id):
+        with self.db.read() as conn:
+            row = conn.execute("SELECT snapshot, version FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def find(self, key, ttl):
+        """(id, snapshot, version) of the newest running or retained job for `key`, or None."""
+        cutoff = time.time() - ttl
+        with self.db.read() as conn:
+            row = conn.execute(
+                """
+                SELECT id, snapshot, version FROM jobs
+                WHERE key = ? AND state NOT IN ('error', 'cancelled') AND COALESCE(finished_at, updated_at) > ?
+                ORDER BY updated_at DESC LIMIT 1
+                """,
+                (json.dumps(key), cutoff),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def watch(self, job_id, session):
+        with self.db.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO watchers VALUES (?, ?)", (job_id, session or ""))
+
+    def unwatch(self, job_id, session):
+        """Drop a watcher; returns how many the job has left."""
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM watchers WHERE job_id = ? AND session = ?", (job_id, session or ""))
+            return conn.execute("SELECT COUNT(*) FROM watchers WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def unwatched(self, job_ids):
+        """Those of `job_ids` nobody watches any more."""
+        with self.db.read() as conn:
+            watched = {row[0] for row in conn.execute(
+                f"SELECT DISTINCT job_id FROM watchers WHERE job_id IN ({','.join('?' * len(job_ids))})", job_ids
+            )}
+        return [job_id for job_id in job_ids if job_id not in watched]
+
+    def claim_session(self, session, owner, claimed_at):
+        # A claim that lost a race with a newer one doesn't overwrite it
+        with self.db.transaction() as conn:
+            conn.execute(
+                """
+                INSERT INTO sessions VALUES (?, ?, ?)
+                ON CONFLICT (session) DO UPDATE SET owner = excluded.owner, claimed_at = excluded.claimed_at
+                WHERE excluded.claimed_at >= sessions.claimed_at
+                """,
+                (session, owner, claimed_at),
+            )
+
+    def session_owners(self, sessions):
+        """session -> (owner, claimed_at) for those of `sessions` that were claimed."""
+        with self.db.read() as conn:
+            rows = conn.execute(
+                f"SELECT session, owner, claimed_at FROM sessions WHERE session IN ({','.join('?' * len(sessions))})", sessions
+            ).fetchall()
+        return {session: (owner, claimed_at) for session, owner, claimed_at in rows}
+
+    def prune(self, ttl):
+        # Unfinished jobs that stopped updating belonged to a worker that went away
+        cutoff = time.time() - ttl
+        with self.db.transaction() as conn:
+            removed = conn.execute(
+                "DELETE FROM jobs WHERE finished_at < ? OR (finished_at IS NULL AND updated_at < ?)", (cutoff, cutoff)
+            ).rowcount
+            conn.execute("DELETE FROM watchers WHERE job_id NOT IN (SELECT id FROM jobs)")
+            conn.execute("DELETE FROM sessions WHERE claimed_at < ?", (cutoff,))
+        return removed
+
+
+class SharedJob:
+    """
+    A job running in another worker process, seen through its snapshot. Offers the
+    parts of QuoteJob that status requests use, polling for changes instead of waiting on an event.
+    """
+
+    def __init__(self, job_id, store, snapshot, version):
+        self.id = job_id
+        self.store = store
+        self._snapshot = snapshot
+        self.version = version
+
+    @property
+    def state(self):
+        return self._snapshot["state"]
+
+    @property
+    def finished(self):
+        return self.state in ("done", "error", "cancelled")
+
+    async def wait_for_change(self, version, timeout):
+        deadline = time.monotonic() + timeout
+        while self.version == version and time.monotonic() < deadline:
+            await asyncio.sleep(JOB_PUBLISH_SECONDS)
+            found = await asyncio.to_thread(self.store.get, self.id)
+            if found is not None:
+                self._snapshot, self.version = found
+
+    def to_dict(self):
+        return self._snapshot
+
+
+class SessionTracker:
+    """
+    The current quote request of each browser session. Claiming a session for a
+    new request calls the cancel function of the request it replaces, so a
+    customer who changes settings mid-slice doesn't leave the old slice running.
+    Claims are also recorded in the job store; a request superseded from another
+    worker process is cancelled once this one polls and sees the newer claim.
+    """
+
+    def __init__(self, store=None, ttl=QUOTE_JOB_TTL):
+        self.store = store
+        self.ttl = ttl
+        self._current = {}  # session -> (owner, cancel, claim id, claimed_at)
+        self._monitor = None
+
+    async def claim(self, session, owner, cancel):
+        if not session:
+            return
+        claim_id, claimed_at = uuid.uuid4().hex, time.time()
+        previous = self._current.get(session)
+        self._current[session] = (owner, cancel, claim_id, claimed_at)
+        if previous is not None and previous[0] != owner:
+            previous[1]()
+        if self.store is None:
+            return
+        await asyncio.to_thread(self.store.claim_session, session, claim_id, claimed_at)
+        if self._monitor is None:
+            self._monitor = asyncio.create_task(self._watch())
+
+    def release(self, session, owner):
+        # The shared claim is left for the next one to overwrite; only this worker polls for it
+        if session and self._current.get(session, (None,))[0] == owner:
+            del self._current[session]
+
+    async def _watch(self):
+        try:
+            while self._current:
+                await asyncio.sleep(JOB_PUBLISH_SECONDS)
+                try:
+                    await self._check()
+                except Exception:
+                    log.exception("Failed to check quote sessions")
+        finally:
+            self._monitor = None
+
+    async def _check(self):
+        claims = dict(self._current)
+        owners = await asyncio.to_thread(self.store.session_owners, list(claims))
+        expired = time.time() - self.ttl
+        for session, (owner, cancel, claim_id, claimed_at) in claims.items():
+            shared = owners.get(session)
+            superseded = shared is not None and shared[0] != claim_id and shared[1] >= claimed_at
+            if (superseded or claimed_at < expired) and self._current.get(session, (None,))[2] == claim_id:
+                del self._current[session]
+                if superseded:
+                    cancel()
+
+
+class JobManager:
+    """
+    Registry of quote jobs, de-duplicated by quote key while in flight or retained.
+    Jobs run in the worker that submitted them; through the store, other workers
+    find them, watch them and stop watching them.
+    """
+
+    def __init__(self, store, sessions, ttl=QUOTE_JOB_TTL):
+        self.ttl = ttl
+        self.jobs = {}
+        self._by_key = {}
+        self._tasks = set()
+        self.store = store
+        self.sessions = sessions
+        self._monitor = None
+
+    async def find(self, key):
+        """The running or retained job for an identical request, in any worker, if there is one."""
+        self.prune()
+        job = self.jobs.get(self._by_key.get(key))
+        if job is not None and job.state not in ("error", "cancelled"):
+            return job
+        found = await asyncio.to_thread(self.store.find, key, self.ttl)
+        if found is not None:
+            return SharedJob(found[0], self.store, *found[1:])
+        return None
+
+    def submit(self, key, run):
+        """Start `run(job)` as a background task and return its job."""
+        self.prune()
+        job = QuoteJob(key)
+        job.store = self.store
+        job._publish()
+        self.jobs[job.id] = job
+        self._by_key[key] = job.id
+        job.task = asyncio.create_task(self._run(job, run))
+        self._tasks.add(job.task)
+        job.task.add_done_callback(self._tasks.discard)
+        if self._monitor is None:
+            self._monitor = asyncio.create_task(self._watch())
+        return job
+
+    async def watch(self, job, session=None):
+        """
+        Record that a client wants this job's result. A job only watched by sessions
+        is cancelled once every one of them, in whichever worker, has moved on to another quote.
+        """
+        local = self.jobs.get(job.id)
+        if local is not None:
+            local.watchers.add(session)
+        await asyncio.to_thread(self.store.watch, job.id, session)
+        if local is not None:
+            local.watched = True
+        await self.sessions.claim(session, job.id, lambda: self._unwatch(job.id, session))
+
+    def _unwatch(self, job_id, session):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.watchers.discard(session)
+        task = asyncio.create_task(self._drop_watcher(job_id, session))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drop_watcher(self, job_id, session):
+        left = await asyncio.to_thread(self.store.unwatch, job_id, session)
+        job = self.jobs.get(job_id)
+        # A job of another worker is cancelled there, once it sees nobody is left
+        if not left and job is not None and not job.finished:
+            job.task.cancel()
+
+    async def _watch(self):
+        try:
+            while running := [job for job in self.jobs.values() if not job.finished]:
+                await asyncio.sleep(JOB_PUBLISH_SECONDS)
+                watched = [job.id for job in running if job.watched and not job.finished]
+                if not watched:
+                    continue
+                try:
+                    unwatched = await asyncio.to_thread(self.store.unwatched, watched)
+                except Exception:
+                    log.exception("Failed to check quote job watchers")
+                    continue
+                for job_id in unwatched:
+                    job = self.jobs.get(job_id)
+                    if job is not None and not job.finished:
+                        job.task.cancel()
+        finally:
+            self._monitor = None
+
+    async def _run(self, job, run):
+        # Jobs outlive the request that submitted them, so they're timed on their own
+        with metrics.tracing("quote-job") as trace:
+            trace.fields["job"] = job.id
+            await self._run_traced(job, run)
+
+    async def _run_traced(self, job, run):
+        try:
+            result = await run(job)
+            job.update(state="done", progress=100, message="Done", result=result, finished_at=time.time())
+        except asyncio.CancelledError:
+            job.update(state="cancelled", message="Cancelled", finished_at=time.time())
+        except QuoteError as e:
+            job.update(state="error", message="Failed", error=e.content, status_code=e.status_code, finished_at=time.time())
+        except Exception as e:
+            log.exception("Quote job failed", extra={"job": job.id})
+            job.update(state="error", message="Failed", error={"error": f"Unexpected error: {str(e)}"}, status_code=500, finished_at=time.time())
+        finally:
+            for session in job.watchers:
+                self.sessions.release(session, job.id)
+
+    async def get(self, job_id):
+        """The job, or a view of its snapshot when another worker process is running it."""
+        self.prune()
+        job = self.jobs.get(job_id)
+        if job is None:
+            found = await asyncio.to_thread(self.store.get, job_id)
+            if found is not None:
+                job = SharedJob(job_id, self.store, *found)
+        return job
+
+    def prune(self):
+        cutoff = time.time() - self.ttl
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                del self.jobs[job_id]
+                if self._by_key.get(job.key) == job_id:
+                    del self._by_key[job.key]
+
+    def prune_store(self):
+        return self.store.prune(self.ttl)
+
+
+job_store = JobStore()
+quote_sessions = SessionTracker(job_store)
+job_manager = JobManager(job_store, quote_sessions)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from db import Database
+
+# Work one uvicorn worker is doing on behalf of all of them (a slice, a cache warm-up)
+LEASE_PATH = Path(os.getenv("LEASE_PATH", "cache/leases.sqlite3"))
+
+log = logging.getLogger(__name__)
+
+
+class Leases:
+    """
+    Named, expiring locks in SQLite, shared by every worker process of a
+    deployment. acquire() hands out a token to one caller at a time per key;
+    the holder renews it while working (see held()), so a worker that dies
+    mid-job only blocks its key until the lease runs out.
+    """
+
+    def __init__(self, path=LEASE_PATH):
+        self.db = Database(path)
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    key TEXT PRIMARY KEY,
+                    token TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+        self.acquired = 0
+        self.contended = 0  # acquire() calls that found the key taken
+        self.expired = 0  # leases taken over from a holder that stopped renewing
+
+    def acquire(self, key, ttl):
+        """A token if the caller now holds `key` for `ttl` seconds, else None."""
+        now = time.time()
+        token = secrets.token_hex(8)
+        with self.db.transaction() as conn:
+            row = conn.execute("SELECT expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] > now:
+                self.contended += 1
+                return None
+            conn.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)", (key, token, os.getpid(), now + ttl))
+        self.acquired += 1
+        if row is not None:
+            self.expired += 1
+        return token
+
+    def renew(self, key, token, ttl):
+        """Extend a lease; False when it was lost meanwhile (it expired and someone else took it)."""
+        with self.db.transaction() as conn:
+            return conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE key = ? AND token = ?", (time.time() + ttl, key, token)
+            ).rowcount > 0
+
+    def release(self, key, token):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE key = ? AND token = ?", (key, token))
+
+    @asynccontextmanager
+    async def held(self, key, token, ttl):
+        """Keep renewing an acquired lease for as long as the block runs, and release it afterwards."""
+
+        async def renew():
+            while True:
+                await asyncio.sleep(ttl / 3)
+                if not await asyncio.to_thread(self.renew, key, token, ttl):
+                    log.warning("Lost a lease while holding it", extra={"key": key})
+                    return
+
+        renewer = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            await asyncio.to_thread(self.release, key, token)
+
+    def sweep(self):
+        with self.db.transaction() as conn:
+            return conn.execute("DELETE FROM leases WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def stats(self):
+        with self.db.read() as conn:
+            held = conn.execute("SELECT COUNT(*) FROM leases WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        return {"held": held, "acquired": self.acquired, "contended": self.contended, "expired": self.expired}
+
+
+leases = Leases()
@@ -1,20 +1,104 @@
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, Form, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, Form, File, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 import tempfile
+import logging
 import os
+import shutil
 import uuid
 from fastapi.middleware.cors import CORSMiddleware
 import re
+import json
+import asyncio
+import httpx
+from contextlib import asynccontextmanager
 
-from helpers import get_shopify_price, create_customer_product
-from slicer import slice_model 
+from logs import configure_logging
+configure_logging()
 
-app = FastAPI(debug=True)
+import metrics
+from helpers import (
+    create_customer_product, make_product_handle, ShopifyUserError, open_shopify_client, close_shopify_client,
+    material_cache, warm_material_cache, verify_webhook, invalidate_material
+)
+from quote_cache import quote_cache
+from shopify_limits import shopify_scheduler
+from slice_pool import slice_pool
+from quotes import (
+    QuoteError, quote_key, quote_model, quote_options, quote_batch, inspect_model, stage_quote, resolve_backend, archive_saved_model,
+    lookup_price
+)
+from artifacts import artifact_store, byte_range, RangeNotSatisfiable
+from images import shrink_screenshot, cached_thumbnail, save_thumbnail
+from slicer import backend_stats, warm_backends, close_backends
+from cluster import use_slice_workers
+from staging import staging
+from blobstore import blob_store, model_manifest
+from jobs import job_manager, quote_sessions
+from leases import leases
+from outbox import outbox, PermanentFailure
+from uploads import (
+    save_upload, save_batch, safe_filename, UploadTooLarge, RequestSizeLimit, MAX_SCREENSHOT_BYTES, MAX_REQUEST_BYTES,
+    MAX_BATCH_REQUEST_BYTES
+)
+
+log = logging.getLogger("main")
 
-# Create uploads directory for persistent file storage
-UPLOADS_DIR = Path("uploads")
-UPLOADS_DIR.mkdir(exist_ok=True)
+# With SLICE_WORKERS set, quotes are sliced on those nodes rather than here
+use_slice_workers()
+
+@asynccontextmanager
+async def lifespan(app):
+    # One Shopify connection pool for the lifetime of the worker
+    await open_shopify_client()
+    warmup = asyncio.create_task(warm_material_cache())
+    warmup.add_done_callback(_log_warmup_failure)
+    sweeper = asyncio.create_task(sweep_staging())
+    order_workers = outbox.start(create_order_product)
+    slicers = asyncio.create_task(warm_backends())
+    yield
+    warmup.cancel()
+    slicers.cancel()
+    sweeper.cancel()
+    for worker in order_workers:
+        worker.cancel()
+    await asyncio.gather(*order_workers, return_exceptions=True)
+    await close_backends()
+    await close_shopify_client()
+    await asyncio.to_thread(quote_cache.flush)
+
+def _log_warmup_failure(task):
+    # Startup shouldn't fail because Shopify is unreachable; quotes fetch prices on demand
+    if not task.cancelled() and task.exception():
+        log.warning("Failed to warm material cache: %s", task.exception())
+
+async def sweep_staging():
+    # Expire quoted uploads that never turned into an order. Every worker runs this loop, but the
+    # lease is left to expire rather than released, so only one of them sweeps per period
+    while True:
+        try:
+            if await asyncio.to_thread(leases.acquire, "sweep:staging", STAGING_SWEEP_SECONDS - 1) is None:
+                await asyncio.sleep(STAGING_SWEEP_SECONDS)
+                continue
+            removed = await asyncio.to_thread(staging.sweep)
+            if removed:
+                log.info("Removed expired staged uploads", extra={"removed": removed})
+            removed = await asyncio.to_thread(artifact_store.sweep)
+            if removed:
+                log.info("Removed G-code of unsaved quotes", extra={"removed": removed})
+            await asyncio.to_thread(job_manager.prune_store)
+            await asyncio.to_thread(leases.sweep)
+        except Exception as e:
+            log.error("Failed to sweep staging area: %s", e)
+        await asyncio.sleep(STAGING_SWEEP_SECONDS)
+
+app = FastAPI(debug=True, lifespan=lifespan)
+
+SSE_KEEPALIVE_SECONDS = 15
+# How often a waiting quote request checks whether its client is still there
+DISCONNECT_POLL_SECONDS = 1
+MAX_QUOTE_OPTIONS = 24
+STAGING_SWEEP_SECONDS = 15 * 60
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,187 +108,577 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Reject oversized uploads from the Content-Length header before the body is read.
+# A plain ASGI middleware, unlike @app.middleware("http"), lets endpoints see client disconnects
+app.add_middleware(RequestSizeLimit, max_bytes=MAX_REQUEST_BYTES, limits={"/api/get-batch-quote": MAX_BATCH_REQUEST_BYTES})
+# Added last so it is outermost and times everything, rejected uploads included
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.register_stats(
+    "slice_pool", slice_pool.stats,
+    counters=("completed", "failed", "rejected", "cancelled", "abandoned", "timed_out", "reordered"),
+)
+metrics.register_stats("leases", leases.stats, counters=("acquired", "contended", "expired"))
+
 @app.get("/api/ping")
 async def ping():
     return {"message": "pong"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    # Collecting reads the lease table and multiprocess files
+    body, content_type = await asyncio.to_thread(metrics.render)
+    return Response(body, media_type=content_type)
+
+@app.get("/api/cache-stats")
+async def cache_stats():
+    quotes, materials, gcode = await asyncio.gather(
+        asyncio.to_thread(quote_cache.stats), asyncio.to_thread(material_cache.stats), asyncio.to_thread(artifact_store.stats)
+    )
+    return {"quotes": quotes, "materials": materials, "gcode": gcode}
+
+@app.get("/api/shopify-stats")
+async def shopify_stats():
+    return shopify_scheduler.stats()
+
+@app.get("/api/slicer-stats")
+async def slicer_stats():
+    return {**slice_pool.stats(), "backends": backend_stats()}
+
+@app.get("/api/slicer-queue")
+async def slicer_queue():
+    """The slicing queue in scheduling order, and the latest scheduling decisions with estimated and actual run times."""
+    return {"queue": slice_pool.queue(), "recent": list(slice_pool.decisions)}
+
+@app.post("/api/webhooks/shopify/products-update")
+async def shopify_product_webhook(request: Request):
+    """Shopify products/update webhook: forget cached prices and densities for the product."""
+    body = await request.body()
+    if not verify_webhook(body, request.headers.get("X-Shopify-Hmac-Sha256")):
+        return JSONResponse(status_code=401, content={"error": "Invalid webhook signature"})
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        return JSONResponse(status_code=400, content={"error": "Webhook body is not a JSON object"})
+    invalidated = await asyncio.to_thread(invalidate_material, payload)
+    log.info("Invalidated material cache entries", extra={"invalidated": invalidated})
+    return {"invalidated": invalidated}
+
+def client_id(request, email=None):
+    """
+    Who a quote is for, so the slicing queue can share workers fairly: the
+    customer's email when given, else their IP (uvicorn's --proxy-headers
+    puts the real one in request.client behind the reverse proxy).
+    """
+    if email and email.strip():
+        return email.strip().lower()
+    return request.client.host if request.client else None
+
+async def run_cancellable(request, coro, session=None):
+    """
+    Await `coro` as a task that is cancelled (killing its slicer) when the client
+    disconnects or the same session starts another quote; both raise a QuoteError.
+    """
+    task = asyncio.ensure_future(coro)
+    await quote_sessions.claim(session, task, task.cancel)
+    disconnected = False
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if not task.done() and await request.is_disconnected():
+                disconnected = True
+                task.cancel()
+                await asyncio.wait({task})
+    finally:
+        quote_sessions.release(session, task)
+        task.cancel()
+    if task.cancelled():
+        if disconnected:
+            log.info("Client disconnected, cancelled its quote")
+            raise QuoteError(499, {"error": "Client closed the request"})
+        raise QuoteError(409, {"error": "Superseded by a newer quote request"})
+    return task.result()
+
 @app.post("/api/get-quote")
 async def get_quote(
+    request: Request,
     file: UploadFile = File(...),
     material: str = Form(...),
     variant: str = Form(...),
     infill: int = Form(...),
     layerHeight: float = Form(...),
-    nozzleSize: float = Form(0.4)  # optional if you want to support different detail levels
+    nozzleSize: float = Form(0.4),  # optional if you want to support different detail levels
+    session: str = Form(None),  # a newer quote from the same session cancels this one
+    backend: str = Form(None),  # "prusa" or "kiri"; overrides the policy below
+    preview: bool = Form(False),  # a quick, non-orderable quote from the preview backend
+    email: str = Form(None)  # optional at quote time; shares the slicers fairly between customers
 ):
-    print(layerHeight, nozzleSize)
-    filename = file.filename
+    metrics.annotate(material=material, variant=variant)
+    with tempfile.TemporaryDirectory() as tempdir:
+        try:
+            slicer = resolve_backend(backend, preview)
+            with metrics.span("upload"):
+                model = await save_upload(file, os.path.join(tempdir, safe_filename(file.filename)))
+            quote = await run_cancellable(
+                request,
+                quote_model(model, material, variant, infill, layerHeight, nozzleSize, backend=slicer, client=client_id(request, email)),
+                session
+            )
+            with metrics.span("stage_quote"):
+                quote["quote_token"] = await stage_quote(model, quote)
+        except UploadTooLarge as e:
+            return JSONResponse(status_code=413, content={"error": str(e)})
+        except QuoteError as e:
+            return JSONResponse(status_code=e.status_code, content=e.content, headers=e.headers)
+    return JSONResponse(quote)
 
-    # Get price per gram and density from Shopify before slicing
+@app.post("/api/get-quotes")
+async def get_quotes(
+    request: Request,
+    file: UploadFile = File(...),
+    options: str = Form(...),
+    backend: str = Form(None),
+    preview: bool = Form(False),
+    email: str = Form(None)
+):
+    """
+    Quote one upload under several parameter combinations. `options` is a JSON
+    list of {infill, layerHeight, nozzleSize, material, variant}; results are
+    streamed back as NDJSON lines, each tagged with the option's index. Its
+    slices queue behind single quotes.
+    """
     try:
-        price_per_gram, density = await get_shopify_price(material, variant if variant.startswith("gid://shopify/ProductVariant/") else None)
-        print(f"Price per gram for {material} (variant {variant}): {price_per_gram}, density: {density}")
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return JSONResponse(status_code=500, content={"error": f"Shopify error: {str(e)}"})
+        options = parse_quote_options(options)
+        slicer = resolve_backend(backend, preview)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except QuoteError as e:
+        return JSONResponse(status_code=e.status_code, content=e.content)
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        stl_path = os.path.join(tempdir, filename)
+    # The response streams after this handler returns, so the generator owns the upload
+    tempdir = tempfile.mkdtemp()
+    try:
+        with metrics.span("upload"):
+            model = await save_upload(file, os.path.join(tempdir, safe_filename(file.filename)))
+        await inspect_model(model)
+    except UploadTooLarge as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except QuoteError as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return JSONResponse(status_code=e.status_code, content=e.content, headers=e.headers)
 
-        # Save uploaded STL to temp file
-        with open(stl_path, "wb") as f:
-            f.write(await file.read())
+    async def results():
+        try:
+            async for result in quote_options(model, options, slicer, client=client_id(request, email)):
+                yield json.dumps(result) + "\n"
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
 
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+def parse_quote_options(raw):
+    try:
+        options = json.loads(raw)
+    except json.JSONDecodeError:
+        raise ValueError("options must be a JSON list")
+    if not isinstance(options, list) or not options:
+        raise ValueError("options must be a non-empty JSON list")
+    if len(options) > MAX_QUOTE_OPTIONS:
+        raise ValueError(f"At most {MAX_QUOTE_OPTIONS} options can be quoted at once")
+    parsed = []
+    for option in options:
         try:
-            print("Slicing model...")
-            grams = slice_model(stl_path, infill_density=infill, layer_height=layerHeight, nozzle_diameter=max(nozzleSize, 0.4), filament_density=density)
-            print("Done slicing model.")
-        except RuntimeError as e:
-            import traceback
-            traceback.print_exc()
-            error_msg = str(e)
-            # Check if it's a model loading error
-            if "Loading of a model file failed" in error_msg or "Slicer error" in error_msg:
-                return JSONResponse(
-                    status_code=400, 
-                    content={
-                        "error": "Invalid model file. Please ensure your STL file is valid and not corrupted.",
-                        "details": "The uploaded file could not be processed. Try re-exporting your model or using a different file format."
-                    }
-                )
-            else:
-                # Other runtime errors still return 500
-                return JSONResponse(status_code=500, content={"error": f"Processing error: {error_msg}"})
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return JSONResponse(status_code=500, content={"error": f"Unexpected error: {str(e)}"})
-
-        estimated_price = round(round(grams) * price_per_gram, 2)
-
-        if float(layerHeight) <= 0.08:
-            estimated_price *= 1.2
-
-        if float(nozzleSize) < 0.4:
-            estimated_price *= 1.2
-
-        return JSONResponse({
-            "file": filename,
-            "grams": round(grams, 2),
-            "price": estimated_price,
-            "material": material,
-            "infill": infill,
-            "layerHeight": layerHeight,
-            "nozzleSize": nozzleSize,
-            "price_per_gram": price_per_gram,
-            "density": density
-        })
+            parsed.append({
+                "material": str(option["material"]),
+                "variant": str(option.get("variant") or ""),
+                "infill": int(option["infill"]),
+                "layerHeight": float(option["layerHeight"]),
+                "nozzleSize": float(option.get("nozzleSize", 0.4)),
+            })
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each option needs material, infill and layerHeight (variant and nozzleSize are optional)")
+    return parsed
 
-@app.post("/api/save-model")
-async def save_model(
+@app.post("/api/get-batch-quote")
+async def get_batch_quote(
+    request: Request,
+    files: list[UploadFile] = File(...),  # model files and/or ZIP archives of them
+    material: str = Form(...),
+    variant: str = Form(...),
+    infill: int = Form(...),
+    layerHeight: float = Form(...),
+    nozzleSize: float = Form(0.4),
+    backend: str = Form(None),
+    email: str = Form(None)
+):
+    """
+    Quote every part of an assembly with the same settings. Results stream back
+    as NDJSON: one line per distinct part (identical files are quoted once, with
+    their count) carrying the running total, then {"done": true, "total": ...}.
+    Its slices queue behind single quotes.
+    """
+    try:
+        slicer = resolve_backend(backend)
+    except QuoteError as e:
+        return JSONResponse(status_code=e.status_code, content=e.content)
+
+    # The response streams after this handler returns, so the generator owns the uploads
+    tempdir = tempfile.mkdtemp()
+    try:
+        with metrics.span("upload"):
+            models = await save_batch(files, tempdir)
+        metrics.annotate(material=material, variant=variant, batch_files=len(models))
+        price = await lookup_price(material, variant)
+    except UploadTooLarge as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except ValueError as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except QuoteError as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return JSONResponse(status_code=e.status_code, content=e.content, headers=e.headers)
+
+    async def results():
+        try:
+            async for result in quote_batch(
+                models, material, variant, infill, layerHeight, nozzleSize, price, slicer, client=client_id(request, email)
+            ):
+                yield json.dumps(result) + "\n"
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.post("/api/quote-jobs", status_code=202)
+async def submit_quote_job(
+    request: Request,
     file: UploadFile = File(...),
-    screenshot: UploadFile = File(None),  # Optional screenshot
     material: str = Form(...),
     variant: str = Form(...),
     infill: int = Form(...),
     layerHeight: float = Form(...),
-    nozzleSize: float = Form(...),
+    nozzleSize: float = Form(0.4),
+    session: str = Form(None),
+    backend: str = Form(None),
+    preview: bool = Form(False),
+    email: str = Form(None)
+):
+    """
+    Start a quote in the background and return its job id right away. With a
+    `session`, submitting another quote from the same session cancels this one
+    unless other clients are waiting for it too.
+    """
+    try:
+        slicer = resolve_backend(backend, preview)
+    except QuoteError as e:
+        return JSONResponse(status_code=e.status_code, content=e.content)
+    # The job outlives this request, so it owns the upload's directory
+    tempdir = tempfile.mkdtemp()
+    try:
+        with metrics.span("upload"):
+            model = await save_upload(file, os.path.join(tempdir, safe_filename(file.filename)))
+    except UploadTooLarge as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    key = (quote_key(model.digest, infill, layerHeight, nozzleSize, slicer), material, variant)
+
+    job = await job_manager.find(key)
+    if job is not None:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    else:
+        client = client_id(request, email)
+
+        async def run(job):
+            try:
+                quote = await quote_model(
+                    model, material, variant, infill, layerHeight, nozzleSize,
+                    on_progress=job.report_progress, on_provisional=job.report_provisional, backend=slicer, client=client
+                )
+                quote["quote_token"] = await stage_quote(model, quote)
+                return quote
+            finally:
+                shutil.rmtree(tempdir, ignore_errors=True)
+
+        job = job_manager.submit(key, run)
+    await job_manager.watch(job, session)
+    return {
+        "job_id": job.id,
+        "status_url": f"/api/quote-jobs/{job.id}",
+        "events_url": f"/api/quote-jobs/{job.id}/events",
+    }
+
+@app.get("/api/quote-jobs/{job_id}")
+async def get_quote_job(job_id: str):
+    job = await job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired quote job"})
+    return job.to_dict()
+
+@app.get("/api/quote-jobs/{job_id}/events")
+async def stream_quote_job(job_id: str):
+    """Server-sent events with the job's progress, ending with a `done` or `error` event."""
+    job = await job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired quote job"})
+
+    async def events():
+        version = None
+        while True:
+            if version != job.version:
+                version = job.version
+                event = job.state if job.finished else "progress"
+                yield f"event: {event}\ndata: {json.dumps(job.to_dict())}\n\n"
+                if job.finished:
+                    return
+            else:
+                # Keep proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+            await job.wait_for_change(version, SSE_KEEPALIVE_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/save-model")
+async def save_model(
+    file: UploadFile = File(None),  # not needed when a quote_token is given
+    screenshot: UploadFile = File(None),  # Optional screenshot
+    quote_token: str = Form(None),
+    material: str = Form(None),
+    variant: str = Form(None),
+    infill: int = Form(None),
+    layerHeight: float = Form(None),
+    nozzleSize: float = Form(None),
     name: str = Form(...),
     email: str = Form(...),
-    weight: float = Form(...),
-    price: float = Form(...),
+    weight: float = Form(None),
+    price: float = Form(None),
     complex: bool = Form(False)
 ):
-    print(name)
+    # With a quote token, reuse the quoted upload and trust only the server-computed quote
+    staged = None
+    if quote_token:
+        staged = await asyncio.to_thread(staging.get, quote_token)
+        if staged is None:
+            return JSONResponse(status_code=410, content={"error": "Your quote has expired. Please request a new quote."})
+        quote = staged.quote
+        material, variant = quote["material"], quote["variant"]
+        infill, layerHeight, nozzleSize = quote["infill"], quote["layerHeight"], quote["nozzleSize"]
+        weight, price = quote["grams"], quote["price"]
+        original_filename = staged.filename
+    elif file is None or None in (material, variant, infill, layerHeight, nozzleSize, weight, price):
+        return JSONResponse(status_code=400, content={"error": "Either a quote_token or the model file with its quote parameters is required."})
+    else:
+        original_filename = file.filename
+    # The G-code kept for printing is the quoting backend's; direct saves were quoted under the policy's
+    try:
+        slicer = resolve_backend(staged.quote.get("backend") if staged else None)
+    except QuoteError as e:
+        return JSONResponse(status_code=e.status_code, content=e.content, headers=e.headers)
+
     # Make the name safe for filesystem
     safe_name = re.sub(r'[^\w\-_\.]', '_', name.strip())
     if not safe_name:
         safe_name = uuid.uuid4().hex[:8]  # Generate a random name if empty
     
-    # Create email-based folder (sanitize email for filesystem safety)
+    # Customers are identified by their sanitised email in the model manifest
     safe_email = re.sub(r'[^\w\-_\.]', '_', email.strip().replace('@', '_at_'))
-    email_folder = UPLOADS_DIR / safe_email
-    email_folder.mkdir(exist_ok=True)
     
     # Get file extension from uploaded file
-    file_extension = Path(file.filename).suffix if file.filename else ".stl"
+    file_extension = Path(original_filename).suffix if original_filename else ".stl"
     # Add random string suffix to avoid overwriting existing files
     random_suffix = uuid.uuid4().hex[:8]
     safe_filename = f"{safe_name}_{random_suffix}{file_extension}"
-    stl_path = email_folder / safe_filename
 
-    # Save uploaded file to persistent storage
-    with open(stl_path, "wb") as f:
-        f.write(await file.read())
-
-    # Handle screenshot if provided (use temp directory)
+    # Keep the screenshot with the order until its product has been created
+    order_id = outbox.new_id()
     screenshot_path = None
-    if screenshot:
-        with tempfile.TemporaryDirectory() as temp_screenshot_dir:
-            screenshot_filename = f"{safe_name}_screenshot.png"
-            screenshot_path = os.path.join(temp_screenshot_dir, screenshot_filename)
-            with open(screenshot_path, "wb") as f:
-                f.write(await screenshot.read())
-            print(f"Screenshot saved temporarily as: {screenshot_filename}")
-
-            # Create product in Shopify with customer ownership metafields
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Both uploads are checked against their limits before anything is stored, so a 413 leaves nothing behind
+        if staged:
+            gcode_key = quote_key(staged.path.stem, infill, layerHeight, nozzleSize, backend=slicer)
+            model_path, model_digest = staged.path, None
+        else:
             try:
-                product_id, product_handle, variant_id = await create_customer_product(
-                    email=email,
-                    product_name=name,
-                    material=material,
-                    variant=variant,
-                    infill=infill,
-                    layer_height=layerHeight,
-                    nozzle_size=nozzleSize,
-                    filename=safe_filename,
-                    file_path=str(stl_path),
-                    weight=weight,
-                    price=price,
-                    screenshot_path=screenshot_path,
-                    complex=complex
-                )
-                print(f"Created product: {product_id} with handle: {product_handle}")
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                return JSONResponse(status_code=500, content={"error": f"Product creation error: {str(e)}"})
-    else:
-        # Create product without screenshot
-        try:
-            product_id, product_handle, variant_id = await create_customer_product(
-                email=email,
-                product_name=name,
-                material=material,
-                variant=variant,
-                infill=infill,
-                layer_height=layerHeight,
-                nozzle_size=nozzleSize,
-                filename=safe_filename,
-                file_path=str(stl_path),
-                weight=weight,
-                price=price,
-                screenshot_path=None
-            )
-            print(f"Created product: {product_id} with handle: {product_handle}")
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return JSONResponse(status_code=500, content={"error": f"Product creation error: {str(e)}"})
+                with metrics.span("upload"):
+                    model = await save_upload(file, os.path.join(tempdir, f"model{file_extension}"))
+            except UploadTooLarge as e:
+                return JSONResponse(status_code=413, content={"error": str(e)})
+            gcode_key = quote_key(model.digest, infill, layerHeight, nozzleSize, backend=slicer)
+            model_path, model_digest = model.path, model.digest
+        if screenshot:
+            upload_path = outbox.files_dir / f"{order_id}.upload"
+            try:
+                with metrics.span("screenshot"):
+                    await save_upload(screenshot, upload_path, max_bytes=MAX_SCREENSHOT_BYTES)
+                    # Browsers send full-resolution PNGs; Shopify gets a bounded WebP/JPEG instead
+                    screenshot_path = await asyncio.to_thread(shrink_screenshot, upload_path, outbox.files_dir / order_id)
+            except UploadTooLarge as e:
+                return JSONResponse(status_code=413, content={"error": str(e)})
+            if screenshot_path is None:
+                log.warning("Screenshot isn't an image, rendering one instead", extra={"order": order_id})
+
+        # Models are stored once per content hash; re-saves of the same model cost nothing. They are
+        # stored uncompressed here and compressed by the outbox worker, off the request path
+        with metrics.span("blob_store"):
+            digest, size = await asyncio.to_thread(blob_store.put, model_path, model_digest, compress=False)
+    metrics.annotate(digest=digest, size=size, material=material, infill=infill, layer_height=layerHeight, quote_token=bool(quote_token))
+    log.info("Model stored", extra={"saved_as": safe_filename, "digest": digest})
+
+    with metrics.span("manifest"):
+        model_id = await asyncio.to_thread(model_manifest.add, safe_email, name, safe_filename, digest, size, order_id, gcode_key=gcode_key)
+
+    # The product is created in Shopify by the outbox workers; the order row is
+    # the only thing that has to succeed here, otherwise nothing is left behind
+    params = {
+        "email": email,
+        "product_name": name,
+        "material": material,
+        "variant": variant,
+        "infill": infill,
+        "layer_height": layerHeight,
+        "nozzle_size": nozzleSize,
+        "filename": safe_filename,
+        "file_path": str(blob_store.find(digest)),
+        "weight": weight,
+        "price": price,
+        "screenshot_path": str(screenshot_path) if screenshot_path else None,
+        "complex": complex,
+        "digest": digest,
+    }
+    try:
+        with metrics.span("enqueue"):
+            await asyncio.to_thread(outbox.enqueue, params, order_id)
+    except Exception as e:
+        await asyncio.to_thread(model_manifest.remove, model_id)
+        if screenshot_path:
+            screenshot_path.unlink(missing_ok=True)
+        return JSONResponse(status_code=500, content={"error": f"Failed to save order: {str(e)}"})
 
-    return JSONResponse({
-        "message": "Model saved and product created successfully",
+    # The print farm downloads the G-code instead of slicing the order again
+    with metrics.span("gcode_archive"):
+        await archive_saved_model(gcode_key, digest, file_extension.lower(), infill, layerHeight, nozzleSize, email, backend=slicer)
+
+    return JSONResponse(status_code=202, content={
+        "message": "Model saved, product is being created",
+        "order_id": order_id,
+        "status": "pending",
         "saved_as": safe_filename,
-        "saved_path": str(stl_path),
-        "screenshot_provided": screenshot is not None,
+        "digest": digest,
+        "screenshot_provided": screenshot_path is not None,
         "name": name,
         "email": email,
-        "product_id": product_id,
-        "variant_id": variant_id,
-        "product_handle": product_handle,
         "material": material,
         "infill": infill,
         "layerHeight": layerHeight,
         "nozzleSize": nozzleSize,
-    })
\ No newline at end of file
+        "weight": weight,
+        "price": price,
+    })
+
+@app.get("/api/orders/{order_id}")
+async def get_order(order_id: str):
+    order = await asyncio.to_thread(outbox.get, order_id)
+    if order is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown order"})
+    artifact = await asyncio.to_thread(order_gcode, order_id)
+    order["gcode"] = {
+        "url": f"/api/orders/{order_id}/gcode",
+        "size": artifact["size"],
+        "stats": artifact["stats"],
+    } if artifact else None
+    return order
+
+def order_gcode(order_id):
+    """The archived G-code of an order's model, with the saved filename, or None."""
+    model = model_manifest.for_order(order_id)
+    if model is None or not model["gcode_key"]:
+        return None
+    artifact = artifact_store.get(model["gcode_key"])
+    return {**artifact, "filename": model["filename"]} if artifact else None
+
+@app.get("/api/orders/{order_id}/gcode")
+async def get_order_gcode(order_id: str, request: Request):
+    """
+    The order's sliced G-code, decompressed as it streams. Single byte ranges
+    are supported, so the print farm can resume or fetch just the footer.
+    """
+    artifact = await asyncio.to_thread(order_gcode, order_id)
+    if artifact is None:
+        return JSONResponse(status_code=404, content={"error": "No G-code archived for this order"})
+    size = artifact["size"]
+    etag = f'"{artifact["digest"]}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{Path(artifact["filename"]).stem}.gcode"',
+    }
+    range_header = request.headers.get("range")
+    if request.headers.get("if-range", etag) != etag:
+        # The file changed since the client's partial download; send all of it
+        range_header = None
+    try:
+        requested = byte_range(range_header, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    if requested is None:
+        return StreamingResponse(
+            artifact_store.read(artifact["digest"]), media_type="text/x-gcode", headers={**headers, "Content-Length": str(size)}
+        )
+    start, end = requested
+    return StreamingResponse(
+        artifact_store.read(artifact["digest"], start, end), status_code=206, media_type="text/x-gcode",
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)},
+    )
+
+def model_thumbnail(digest):
+    """The rendered thumbnail of a stored STL, from the cache or rendered now (blocking)."""
+    path = cached_thumbnail(digest)
+    if path is None:
+        with blob_store.materialized(digest, ".stl") as stl_path:
+            path = save_thumbnail(digest, stl_path)
+    return path
+
+async def order_image(params):
+    """The customer's screenshot, else a thumbnail rendered from the STL, so every product has an image."""
+    if params["screenshot_path"]:
+        return params["screenshot_path"]
+    # Orders queued before thumbnails existed carry no digest
+    if not params.get("digest") or Path(params["filename"]).suffix.lower() != ".stl":
+        return None
+    try:
+        with metrics.span("thumbnail"):
+            return str(await asyncio.to_thread(model_thumbnail, params["digest"]))
+    except Exception as e:
+        log.warning("Couldn't render a thumbnail: %s", e, extra={"digest": params["digest"]})
+        return None
+
+async def create_order_product(order_id, params):
+    # The handle is derived from the order id so a retried order updates its product instead of duplicating it
+    handle = make_product_handle(params["product_name"], params["email"], order_id[:8])
+    product = {key: value for key, value in params.items() if key != "digest"}
+    try:
+        with metrics.tracing("outbox") as trace:
+            trace.fields["order"] = order_id
+            product["screenshot_path"] = await order_image(params)
+            with metrics.span("create_product"):
+                product_id, product_handle, variant_id = await create_customer_product(**product, handle=handle)
+    except ShopifyUserError as e:
+        raise PermanentFailure(str(e))
+    except httpx.HTTPStatusError as e:
+        if 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+            raise PermanentFailure(str(e))
+        raise
+    log.info("Created product for order", extra={"order": order_id, "product": product_id, "handle": product_handle})
+    if params["screenshot_path"]:
+        Path(params["screenshot_path"]).unlink(missing_ok=True)
+    if params.get("digest"):
+        try:
+            with metrics.span("compress_model"):
+                await asyncio.to_thread(blob_store.compress, params["digest"])
+        except OSError as e:
+            # The product exists; the model stays uncompressed, which only costs disk
+            log.warning("Couldn't compress the saved model: %s", e, extra={"order": order_id, "digest": params["digest"]})
+    return {"product_id": product_id, "product_handle": product_handle, "variant_id": variant_id}
\ No newline at end of file
@@ -0,0 +1,273 @@
+import os
+import re
+
+import numpy as np
+
+from slicer import filament_length_for_volume
+
+# Binary STL: 80-byte header, uint32 triangle count, then 50 bytes per triangle
+STL_HEADER_SIZE = 84
+STL_TRIANGLE_DTYPE = np.dtype([
+    ("normal", "<f4", (3,)),
+    ("vertices", "<f4", (3, 3)),
+    ("attributes", "<u2"),
+])
+# Triangles processed per block, which bounds temporary float64 memory
+CHUNK_TRIANGLES = 1_000_000
+# Edge-sharing check needs the whole mesh in memory at once; skip it for huge scans
+MANIFOLD_CHECK_MAX_TRIANGLES = int(os.getenv("MANIFOLD_CHECK_MAX_TRIANGLES", "3000000"))
+DEGENERATE_AREA_MM2 = 1e-12
+# Quotes slice a decimated copy of meshes above this many triangles, as long as
+# the copy's volume stays within the tolerance (a fraction of the original volume)
+QUOTE_TRIANGLE_BUDGET = int(os.getenv("QUOTE_TRIANGLE_BUDGET", "400000"))
+DECIMATION_VOLUME_TOLERANCE = float(os.getenv("DECIMATION_VOLUME_TOLERANCE", "0.01"))
+DECIMATION_ATTEMPTS = 6
+# How far into a file to look for ASCII facets when its size doesn't match a binary STL exactly
+ASCII_SNIFF_BYTES = 1024
+VERTEX_RE = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+class MeshError(ValueError):
+    """The file is not a usable STL mesh."""
+
+
+def is_binary_stl(path):
+    return binary_stl_triangles(path) is not None
+
+
+def binary_stl_triangles(path):
+    """The triangle count of a binary STL, or None if the file isn't one."""
+    size = os.path.getsize(path)
+    if size < STL_HEADER_SIZE:
+        return None
+    with open(path, "rb") as f:
+        header = f.read(STL_HEADER_SIZE)
+        start = header + f.read(ASCII_SNIFF_BYTES)
+    count = int.from_bytes(header[80:84], "little")
+    expected = STL_HEADER_SIZE + count * STL_TRIANGLE_DTYPE.itemsize
+    if expected == size:
+        # Some exporters write "solid" into binary headers, so an exact size wins over the text
+        return count
+    # Others pad the file past the last triangle; take it as binary unless it reads as ASCII facets
+    if expected < size and not (start.lstrip().startswith(b"solid") and b"facet" in start):
+        return count
+    return None
+
+
+def read_stl(path):
+    """
+    Return the triangles of a binary or ASCII STL as an (n, 3, 3) float32 array.
+    Binary files are memory-mapped rather than read.
+    """
+    count = binary_stl_triangles(path)
+    if count is not None:
+        if count == 0:
+            return np.empty((0, 3, 3), dtype=np.float32)
+        records = np.memmap(path, dtype=STL_TRIANGLE_DTYPE, mode="r", offset=STL_HEADER_SIZE, shape=(count,))
+        return records["vertices"]
+
+    with open(path, "rb") as f:
+        text = f.read()
+    if not text.lstrip().startswith(b"solid"):
+        raise MeshError("Not an STL file")
+    try:
+        vertices = np.array(VERTEX_RE.findall(text), dtype=np.float32)
+    except ValueError:
+        raise MeshError("Malformed vertex in ASCII STL")
+    if len(vertices) % 3:
+        raise MeshError("ASCII STL has an incomplete facet")
+    return vertices.reshape(-1, 3, 3)
+
+
+def write_binary_stl(triangles, path, header=b"binary STL"):
+    """Write an (n, 3, 3) triangle array as a binary STL, with normals computed from the winding."""
+    records = np.zeros(len(triangles), dtype=STL_TRIANGLE_DTYPE)
+    records["vertices"] = triangles
+    for start in range(0, len(triangles), CHUNK_TRIANGLES):
+        chunk = np.asarray(triangles[start:start + CHUNK_TRIANGLES], dtype=np.float64)
+        normals = np.cross(chunk[:, 1] - chunk[:, 0], chunk[:, 2] - chunk[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        records["normal"][start:start + CHUNK_TRIANGLES] = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+    with open(path, "wb") as f:
+        f.write(header[:80].ljust(80, b"\0"))
+        f.write(len(records).to_bytes(4, "little"))
+        records.tofile(f)
+
+
+def analyse_triangles(triangles, welded=None):
+    """
+    Volume, surface area, bounding box and topology checks for an (n, 3, 3) triangle
+    array. `welded` may pass in weld_vertices(triangles) when the caller needs it too.
+    """
+    count = len(triangles)
+    volume = 0.0
+    area = 0.0
+    degenerate = 0
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for start in range(0, count, CHUNK_TRIANGLES):
+        chunk = np.asarray(triangles[start:start + CHUNK_TRIANGLES], dtype=np.float64)
+        if not np.isfinite(chunk).all():
+            raise MeshError("Mesh contains non-finite coordinates")
+        a, b, c = chunk[:, 0], chunk[:, 1], chunk[:, 2]
+        # Signed volume of the tetrahedron each face forms with the origin
+        volume += np.einsum("ij,ij->", a, np.cross(b, c)) / 6.0
+        face_areas = np.linalg.norm(np.cross(b - a, c - a), axis=1) / 2.0
+        area += face_areas.sum()
+        degenerate += int((face_areas < DEGENERATE_AREA_MM2).sum())
+        lower = np.minimum(lower, chunk.reshape(-1, 3).min(axis=0))
+        upper = np.maximum(upper, chunk.reshape(-1, 3).max(axis=0))
+
+    stats = {
+        "triangles": count,
+        "volume_mm3": abs(float(volume)),
+        "surface_area_mm2": float(area),
+        "bbox_min": lower.tolist() if count else [0.0, 0.0, 0.0],
+        "bbox_max": upper.tolist() if count else [0.0, 0.0, 0.0],
+        "size_mm": (upper - lower).tolist() if count else [0.0, 0.0, 0.0],
+        "degenerate_faces": degenerate,
+        "inverted": bool(volume < 0),
+        "manifold": None,
+        "open_edges": None,
+        "non_manifold_edges": None,
+    }
+    if 0 < count <= MANIFOLD_CHECK_MAX_TRIANGLES:
+        stats.update(_edge_check(welded or weld_vertices(triangles)))
+    return stats
+
+
+def _edge_check(welded):
+    # With identical vertices welded, every edge of a closed manifold mesh is shared by exactly two faces
+    index = welded[1]
+    faces = index.reshape(-1, 3)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges.sort(axis=1)
+    # Pack each undirected edge into one int64 so counting is a single integer sort
+    _, counts = np.unique(edges[:, 0] * (int(index.max()) + 1) + edges[:, 1], return_counts=True)
+    open_edges = int((counts == 1).sum())
+    non_manifold = int((counts > 2).sum())
+    return {"manifold": open_edges == 0 and non_manifold == 0, "open_edges": open_edges, "non_manifold_edges": non_manifold}
+
+
+def weld_vertices(triangles):
+    """
+    Merge bit-identical vertices. Returns (vertices, index) where index maps each
+    of the 3n triangle corners to a row of vertices.
+    """
+    corners = np.ascontiguousarray(triangles, dtype=np.float32).reshape(-1, 3)
+    # Hash the three coordinates' bits into one uint64 and sort that, which is far
+    # faster than sorting rows; a collision would only merge two vertices
+    bits = corners.view(np.uint32).astype(np.uint64)
+    keys = (bits[:, 0] * np.uint64(0x9E3779B97F4A7C15)) ^ (bits[:, 1] * np.uint64(0xC2B2AE3D27D4EB4F)) ^ (bits[:, 2] * np.uint64(0x165667B19E3779F9))
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    is_new = np.empty(len(keys), dtype=bool)
+    is_new[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=is_new[1:])
+    index = np.empty(len(keys), dtype=np.int64)
+    index[order] = np.cumsum(is_new) - 1
+    return corners[order[is_new]], index
+
+
+def signed_volume(triangles):
+    volume = 0.0
+    for start in range(0, len(triangles), CHUNK_TRIANGLES):
+        chunk = np.asarray(triangles[start:start + CHUNK_TRIANGLES], dtype=np.float64)
+        volume += np.einsum("ij,ij->", chunk[:, 0], np.cross(chunk[:, 1], chunk[:, 2])) / 6.0
+    return float(volume)
+
+
+def decimate(triangles, target, volume, surface_area, tolerance=DECIMATION_VOLUME_TOLERANCE, welded=None):
+    """
+    Vertex-clustering decimation: weld the mesh, snap vertices to a grid sized so
+    roughly `target` triangles survive, replace each occupied cell's vertices by
+    their mean and drop faces that collapsed. The grid is coarsened until the
+    result fits the budget. Returns (triangles, relative_volume_error), or None
+    if the budget can't be met within `tolerance` of the original volume.
+    """
+    vertices, index = welded or weld_vertices(triangles)
+    vertices = vertices.astype(np.float64)
+    faces = index.reshape(-1, 3)
+    lower = vertices.min(axis=0)
+    # A closed mesh has about twice as many faces as vertices, and vertices cover the surface evenly
+    cell = max(np.sqrt(surface_area / (target / 2)), 1e-6)
+    for _ in range(DECIMATION_ATTEMPTS):
+        result = _cluster(vertices, faces, lower, cell)
+        if len(result) <= target:
+            error = abs(abs(signed_volume(result)) - volume) / volume
+            return (result, error) if error <= tolerance else None
+        cell *= 1.3
+    return None
+
+
+def _cluster(vertices, faces, lower, cell):
+    cells = np.floor((vertices - lower) / cell).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    cell_ids = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    _, cluster = np.unique(cell_ids, return_inverse=True)
+    cluster = cluster.ravel()
+    counts = np.bincount(cluster)
+    centres = np.stack([np.bincount(cluster, weights=vertices[:, axis]) / counts for axis in range(3)], axis=1)
+    clustered = cluster[faces]
+    keep = (clustered[:, 0] != clustered[:, 1]) & (clustered[:, 1] != clustered[:, 2]) & (clustered[:, 2] != clustered[:, 0])
+    return centres[clustered[keep]].astype(np.float32)
+
+
+def prepare_for_quote(path, out_path, budget=QUOTE_TRIANGLE_BUDGET, tolerance=DECIMATION_VOLUME_TOLERANCE):
+    """
+    Analyse and validate an STL, reading it once, and write a copy that is quicker
+    to slice to `out_path` when that helps: binary instead of ASCII, and decimated
+    below `budget` triangles if the volume stays within `tolerance`. Only meant for
+    quoting; the original file is what gets printed. Returns (stats, prepared),
+    where prepared describes the copy, or is None if the original should be sliced.
+    """
+    binary = is_binary_stl(path)
+    triangles = read_stl(path)
+    # Welding is the expensive part of both the manifold check and decimation, so do it once
+    count = len(triangles)
+    welded = weld_vertices(triangles) if count and (count <= MANIFOLD_CHECK_MAX_TRIANGLES or count > budget) else None
+    stats = analyse_triangles(triangles, welded)
+    stats["binary"] = binary
+    validate(stats)
+
+    prepared = None
+    if stats["triangles"] > budget:
+        decimated = decimate(triangles, budget, stats["volume_mm3"], stats["surface_area_mm2"], tolerance, welded)
+        if decimated is not None:
+            triangles, error = decimated
+            prepared = {"triangles": len(triangles), "volume_error": error, "decimated": True}
+    if prepared is None and not binary:
+        prepared = {"triangles": stats["triangles"], "volume_error": 0.0, "decimated": False}
+    if prepared is not None:
+        write_binary_stl(triangles, out_path)
+    return stats, prepared
+
+
+def analyse_stl(path):
+    stats = analyse_triangles(read_stl(path))
+    stats["binary"] = is_binary_stl(path)
+    return stats
+
+
+def validate(stats):
+    """Raise MeshError for meshes the slicer can't produce anything useful from."""
+    if stats["triangles"] == 0:
+        raise MeshError("The model contains no triangles")
+    if stats["degenerate_faces"] == stats["triangles"]:
+        raise MeshError("Every face of the model is degenerate")
+    if stats["volume_mm3"] < 1e-3:
+        raise MeshError("The model has no volume")
+
+
+def estimate_filament(stats, infill_density=20, nozzle_diameter=0.4):
+    """
+    Rough filament usage from mesh statistics: solid walls of two perimeters
+    over the whole surface, infill inside them. Ignores supports, so it tends
+    to underestimate overhanging models.
+    """
+    wall_mm = 2 * 1.125 * nozzle_diameter
+    volume = stats["volume_mm3"]
+    shell = min(volume, stats["surface_area_mm2"] * wall_mm)
+    used_mm3 = shell + (volume - shell) * min(infill_density, 100) / 100
+    volume_cm3 = used_mm3 / 1000
+    return {"volume_cm3": float(volume_cm3), "length_mm": float(filament_length_for_volume(volume_cm3))}
@@ -0,0 +1,209 @@
+import contextvars
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+log = logging.getLogger(__name__)
+slow_log = logging.getLogger("slow_requests")
+
+# Requests slower than this are logged with their stage timings, parameters and mesh stats; 0 disables
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))
+
+# Set to an empty directory when running several uvicorn workers: prometheus_client then keeps
+# counters and histograms in files there, and a scrape of any worker adds up all of them
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Stages run from milliseconds (cache hits) to minutes (big slices)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP requests by route and status",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "request_stage_duration_seconds", "Time spent in each stage of a request (upload, price_lookup, slicing, ...)",
+    ["endpoint", "stage"], buckets=LATENCY_BUCKETS,
+)
+SLICE_SECONDS = Histogram(
+    "slice_duration_seconds", "Queue wait plus slicing, by backend and print settings",
+    ["backend", "layer_height", "infill", "nozzle"], buckets=LATENCY_BUCKETS,
+)
+ERRORS = Counter("errors_total", "Errors by where they happened and their type", ["endpoint", "stage", "type"])
+QUOTE_CACHE_LOOKUPS = Counter("quote_cache_lookups_total", "Slice result cache lookups", ["result"])
+SLICE_ESTIMATE_RATIO = Histogram(
+    "slice_estimate_ratio", "Measured over estimated slice run time, for the scheduler's cost model",
+    buckets=(0.25, 0.5, 0.67, 0.8, 0.9, 1.1, 1.25, 1.5, 2, 4),
+)
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """Stage timings and context of one request (or background job), for metrics and the slow log."""
+
+    def __init__(self, endpoint=None, scope=None):
+        self.id = uuid.uuid4().hex[:12]
+        self._endpoint = endpoint
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    @property
+    def endpoint(self):
+        if self._endpoint:
+            return self._endpoint
+        # Starlette records the matched route in the scope; its template keeps label values bounded
+        route = self.scope.get("route") if self.scope else None
+        return getattr(route, "path", "unmatched")
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def _endpoint():
+    trace = _current_trace.get()
+    return trace.endpoint if trace else "background"
+
+
+@contextmanager
+def tracing(endpoint=None, scope=None):
+    """Make a new Trace current for the block; it's checked against SLOW_REQUEST_SECONDS at the end."""
+    trace = Trace(endpoint, scope)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        if SLOW_REQUEST_SECONDS and trace.elapsed >= SLOW_REQUEST_SECONDS:
+            slow_log.warning("Slow request", extra={
+                "trace": trace.id,
+                "endpoint": trace.endpoint,
+                "seconds": round(trace.elapsed, 3),
+                "stages": {name: round(seconds, 3) for name, seconds in trace.stages.items()},
+                **trace.fields,
+            })
+
+
+def annotate(**fields):
+    """Attach parameters, mesh stats, ... to the current trace for the slow-request log."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def observe_stage(stage, seconds):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.stages[stage] = trace.stages.get(stage, 0.0) + seconds
+    STAGE_SECONDS.labels(_endpoint(), stage).observe(seconds)
+
+
+def record_error(stage, error):
+    ERRORS.labels(_endpoint(), stage, type(error).__name__).inc()
+
+
+@contextmanager
+def span(stage):
+    """Time a stage of the current request; exceptions escaping it are counted by type."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_error(stage, e)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def observe_slice(backend, layer_height, infill, nozzle, seconds):
+    # Rounded so arbitrary form values can't create unbounded label sets
+    SLICE_SECONDS.labels(backend, f"{round(float(layer_height), 2):g}", str(int(infill) // 10 * 10), f"{round(float(nozzle), 1):g}").observe(seconds)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request and running it inside a Trace."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        with tracing(scope=scope) as trace:
+            try:
+                await self.app(scope, receive, send_with_status)
+            except Exception as e:
+                record_error("unhandled", e)
+                raise
+            finally:
+                seconds = trace.elapsed
+                REQUEST_SECONDS.labels(scope["method"], trace.endpoint, str(status)).observe(seconds)
+                log.info("Request", extra={
+                    "trace": trace.id, "method": scope["method"], "path": scope["path"],
+                    "status": status, "ms": round(seconds * 1000, 1),
+                })
+
+
+class StatsCollector:
+    """
+    Exposes a stats() dict (slice pool, quote cache, ...) as gauges and counters at scrape time.
+    With several workers each series is labelled with the worker's pid, since only the
+    scraped worker's own stats are at hand.
+    """
+
+    def __init__(self, prefix, stats, counters=()):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = set(counters)
+
+    def collect(self):
+        labels = ["worker"] if PROMETHEUS_MULTIPROC_DIR else None
+        for name, value in self.stats().items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            family = CounterMetricFamily if name in self.counters else GaugeMetricFamily
+            if labels:
+                metric = family(f"{self.prefix}_{name}", f"{self.prefix} {name}", labels=labels)
+                metric.add_metric([str(os.getpid())], value)
+                yield metric
+            else:
+                yield family(f"{self.prefix}_{name}", f"{self.prefix} {name}", value=value)
+
+
+_stats_collectors = []
+
+
+def register_stats(prefix, stats, counters=()):
+    collector = StatsCollector(prefix, stats, counters)
+    _stats_collectors.append(collector)
+    REGISTRY.register(collector)
+
+
+def render():
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in _stats_collectors:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,69 @@
+"""
+Move models saved before the blob store existed (uploads/<customer>/<name>.stl)
+into it and record them in the model manifest. Safe to run more than once:
+files already in the manifest are skipped. Originals are only removed with
+--delete, after their blob has been written.
+
+    cd backend && python migrate_uploads.py --dry-run
+    cd backend && python migrate_uploads.py --delete
+"""
+import argparse
+import re
+from pathlib import Path
+
+from blobstore import BLOB_DIR, MANIFEST_PATH, blob_store, model_manifest
+
+# save-model appended "_<8 hex chars>" to the customer's model name
+RANDOM_SUFFIX_RE = re.compile(r"_[0-9a-f]{8}$")
+
+
+def legacy_files(uploads):
+    skip = {BLOB_DIR.resolve(), MANIFEST_PATH.parent.resolve()}
+    for customer_dir in sorted(p for p in uploads.iterdir() if p.is_dir()):
+        if customer_dir.resolve() in skip:
+            continue
+        for path in sorted(p for p in customer_dir.iterdir() if p.is_file()):
+            yield customer_dir.name, path
+
+
+def main(args):
+    uploads = Path(args.uploads)
+    migrated = skipped = original_bytes = 0
+    digests = set()
+    for customer, path in legacy_files(uploads):
+        if model_manifest.has_file(customer, path.name):
+            skipped += 1
+            continue
+        size = path.stat().st_size
+        if args.dry_run:
+            print(f"would migrate {customer}/{path.name} ({size} bytes)")
+            migrated += 1
+            original_bytes += size
+            continue
+        digest, stored_size = blob_store.put(path)
+        if not blob_store.has(digest):
+            raise RuntimeError(f"Blob for {path} was not written")
+        name = RANDOM_SUFFIX_RE.sub("", path.stem)
+        model_manifest.add(customer, name, path.name, digest, stored_size, created_at=path.stat().st_mtime)
+        digests.add(digest)
+        migrated += 1
+        original_bytes += size
+        if args.delete:
+            path.unlink()
+            if not any(path.parent.iterdir()):
+                path.parent.rmdir()
+        print(f"{customer}/{path.name} -> {digest}")
+
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {migrated} files ({original_bytes / 1e6:.1f} MB), "
+          f"skipped {skipped} already in the manifest")
+    if not args.dry_run:
+        stats = blob_store.stats()
+        print(f"{len(digests)} distinct models; blob store now holds {stats['blobs']} blobs, {stats['bytes'] / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", default="uploads")
+    parser.add_argument("--delete", action="store_true", help="remove each original once its blob is stored")
+    parser.add_argument("--dry-run", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from pathlib import Path
+
+from db import Database
+
+# Saved models wait here until their Shopify product has been created
+OUTBOX_PATH = Path(os.getenv("OUTBOX_PATH", "outbox/orders.sqlite3"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_SECONDS = 2
+OUTBOX_MAX_BACKOFF_SECONDS = 600
+# A worker that dies mid-job loses its claim after this long and the job is retried;
+# a live worker renews it every third of that while its handler runs
+OUTBOX_LEASE_SECONDS = 300
+OUTBOX_POLL_SECONDS = 1
+
+log = logging.getLogger(__name__)
+
+
+class PermanentFailure(Exception):
+    """Raised by a handler for errors that retrying won't fix; the job is dead-lettered at once."""
+
+
+class Outbox:
+    """
+    Durable queue of orders backed by SQLite. Rows move pending -> running -> done,
+    or back to pending with exponential backoff on failure, and to dead once
+    max_attempts is reached. Workers claim rows with a lease, so several
+    processes can drain the same outbox and a crashed worker's job is picked up again.
+    """
+
+    def __init__(self, path=OUTBOX_PATH, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.db = Database(path)
+        self.files_dir = Path(path).parent / "files"
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = max_attempts
+        self._wakeup = None
+        self._loop = None
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    next_attempt_at REAL NOT NULL,
+                    lease_until REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS orders_ready ON orders (state, next_attempt_at)")
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def enqueue(self, params, order_id=None):
+        order_id = order_id or self.new_id()
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO orders (id, state, params, next_attempt_at, created_at, updated_at) VALUES (?, 'pending', ?, ?, ?, ?)",
+                (order_id, json.dumps(params), now, now, now),
+            )
+        if self._wakeup is not None:
+            # Usually called from a worker thread (asyncio.to_thread), where the event can't be set directly
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return order_id
+
+    def claim(self):
+        """
+        Take the oldest ready job, or one whose worker's lease ran out. Returns (id, params, attempts, lease_until)
+        or None. A lapsed lease counts as a failed attempt, so a job that keeps crashing or hanging its worker is
+        dead-lettered.
+        """
+        now = time.time()
+        # Idle workers poll every second; only take the write lock when there is something to claim
+        with self.db.read() as conn:
+            due = conn.execute(
+                "SELECT 1 FROM orders WHERE (state = 'pending' AND next_attempt_at <= ?) OR (state = 'running' AND lease_until <= ?) LIMIT 1",
+                (now, now),
+            ).fetchone()
+        if due is None:
+            return None
+        with self.db.transaction() as conn:
+            while True:
+                row = conn.execute(
+                    """
+                    SELECT id, params, attempts, state FROM orders
+                    WHERE (state = 'pending' AND next_attempt_at <= ?) OR (state = 'running' AND lease_until <= ?)
+                    ORDER BY next_attempt_at LIMIT 1
+                    """,
+                    (now, now),
+                ).fetchone()
+                if row is None:
+                    return None
+                order_id, params, attempts, state = row
+                if state == "running":
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        conn.execute(
+                            "UPDATE orders SET state = 'dead', attempts = ?, last_error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                            (attempts, "Worker stopped before finishing the job", now, order_id),
+                        )
+                        log.error("Order dead-lettered after its worker kept stopping", extra={"order": order_id, "attempts": attempts})
+                        continue
+                lease_until = now + OUTBOX_LEASE_SECONDS
+                conn.execute(
+                    "UPDATE orders SET state = 'running', attempts = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                    (attempts, lease_until, now, order_id),
+                )
+                return order_id, json.loads(params), attempts, lease_until
+
+    def renew(self, order_id, lease_until):
+        """Extend a claim; returns the new lease_until, or None if the lease lapsed and another worker took the job."""
+        renewed = time.time() + OUTBOX_LEASE_SECONDS
+        with self.db.transaction() as conn:
+            updated = conn.execute(
+                "UPDATE orders SET lease_until = ? WHERE id = ? AND state = 'running' AND lease_until = ?",
+                (renewed, order_id, lease_until),
+            ).rowcount
+        return renewed if updated else None
+
+    def complete(self, order_id, result):
+        with self.db.transaction() as conn:
+            conn.execute(
+                "UPDATE orders SET state = 'done', result = ?, last_error = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (json.dumps(result), time.time(), order_id),
+            )
+
+    def fail(self, order_id, error, permanent=False):
+        """Record a failed attempt; schedules a retry with backoff or dead-letters the job. Returns the new state."""
+        now = time.time()
+        with self.db.transaction() as conn:
+            attempts = conn.execute("SELECT attempts FROM orders WHERE id = ?", (order_id,)).fetchone()[0] + 1
+            state = "dead" if permanent or attempts >= self.max_attempts else "pending"
+            delay = min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1))
+            # Jitter so jobs that failed together don't retry together
+            delay *= random.uniform(0.5, 1.0)
+            conn.execute(
+                "UPDATE orders SET state = ?, attempts = ?, last_error = ?, next_attempt_at = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (state, attempts, str(error), now + delay, now, order_id),
+            )
+        return state
+
+    def release(self, order_id):
+        # Hand an interrupted job back without counting it as an attempt
+        with self.db.transaction() as conn:
+            conn.execute(
+                "UPDATE orders SET state = 'pending', lease_until = NULL, updated_at = ? WHERE id = ? AND state = 'running'",
+                (time.time(), order_id),
+            )
+
+    def get(self, order_id):
+        with self.db.read() as conn:
+            row = conn.execute(
+                "SELECT state, result, attempts, last_error, next_attempt_at, created_at, updated_at FROM orders WHERE id = ?",
+                (order_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        state, result, attempts, last_error, next_attempt_at, created_at, updated_at = row
+        return {
+            "order_id": order_id,
+            "status": state,
+            "attempts": attempts,
+            "error": last_error,
+            "next_attempt_at": next_attempt_at if state == "pending" and attempts else None,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            **(json.loads(result) if result else {}),
+        }
+
+    def stats(self):
+        with self.db.read() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM orders GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ("pending", "running", "done", "dead")}
+
+    def start(self, handler, workers=OUTBOX_WORKERS):
+        """
+        Start `workers` tasks that drain the outbox with `handler(order_id, params)`,
+        whose return value is stored as the order's result. Cancel the tasks to stop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        return [asyncio.create_task(self._work(handler)) for _ in range(workers)]
+
+    async def _work(self, handler):
+        while True:
+            job = await asyncio.to_thread(self.claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            order_id, params, attempts, lease_until = job
+            renewer = asyncio.create_task(self._keep_leased(order_id, lease_until))
+            try:
+                result = await handler(order_id, params)
+            except asyncio.CancelledError:
+                await asyncio.shield(asyncio.to_thread(self.release, order_id))
+                raise
+            except Exception as e:
+                state = await asyncio.to_thread(self.fail, order_id, e, isinstance(e, PermanentFailure))
+                log.warning("Order attempt failed: %s", e, extra={"order": order_id, "attempt": attempts + 1, "state": state})
+                continue
+            finally:
+                renewer.cancel()
+            await asyncio.to_thread(self.complete, order_id, result)
+
+    async def _keep_leased(self, order_id, lease_until):
+        # A slow handler (thumbnail, then productSet) mustn't outlive its lease and run twice
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE_SECONDS / 3)
+            lease_until = await asyncio.to_thread(self.renew, order_id, lease_until)
+            if lease_until is None:
+                log.warning("Lost the lease on an order while handling it", extra={"order": order_id})
+                return
+
+
+outbox = Outbox()
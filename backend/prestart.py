@@ -0,0 +1,71 @@
+"""
+One-off startup tasks for a deployment running several uvicorn workers, done
+once before they start instead of by each of them: checking that PrusaSlicer
+can be found, creating the shared SQLite databases, filling the material price
+cache and clearing the Prometheus multiprocess directory left by the last run.
+
+    cd backend && python prestart.py && uvicorn main:app --workers 4
+"""
+import asyncio
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+
+from logs import configure_logging
+
+
+def reset_multiproc_dir():
+    # Metric files of the last run's workers would otherwise be added into this run's totals.
+    # Done before anything imports prometheus_client, which writes into the directory
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        Path(path).mkdir(parents=True)
+
+
+configure_logging()
+reset_multiproc_dir()
+
+from cluster import SLICE_WORKERS
+from slicer import PRUSA_SLICER_BIN, backends
+
+log = logging.getLogger("prestart")
+
+
+def check_slicer():
+    if backends["prusa"].available():
+        log.info("Found PrusaSlicer", extra={"binary": backends["prusa"].binary})
+        return True
+    if SLICE_WORKERS:
+        return True
+    log.error("PrusaSlicer not found and no SLICE_WORKERS configured", extra={"binary": PRUSA_SLICER_BIN})
+    # Outside production, quotes fall back to estimates from the mesh
+    return os.getenv("ENV") != "production"
+
+
+async def warm_prices():
+    from helpers import close_shopify_client, open_shopify_client, warm_material_cache
+
+    await open_shopify_client()
+    try:
+        await warm_material_cache()
+    except Exception as e:
+        # Workers fetch prices on demand, so this only costs the first quotes some latency
+        log.warning("Failed to warm material cache: %s", e)
+    finally:
+        await close_shopify_client()
+
+
+def main():
+    if not check_slicer():
+        sys.exit(1)
+    # Creating the stores creates their tables
+    import artifacts, blobstore, jobs, leases, outbox, quote_cache, staging  # noqa: F401
+
+    asyncio.run(warm_prices())
+
+
+if __name__ == "__main__":
+    main()
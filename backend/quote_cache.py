@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from db import Database
+
+# Slice results are keyed by mesh digest + geometry-affecting parameters and store
+# filament usage (volume/length), not grams, so material/density changes stay cache hits.
+QUOTE_CACHE_PATH = Path(os.getenv("QUOTE_CACHE_PATH", "cache/quotes.sqlite3"))
+QUOTE_CACHE_MAX_ENTRIES = int(os.getenv("QUOTE_CACHE_MAX_ENTRIES", "50000"))
+# Hit/miss counts and LRU timestamps are written in batches at most this often, so lookups only read
+QUOTE_CACHE_FLUSH_SECONDS = 5
+
+
+def make_key(digest, infill, layer_height, nozzle_diameter):
+    return f"{digest}:{int(infill)}:{float(layer_height):g}:{float(nozzle_diameter):g}"
+
+
+class QuoteCache:
+    """
+    Persistent LRU cache of slice results backed by SQLite in WAL mode, so it
+    survives restarts and can be shared by several uvicorn workers. Methods
+    block on the database; call them off the event loop.
+    """
+
+    def __init__(self, path=QUOTE_CACHE_PATH, max_entries=QUOTE_CACHE_MAX_ENTRIES):
+        self.db = Database(path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._used = {}  # key -> last lookup, not yet written
+        self._flushed_at = time.monotonic()
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS quotes (
+                    key TEXT PRIMARY KEY,
+                    volume_cm3 REAL NOT NULL,
+                    length_mm REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    extra TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS quotes_last_used ON quotes (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+
+    def get(self, key, count=True):
+        """The cached usage for `key`, or None; `count` is False for lookups that shouldn't skew the hit rate."""
+        with self.db.read() as conn:
+            row = conn.execute("SELECT volume_cm3, length_mm, extra FROM quotes WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is not None:
+                self._used[key] = time.time()
+            if count:
+                if row is None:
+                    self._misses += 1
+                else:
+                    self._hits += 1
+        if time.monotonic() - self._flushed_at >= QUOTE_CACHE_FLUSH_SECONDS:
+            self.flush()
+        if row is None:
+            return None
+        return {**json.loads(row[2] or "{}"), "volume_cm3": row[0], "length_mm": row[1]}
+
+    def flush(self):
+        """Write the lookups counted since the last flush."""
+        with self._lock:
+            hits, misses, used = self._hits, self._misses, self._used
+            self._hits = self._misses = 0
+            self._used = {}
+            self._flushed_at = time.monotonic()
+        if not (hits or misses or used):
+            return
+        with self.db.transaction() as conn:
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'", (hits,))
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'", (misses,))
+            conn.executemany("UPDATE quotes SET last_used = ? WHERE key = ?", [(t, key) for key, t in used.items()])
+
+    def put(self, key, usage):
+        now = time.time()
+        extra = {k: v for k, v in usage.items() if k not in ("volume_cm3", "length_mm")}
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO quotes (key, volume_cm3, length_mm, created_at, last_used, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, usage["volume_cm3"], usage["length_mm"], now, now, json.dumps(extra)),
+            )
+            count = conn.execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                # Evict a little extra so we don't pay for eviction on every insert
+                overflow += self.max_entries // 20
+                conn.execute(
+                    "DELETE FROM quotes WHERE key IN (SELECT key FROM quotes ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                conn.execute("UPDATE counters SET value = value + ? WHERE name = 'evictions'", (overflow,))
+
+    def stats(self):
+        # Other workers' unflushed lookups show up within QUOTE_CACHE_FLUSH_SECONDS
+        self.flush()
+        with self.db.read() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            counters["entries"] = conn.execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+        counters["max_entries"] = self.max_entries
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+        return counters
+
+
+quote_cache = QuoteCache()
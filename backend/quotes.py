@@ -0,0 +1,491 @@
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+from artifacts import artifact_store
+from blobstore import blob_store
+from helpers import get_shopify_price
+from leases import leases
+from mesh import MeshError, prepare_for_quote, estimate_filament
+from slicer import SliceOutOfMemory, SliceTimeout, SLICE_BACKEND, get_backend
+from quote_cache import quote_cache, make_key
+from slice_pool import slice_pool, SlicerBusy, estimate_slice_cost, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from staging import staging
+
+# Optional machine-time charge on top of material, using the slicer's print time estimate
+MACHINE_RATE_PER_HOUR = float(os.getenv("MACHINE_RATE_PER_HOUR", "0"))
+# Tries at getting a saved model's G-code sliced when the slicing queue is full
+ARCHIVE_SLICE_ATTEMPTS = 5
+# An identical slice running in any worker is waited for rather than repeated; its lease
+# is renewed while it runs and lapses this long after a worker dies holding it
+SLICE_LEASE_SECONDS = 30
+SLICE_LEASE_POLL_SECONDS = 0.25
+
+log = logging.getLogger(__name__)
+
+# G-code being archived; referenced here so the tasks aren't garbage collected
+_archiving = set()
+
+
+class QuoteError(Exception):
+    """Carries the HTTP status and JSON body the API should answer with."""
+
+    def __init__(self, status_code, content, headers=None):
+        super().__init__(content.get("error"))
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+
+async def lookup_price(material, variant):
+    # Get price per gram and density from Shopify before slicing
+    try:
+        with metrics.span("price_lookup"):
+            price_per_gram, density = await get_shopify_price(material, variant if variant.startswith("gid://shopify/ProductVariant/") else None)
+        log.debug("Material price", extra={"material": material, "variant": variant, "price_per_gram": price_per_gram, "density": density})
+        return price_per_gram, density
+    except Exception as e:
+        log.exception("Shopify price lookup failed")
+        raise QuoteError(500, {"error": f"Shopify error: {str(e)}"})
+
+
+def quote_key(digest, infill, layer_height, nozzle_size, backend=None):
+    key = make_key(digest, infill, layer_height, max(nozzle_size, 0.4))
+    # PrusaSlicer results keep the keys they were cached under before there were other backends
+    if backend is not None and backend.name != "prusa":
+        key = f"{key}:{backend.name}"
+    return key
+
+
+def resolve_backend(name=None, preview=False):
+    """The slicing backend a request asked for, by name or by the preview/quote policy."""
+    try:
+        return get_backend(name or None, preview=preview)
+    except ValueError as e:
+        raise QuoteError(400, {"error": str(e)})
+
+
+def is_final(backend):
+    """Only quotes from the quoting backend can be ordered from; others are previews."""
+    return backend.name == SLICE_BACKEND
+
+
+async def inspect_model(model):
+    """
+    Analyse an uploaded STL once (milliseconds, no slicer process) and reject
+    meshes the slicer can't do anything with. Other formats are left to the slicer.
+    Also prepares a binary, possibly decimated, copy for quoting when that slices faster.
+    """
+    if model.mesh is None and model.path.suffix.lower() == ".stl":
+        quote_path = model.path.with_name(f"{model.path.stem}.quote.stl")
+        try:
+            with metrics.span("inspect"):
+                stats, prepared = await asyncio.to_thread(prepare_for_quote, model.path, quote_path)
+        except MeshError as e:
+            raise QuoteError(400, {
+                "error": "Invalid model file. Please ensure your STL file is valid and not corrupted.",
+                "details": str(e)
+            })
+        model.mesh = stats
+        metrics.annotate(mesh=stats, upload_bytes=model.size)
+        if prepared is not None:
+            model.slice_path = quote_path
+            model.prepared = prepared
+            metrics.annotate(prepared=prepared)
+            log.info(
+                "Quoting from a %s copy", "decimated" if prepared["decimated"] else "binary",
+                extra={"triangles": stats["triangles"], "prepared_triangles": prepared["triangles"], "volume_error": prepared["volume_error"]},
+            )
+    return model.mesh
+
+
+def archivable(model, backend):
+    """Whether slicing `model` on `backend` gives G-code worth keeping for the print farm."""
+    # G-code of a decimated copy isn't the model the customer ordered; slices
+    # that end up writing none (e.g. without PrusaSlicer) are dropped by archive_gcode()
+    decimated = model.prepared is not None and model.prepared["decimated"]
+    return backend.gcode and not decimated
+
+
+def slice_cost(model, layer_height):
+    """The scheduler's cost estimate for slicing `model`, or None for meshes we haven't analysed."""
+    stats = model.mesh
+    if stats is None:
+        return None
+    triangles = model.prepared["triangles"] if model.prepared else stats["triangles"]
+    height = stats["bbox_max"][2] - stats["bbox_min"][2]
+    return estimate_slice_cost(triangles, stats["volume_mm3"], height, float(layer_height))
+
+
+async def get_filament_usage(model, infill, layer_height, nozzle_size, on_progress=None, on_estimate=None, backend=None,
+                             client=None, priority=PRIORITY_INTERACTIVE):
+    """
+    Return the filament usage for an uploaded model, slicing it only on a quote
+    cache miss. on_estimate(usage) receives a mesh-based estimate before slicing.
+    `client` and `priority` decide its place in the slicing queue.
+    """
+    backend = backend or get_backend()
+    nozzle_diameter = max(nozzle_size, 0.4)
+    cache_key = quote_key(model.digest, infill, layer_height, nozzle_size, backend)
+    metrics.annotate(infill=infill, layer_height=layer_height, nozzle_size=nozzle_size, backend=backend.name)
+    usage = await asyncio.to_thread(quote_cache.get, cache_key)
+    metrics.QUOTE_CACHE_LOOKUPS.labels("miss" if usage is None else "hit").inc()
+    if usage is not None:
+        log.debug("Quote cache hit", extra={"key": cache_key})
+        return usage
+
+    stats = await inspect_model(model)
+    if stats is not None and on_estimate:
+        on_estimate(estimate_filament(stats, infill_density=infill, nozzle_diameter=nozzle_diameter))
+
+    token, usage = await claim_slice(cache_key, on_progress)
+    if usage is not None:
+        metrics.QUOTE_CACHE_LOOKUPS.labels("shared").inc()
+        return usage
+
+    async with leases.held(f"slice:{cache_key}", token, SLICE_LEASE_SECONDS):
+        gcode_path = artifact_store.incoming_path(cache_key) if archivable(model, backend) else None
+        started = time.perf_counter()
+        try:
+            slice_args = (str(model.slice_path), infill, layer_height, nozzle_diameter, on_progress, gcode_path)
+            with metrics.span("slice"):
+                if backend.bounded:
+                    usage = await backend.slice(*slice_args)
+                else:
+                    usage = await slice_pool.run(
+                        backend.slice, *slice_args, cost=slice_cost(model, layer_height), client=client, priority=priority
+                    )
+            seconds = time.perf_counter() - started
+            metrics.observe_slice(backend.name, layer_height, infill, nozzle_diameter, seconds)
+            log.info("Sliced model", extra={"backend": backend.name, "key": cache_key, "seconds": round(seconds, 3)})
+        except SlicerBusy as e:
+            raise QuoteError(
+                503,
+                {"error": "The slicer is busy. Please try again shortly.", "retry_after": e.retry_after},
+                headers={"Retry-After": str(e.retry_after)}
+            )
+        except SliceTimeout as e:
+            raise QuoteError(422, {
+                "error": "This model took too long to slice. Try simplifying it or contact us for a manual quote.",
+                "details": str(e),
+            })
+        except SliceOutOfMemory as e:
+            log.warning("Slicer ran out of memory", extra={"backend": backend.name, "key": cache_key})
+            raise QuoteError(422, {
+                "error": "This model needs more memory to slice than we allow. Try simplifying it or contact us for a manual quote.",
+                "details": str(e),
+            })
+        except RuntimeError as e:
+            log.exception("Slicing failed", extra={"backend": backend.name, "key": cache_key})
+            error_msg = str(e)
+            # Check if it's a model loading error
+            if "Loading of a model file failed" in error_msg or "Slicer error" in error_msg:
+                raise QuoteError(400, {
+                    "error": "Invalid model file. Please ensure your STL file is valid and not corrupted.",
+                    "details": "The uploaded file could not be processed. Try re-exporting your model or using a different file format."
+                })
+            # Other runtime errors still return 500
+            raise QuoteError(500, {"error": f"Processing error: {error_msg}"})
+        except Exception as e:
+            log.exception("Slicing failed", extra={"backend": backend.name, "key": cache_key})
+            raise QuoteError(500, {"error": f"Unexpected error: {str(e)}"})
+        finally:
+            if gcode_path is not None and usage is None:
+                gcode_path.unlink(missing_ok=True)
+
+        await asyncio.to_thread(quote_cache.put, cache_key, usage)
+        if gcode_path is not None:
+            archive_gcode(cache_key, gcode_path, usage)
+    return usage
+
+
+async def claim_slice(cache_key, on_progress=None):
+    """
+    Lease the slicing of `cache_key`, waiting while another request, in this
+    worker or another, is slicing the same thing. Returns (token, None) when
+    the caller should slice, or (None, usage) once the other slice's result
+    is in the quote cache.
+    """
+    key = f"slice:{cache_key}"
+    waiting = False
+    while True:
+        token = await asyncio.to_thread(leases.acquire, key, SLICE_LEASE_SECONDS)
+        if token is not None:
+            # The previous holder may have finished between our cache miss and now
+            usage = await asyncio.to_thread(quote_cache.get, cache_key, False)
+            if usage is None:
+                return token, None
+            await asyncio.to_thread(leases.release, key, token)
+            return None, usage
+        if not waiting:
+            waiting = True
+            log.info("Waiting for an identical slice", extra={"key": cache_key})
+            if on_progress:
+                on_progress(0, "Waiting for an identical quote")
+        await asyncio.sleep(SLICE_LEASE_POLL_SECONDS)
+        usage = await asyncio.to_thread(quote_cache.get, cache_key, False)
+        if usage is not None:
+            return None, usage
+
+
+def archive_gcode(key, gcode_path, usage):
+    """Store a slice's G-code and statistics in the background; quotes don't wait for the compression."""
+    if not _has_gcode(gcode_path):
+        return
+    _in_background(asyncio.to_thread(artifact_store.put, key, gcode_path, usage))
+
+
+def _has_gcode(gcode_path):
+    """Whether a slice left G-code to archive; an empty or missing file is cleaned up."""
+    try:
+        if gcode_path.stat().st_size > 0:
+            return True
+    except FileNotFoundError:
+        return False
+    gcode_path.unlink(missing_ok=True)
+    return False
+
+
+def _in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _archiving.add(task)
+    task.add_done_callback(_archived)
+
+
+def _archived(task):
+    _archiving.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error("Failed to archive G-code", exc_info=task.exception())
+
+
+async def archive_saved_model(key, digest, suffix, infill, layer_height, nozzle_size, client=None, backend=None):
+    """
+    Keep the G-code of a saved model's quote (`key` is its quote_key() for
+    `backend`) for printing. When the quote came from the cache and there is
+    none, the stored blob is sliced again in the background, behind interactive work.
+    """
+    if await asyncio.to_thread(artifact_store.keep, key) or artifact_store.pending(key):
+        return
+    backend = backend or get_backend()
+    if not backend.gcode or not backend.available():
+        return
+    _in_background(_slice_for_archive(backend, key, digest, suffix, infill, layer_height, max(nozzle_size, 0.4), client))
+
+
+async def _slice_for_archive(backend, key, digest, suffix, infill, layer_height, nozzle_diameter, client):
+    gcode_path = artifact_store.incoming_path(key)
+    try:
+        with blob_store.materialized(digest, suffix) as path:
+            for attempt in range(ARCHIVE_SLICE_ATTEMPTS):
+                try:
+                    usage = await slice_pool.run(
+                        backend.slice, str(path), infill, layer_height, nozzle_diameter, None, gcode_path,
+                        client=client, priority=PRIORITY_BATCH
+                    )
+                    break
+                except SlicerBusy as e:
+                    await asyncio.sleep(e.retry_after)
+            else:
+                log.warning("Gave up slicing a saved model for its G-code; the queue stayed full", extra={"key": key})
+                gcode_path.unlink(missing_ok=True)
+                return
+    except BaseException:
+        gcode_path.unlink(missing_ok=True)
+        raise
+    if not _has_gcode(gcode_path):
+        return
+    await asyncio.to_thread(artifact_store.put, key, gcode_path, usage)
+    log.info("Archived G-code of a saved model", extra={"key": key})
+
+
+def build_quote(filename, usage, material, variant, infill, layer_height, nozzle_size, price_per_gram, density, backend=None):
+    grams = usage["volume_cm3"] * density
+
+    estimated_price = round(round(grams) * price_per_gram, 2)
+
+    print_time_s = usage.get("print_time_s")
+    if print_time_s and MACHINE_RATE_PER_HOUR:
+        estimated_price = round(estimated_price + print_time_s / 3600 * MACHINE_RATE_PER_HOUR, 2)
+
+    if float(layer_height) <= 0.08:
+        estimated_price *= 1.2
+
+    if float(nozzle_size) < 0.4:
+        estimated_price *= 1.2
+
+    return {
+        "file": filename,
+        "grams": round(grams, 2),
+        "price": estimated_price,
+        "material": material,
+        "variant": variant,
+        "infill": infill,
+        "layerHeight": layer_height,
+        "nozzleSize": nozzle_size,
+        "price_per_gram": price_per_gram,
+        "density": density,
+        "print_time_s": print_time_s,
+        "layers": usage.get("layers"),
+        "backend": backend.name if backend else None,
+    }
+
+
+async def quote_model(model, material, variant, infill, layer_height, nozzle_size, on_progress=None, on_provisional=None, backend=None,
+                      client=None):
+    """
+    Price a model. on_provisional(quote) gets an instant mesh-based quote while the
+    slice runs, then one from the preview backend if that finishes first.
+    """
+    backend = backend or get_backend()
+    price_per_gram, density = await lookup_price(material, variant)
+
+    def quote_from(usage, used_backend):
+        quote = build_quote(model.filename, usage, material, variant, infill, layer_height, nozzle_size, price_per_gram, density, used_backend)
+        if not is_final(used_backend):
+            quote["provisional"] = True
+        return quote
+
+    def on_estimate(estimate):
+        if on_provisional:
+            quote = build_quote(model.filename, estimate, material, variant, infill, layer_height, nozzle_size, price_per_gram, density)
+            on_provisional({**quote, "provisional": True})
+
+    preview = None
+    preview_backend = get_backend(preview=True)
+    if on_provisional and preview_backend is not backend:
+        # Prepare the mesh once, before both slices want it
+        await inspect_model(model)
+
+        async def run_preview():
+            try:
+                usage = await get_filament_usage(model, infill, layer_height, nozzle_size, backend=preview_backend, client=client)
+            except QuoteError as e:
+                log.warning("Preview slice failed: %s", e)
+                return
+            on_provisional(quote_from(usage, preview_backend))
+
+        preview = asyncio.create_task(run_preview())
+
+    try:
+        usage = await get_filament_usage(
+            model, infill, layer_height, nozzle_size, on_progress=on_progress, on_estimate=on_estimate, backend=backend, client=client
+        )
+    finally:
+        if preview is not None:
+            preview.cancel()
+    return quote_from(usage, backend)
+
+
+async def stage_quote(model, quote):
+    """
+    Keep the upload and its server-computed quote; save-model can claim both with
+    the returned token. Previews get no token (None), since they can't be ordered.
+    """
+    if quote.get("provisional"):
+        return None
+    return await asyncio.to_thread(staging.stage, model, quote)
+
+
+async def quote_options(model, options, backend=None, client=None, priority=PRIORITY_BATCH):
+    """
+    Quote one model under several parameter combinations, yielding each result
+    as soon as it is ready. Combinations that only differ in material share one
+    slice, and distinct slices run concurrently on the slicing pool, behind
+    single quotes unless given another priority.
+    """
+    backend = backend or get_backend()
+    await inspect_model(model)
+
+    usages = {}
+    prices = {}
+    for option in options:
+        key = quote_key(model.digest, option["infill"], option["layerHeight"], option["nozzleSize"], backend)
+        if key not in usages:
+            usages[key] = asyncio.create_task(
+                get_filament_usage(
+                    model, option["infill"], option["layerHeight"], option["nozzleSize"], backend=backend, client=client, priority=priority
+                )
+            )
+        material = (option["material"], option["variant"])
+        if material not in prices:
+            prices[material] = asyncio.create_task(lookup_price(*material))
+
+    async def quote_option(index, option):
+        try:
+            key = quote_key(model.digest, option["infill"], option["layerHeight"], option["nozzleSize"], backend)
+            # Shield the shared tasks so one failing option can't cancel them for the others
+            usage = await asyncio.shield(usages[key])
+            price_per_gram, density = await asyncio.shield(prices[(option["material"], option["variant"])])
+            quote = build_quote(
+                model.filename, usage, option["material"], option["variant"], option["infill"],
+                option["layerHeight"], option["nozzleSize"], price_per_gram, density, backend
+            )
+            if not is_final(backend):
+                quote["provisional"] = True
+            quote["quote_token"] = await stage_quote(model, quote)
+            return {"index": index, **quote}
+        except QuoteError as e:
+            return {"index": index, "status": e.status_code, **e.content}
+
+    pending = [asyncio.create_task(quote_option(i, option)) for i, option in enumerate(options)]
+    try:
+        for next_done in asyncio.as_completed(pending):
+            yield await next_done
+    finally:
+        # Client went away or we're done: don't leave slices running for nobody
+        for task in [*pending, *usages.values(), *prices.values()]:
+            task.cancel()
+
+
+async def quote_batch(models, material, variant, infill, layer_height, nozzle_size, price, backend=None, client=None,
+                      priority=PRIORITY_BATCH):
+    """
+    Quote the parts of an assembly with one set of print settings, yielding each
+    part as soon as it is priced together with the running total, then a last
+    {"done": true, "total": ...}. `price` is lookup_price() of the material,
+    fetched once for all parts. Identical files are sliced once and counted;
+    distinct parts slice concurrently on the slicing pool, behind single quotes.
+    """
+    backend = backend or get_backend()
+    price_per_gram, density = price
+    parts = {}
+    for model in models:
+        parts.setdefault(model.digest, []).append(model)
+
+    async def quote_part(index, copies):
+        model = copies[0]
+        part = {"index": index, "files": [copy.filename for copy in copies], "count": len(copies)}
+        try:
+            await inspect_model(model)
+            usage = await get_filament_usage(
+                model, infill, layer_height, nozzle_size, backend=backend, client=client, priority=priority
+            )
+            quote = build_quote(
+                model.filename, usage, material, variant, infill, layer_height, nozzle_size, price_per_gram, density, backend
+            )
+            if not is_final(backend):
+                quote["provisional"] = True
+            quote["quote_token"] = await stage_quote(model, quote)
+            return {**part, **quote, "subtotal": round(quote["price"] * len(copies), 2)}
+        except QuoteError as e:
+            return {**part, "status": e.status_code, **e.content}
+
+    total = {"parts": len(parts), "files": len(models), "quoted": 0, "failed": 0, "grams": 0.0, "price": 0.0}
+    pending = [asyncio.create_task(quote_part(index, copies)) for index, copies in enumerate(parts.values())]
+    try:
+        for next_done in asyncio.as_completed(pending):
+            part = await next_done
+            if "status" in part:
+                total["failed"] += 1
+            else:
+                total["quoted"] += 1
+                total["grams"] = round(total["grams"] + part["grams"] * part["count"], 2)
+                total["price"] = round(total["price"] + part["subtotal"], 2)
+            yield {**part, "total": dict(total)}
+        yield {"done": True, "total": total}
+    finally:
+        # Client went away or we're done: don't leave slices running for nobody
+        for task in pending:
+            task.cancel()
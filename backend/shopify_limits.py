@@ -0,0 +1,207 @@
+import asyncio
+import email.utils
+import hashlib
+import heapq
+import itertools
+import os
+import time
+
+# Lower runs first: prices for a customer waiting on a quote go ahead of background product creation
+PRIORITY_QUOTE = 0
+PRIORITY_BACKGROUND = 1
+
+# Shopify's standard plan limits; both are corrected from every response
+REST_BUCKET_SIZE = 40
+REST_LEAK_RATE = 2.0
+GRAPHQL_BUCKET_SIZE = 2000
+GRAPHQL_RESTORE_RATE = 100.0
+# Cost assumed for a GraphQL document until Shopify has told us what it costs
+DEFAULT_QUERY_COST = 50
+# Share of each budget background requests must leave free for quotes
+BACKGROUND_RESERVE = float(os.getenv("SHOPIFY_BACKGROUND_RESERVE", "0.25"))
+
+
+def retry_after_seconds(value, default):
+    """Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        return default
+    return max(0.0, when.timestamp() - time.time())
+
+
+class Budget:
+    """
+    Client-side model of one Shopify rate limit: `available` points refill at
+    `rate` per second up to `capacity`. Requests reserve their expected cost
+    before being sent and the model is re-synchronised from each response.
+    Waiters are served in (priority, arrival) order.
+    """
+
+    def __init__(self, name, capacity, rate):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self._available = float(capacity)
+        self._updated = time.monotonic()
+        self._queue = []
+        self._seq = itertools.count()
+        self._loop = None
+        self._changed = None
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+
+    def _condition(self):
+        # Conditions belong to one event loop; scripts and tests may run several in turn
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._changed = asyncio.Condition()
+            self._queue = []
+        return self._changed
+
+    def available(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._available
+
+    def _time_until(self, cost, priority):
+        reserve = self.capacity * BACKGROUND_RESERVE if priority > PRIORITY_QUOTE else 0
+        # Never wait for more than the bucket can hold
+        needed = min(cost + reserve, self.capacity) - self.available()
+        return max(0.0, needed / self.rate)
+
+    async def acquire(self, cost, priority):
+        entry = (priority, next(self._seq))
+        started = time.monotonic()
+        changed = self._condition()
+        async with changed:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    timeout = None
+                    if self._queue[0] == entry:
+                        timeout = self._time_until(cost, priority)
+                        if timeout == 0:
+                            heapq.heappop(self._queue)
+                            self._available -= cost
+                            break
+                    try:
+                        await asyncio.wait_for(changed.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                raise
+            finally:
+                changed.notify_all()
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.waits += 1
+            self.wait_seconds += waited
+
+    async def update(self, available=None, capacity=None, rate=None, refund=0.0):
+        """Apply what a response said about the budget, or hand back unused reserved cost."""
+        changed = self._condition()
+        async with changed:
+            self.available()
+            if capacity:
+                self.capacity = capacity
+            if rate:
+                self.rate = rate
+            if available is not None:
+                self._available = float(available)
+            else:
+                self._available = min(self.capacity, self._available + refund)
+            changed.notify_all()
+
+    async def throttle(self, retry_after=None):
+        # Shopify said we're over the limit: assume the bucket is empty (or as long as it told us to wait)
+        self.throttled += 1
+        await self.update(available=-(retry_after or 0) * self.rate)
+
+    def stats(self):
+        return {
+            "available": round(self.available(), 1),
+            "capacity": self.capacity,
+            "rate": self.rate,
+            "queued": len(self._queue),
+            "waits": self.waits,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "throttled": self.throttled,
+        }
+
+
+class ShopifyScheduler:
+    """Paces every Admin API call against the REST call limit and the GraphQL cost budget."""
+
+    def __init__(self):
+        self.rest = Budget("rest", REST_BUCKET_SIZE, REST_LEAK_RATE)
+        self.graphql = Budget("graphql", GRAPHQL_BUCKET_SIZE, GRAPHQL_RESTORE_RATE)
+        self.query_costs = {}
+
+    def _query_key(self, query):
+        return hashlib.sha1(query.encode()).hexdigest()
+
+    def estimate_cost(self, query):
+        return self.query_costs.get(self._query_key(query), DEFAULT_QUERY_COST)
+
+    async def before_rest(self, priority):
+        await self.rest.acquire(1, priority)
+
+    async def after_rest(self, response):
+        # X-Shopify-Shop-Api-Call-Limit: 32/40 means 32 of 40 slots in the bucket are used
+        limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if response.status_code == 429:
+            await self.rest.throttle(retry_after_seconds(response.headers.get("Retry-After"), 1.0))
+        elif limit and "/" in limit:
+            used, capacity = (int(part) for part in limit.split("/", 1))
+            await self.rest.update(available=capacity - used, capacity=capacity)
+
+    async def before_graphql(self, query, priority):
+        cost = self.estimate_cost(query)
+        await self.graphql.acquire(cost, priority)
+        return cost
+
+    async def after_graphql(self, query, reserved, body):
+        """Sync the budget from a GraphQL response body; returns True if the request was throttled."""
+        body = body if isinstance(body, dict) else {}
+        cost = (body.get("extensions") or {}).get("cost")
+        errors = body.get("errors")
+        throttled = isinstance(errors, list) and any(
+            isinstance(error, dict) and (error.get("extensions") or {}).get("code") == "THROTTLED"
+            for error in errors
+        )
+        if throttled:
+            self.graphql.throttled += 1
+        if cost:
+            self.query_costs[self._query_key(query)] = cost.get("requestedQueryCost") or reserved
+            status = cost.get("throttleStatus") or {}
+            await self.graphql.update(
+                available=status.get("currentlyAvailable"),
+                capacity=status.get("maximumAvailable"),
+                rate=status.get("restoreRate"),
+            )
+        elif throttled:
+            await self.graphql.update(available=0)
+        else:
+            # No cost information (e.g. an error page): give the reservation back
+            await self.graphql.update(refund=reserved)
+        return throttled
+
+    def stats(self):
+        return {"rest": self.rest.stats(), "graphql": self.graphql.stats()}
+
+
+shopify_scheduler = ShopifyScheduler()
@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import hashlib
+import itertools
+import math
+import os
+import time
+
+import metrics
+
+# uvicorn's --workers default; each worker process gets its share of the cores for slicing
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+SLICE_CONCURRENCY = int(os.getenv("SLICE_CONCURRENCY", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+SLICE_QUEUE_SIZE = int(os.getenv("SLICE_QUEUE_SIZE", "16"))
+# Assumed slice duration until we've measured a few real ones
+DEFAULT_SLICE_SECONDS = 20.0
+
+# Cost model for a slice, in seconds of PrusaSlicer on one core; the pool rescales it by what it measures
+SLICE_COST_BASE_SECONDS = float(os.getenv("SLICE_COST_BASE_SECONDS", "1.0"))
+SLICE_COST_PER_MTRI = float(os.getenv("SLICE_COST_PER_MTRI", "8.0"))
+SLICE_COST_PER_LAYER = float(os.getenv("SLICE_COST_PER_LAYER", "0.01"))
+SLICE_COST_PER_CM3 = float(os.getenv("SLICE_COST_PER_CM3", "0.02"))
+
+# Most of the workers one client (email, or IP without one) may hold while others wait
+SLICE_CLIENT_SHARE = float(os.getenv("SLICE_CLIENT_SHARE", "0.5"))
+# A queued job counts as this many seconds shorter for every second it has waited, so big jobs still run
+SLICE_AGING_RATE = float(os.getenv("SLICE_AGING_RATE", "0.5"))
+# Batch jobs waiting this long compete with interactive ones
+SLICE_BATCH_PROMOTE_SECONDS = float(os.getenv("SLICE_BATCH_PROMOTE_SECONDS", "60"))
+RECENT_DECISIONS = 50
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+
+def estimate_slice_cost(triangles, volume_mm3, height_mm, layer_height):
+    """Rough slicing time in seconds from mesh statistics, before the pool's calibration."""
+    layers = height_mm / layer_height if layer_height > 0 else 0
+    return (
+        SLICE_COST_BASE_SECONDS
+        + triangles / 1e6 * SLICE_COST_PER_MTRI
+        + layers * SLICE_COST_PER_LAYER
+        + volume_mm3 / 1000 * SLICE_COST_PER_CM3
+    )
+
+
+class SlicerBusy(Exception):
+    """Raised when the wait queue is full; retry_after is a whole number of seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Slicer is busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class SliceJob:
+    """A caller waiting for, or holding, a slot in the pool."""
+
+    def __init__(self, seq, client, priority, cost, estimate, future):
+        self.seq = seq
+        self.client = client
+        self.priority = priority
+        self.cost = cost  # uncalibrated estimate, None when the mesh wasn't analysed
+        self.estimate = estimate  # calibrated seconds
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.decision = None
+
+
+class SlicePool:
+    """
+    Bounded executor for slicing jobs. At most `workers` jobs run at once, at most
+    `max_queue` wait for a slot, and anything beyond that is rejected immediately
+    with a Retry-After estimate instead of piling up on the event loop.
+
+    Free slots go to waiting jobs by, in order: interactive before batch, the
+    client with the fewest running jobs, the shortest estimated job (less what
+    it has already waited), then arrival. While others are waiting, a client
+    can't hold more than SLICE_CLIENT_SHARE of the workers.
+    """
+
+    def __init__(self, workers=SLICE_CONCURRENCY, max_queue=SLICE_QUEUE_SIZE, client_share=SLICE_CLIENT_SHARE):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.client_share = client_share
+        self.client_limit = max(1, math.ceil(self.workers * client_share))
+        self.running = 0
+        self._waiters = []
+        self._running_by_client = collections.Counter()
+        self._seq = itertools.count()
+        self.decisions = collections.deque(maxlen=RECENT_DECISIONS)
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0  # running jobs whose caller gave up
+        self.abandoned = 0  # callers that gave up while still queued
+        self.timed_out = 0
+        self.reordered = 0  # jobs started ahead of one that arrived earlier
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+        self.avg_run = None  # exponentially weighted, seconds
+        # Measured over estimated run time, exponentially weighted; scales the cost model to this machine
+        self.calibration = 1.0
+        self.estimated_jobs = 0
+        self.estimate_error = 0.0  # summed |actual - estimate| / actual
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def resize(self, workers):
+        """Change the number of slots, e.g. as remote slicing nodes come and go; running jobs are left alone."""
+        self.workers = max(1, workers)
+        self.client_limit = max(1, math.ceil(self.workers * self.client_share))
+        self._dispatch()
+
+    def estimate(self, cost):
+        if cost is None:
+            return self.avg_run or DEFAULT_SLICE_SECONDS
+        return cost * self.calibration
+
+    def retry_after(self, estimate=None):
+        queued = sum(self.estimate(job.cost) for job in self._waiters) + (estimate or self.avg_run or DEFAULT_SLICE_SECONDS)
+        return max(1, math.ceil(queued / self.workers))
+
+    async def run(self, fn, *args, cost=None, client=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Run `await fn(*args, **kwargs)` in a slot. `cost` is estimate_slice_cost()
+        of the job, `client` who it's for and `priority` PRIORITY_INTERACTIVE or
+        PRIORITY_BATCH; all three only affect the order jobs start in.
+        """
+        job = SliceJob(next(self._seq), client, priority, cost, self.estimate(cost), asyncio.get_running_loop().create_future())
+        await self._acquire(job)
+        started_at = time.monotonic()
+        wait = started_at - job.enqueued_at
+        metrics.observe_stage("slice_queue", wait)
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        outcome = "failed"
+        try:
+            result = await fn(*args, **kwargs)
+            self.completed += 1
+            outcome = "completed"
+            return result
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            outcome = "cancelled"
+            raise
+        except TimeoutError:
+            self.timed_out += 1
+            self.failed += 1
+            outcome = "timed_out"
+            raise
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started_at
+            self.total_run += elapsed
+            self.avg_run = elapsed if self.avg_run is None else 0.8 * self.avg_run + 0.2 * elapsed
+            if outcome == "completed":
+                self._calibrate(job, elapsed)
+            job.decision.update(outcome=outcome, actual_s=round(elapsed, 3))
+            self._release(job)
+
+    def _calibrate(self, job, elapsed):
+        if job.cost is None or elapsed <= 0:
+            return
+        metrics.SLICE_ESTIMATE_RATIO.observe(elapsed / job.estimate)
+        self.estimated_jobs += 1
+        self.estimate_error += abs(elapsed - job.estimate) / elapsed
+        self.calibration = 0.8 * self.calibration + 0.2 * (elapsed / job.cost)
+
+    async def _acquire(self, job):
+        self._waiters.append(job)
+        self._dispatch()
+        if job.future.done():
+            return
+        if len(self._waiters) > self.max_queue:
+            self._waiters.remove(job)
+            self.rejected += 1
+            raise SlicerBusy(self.retry_after(job.estimate))
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled():
+                # The slot was handed to us just before we were cancelled
+                self._release(job)
+            elif job in self._waiters:
+                self._waiters.remove(job)
+            self.abandoned += 1
+            raise
+
+    def _eligible(self, job):
+        # A client at its limit only gets a slot that leaves one free for somebody else
+        if self._running_by_client[job.client] < self.client_limit:
+            return True
+        return self.workers - self.running > 1
+
+    def _rank(self, job, now):
+        waited = now - job.enqueued_at
+        priority = PRIORITY_INTERACTIVE if waited >= SLICE_BATCH_PROMOTE_SECONDS else job.priority
+        # Re-estimated with the current calibration; job.estimate is kept as it was when the job arrived
+        return priority, self._running_by_client[job.client], self.estimate(job.cost) - waited * SLICE_AGING_RATE, job.seq
+
+    def _dispatch(self):
+        now = time.monotonic()
+        # Waiters cancelled since the last dispatch haven't removed themselves yet
+        self._waiters = [job for job in self._waiters if not job.future.done()]
+        while self.running < self.workers:
+            candidates = [job for job in self._waiters if self._eligible(job)]
+            if not candidates:
+                return
+            job = min(candidates, key=lambda job: self._rank(job, now))
+            self._waiters.remove(job)
+            self._start(job, now)
+
+    def _start(self, job, now):
+        self.running += 1
+        self._running_by_client[job.client] += 1
+        overtook = sum(1 for other in self._waiters if other.seq < job.seq)
+        if overtook:
+            self.reordered += 1
+        job.decision = {
+            "client": client_tag(job.client),
+            "priority": PRIORITY_NAMES.get(job.priority, str(job.priority)),
+            "estimated_s": round(job.estimate, 3),
+            "waited_s": round(now - job.enqueued_at, 3),
+            "overtook": overtook,
+            "queued": len(self._waiters),
+        }
+        self.decisions.append(job.decision)
+        job.future.set_result(None)
+
+    def _release(self, job):
+        self.running -= 1
+        self._running_by_client[job.client] -= 1
+        if self._running_by_client[job.client] <= 0:
+            del self._running_by_client[job.client]
+        self._dispatch()
+
+    def queue(self):
+        """The waiting jobs in the order they would start now."""
+        now = time.monotonic()
+        return [
+            {
+                "client": client_tag(job.client),
+                "priority": PRIORITY_NAMES.get(job.priority, str(job.priority)),
+                "estimated_s": round(job.estimate, 3),
+                "waited_s": round(now - job.enqueued_at, 3),
+            }
+            for job in sorted(self._waiters, key=lambda job: self._rank(job, now))
+        ]
+
+    def stats(self):
+        finished = self.completed + self.failed + self.cancelled
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "client_limit": self.client_limit,
+            "running": self.running,
+            "queued": self.queued,
+            "clients_running": len(self._running_by_client),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+            "abandoned": self.abandoned,
+            "timed_out": self.timed_out,
+            "reordered": self.reordered,
+            "avg_wait_seconds": round(self.total_wait / finished, 3) if finished else 0.0,
+            "max_wait_seconds": round(self.max_wait, 3),
+            "avg_run_seconds": round(self.total_run / finished, 3) if finished else 0.0,
+            "estimate_calibration": round(self.calibration, 3),
+            "mean_estimate_error": round(self.estimate_error / self.estimated_jobs, 3) if self.estimated_jobs else None,
+            "retry_after_estimate": self.retry_after(),
+        }
+
+
+def client_tag(client):
+    # Emails and IPs stay out of stats and logs; a short hash still tells clients apart
+    if client is None:
+        return None
+    return hashlib.sha256(client.encode()).hexdigest()[:8]
+
+
+slice_pool = SlicePool()
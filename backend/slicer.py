@@ -1,57 +1,488 @@
-import subprocess
+import asyncio
+import json
+import logging
 import tempfile
 import os
 import re
+import math
+import shutil
+import signal
+import time
+from pathlib import Path
 
-def slice_model(stl_path, infill_density=20, layer_height=0.2, nozzle_diameter=0.4, filament_density=1.24):
-    # Check if we're in development mode (no prusa-slicer available)
-    import shutil
-    if not shutil.which("prusa-slicer"):
-        print("⚠️  DEV MODE: PrusaSlicer not found, using mock weight calculation")
-        # Mock calculation for development: estimate weight based on file size and infill
+import metrics
+from gcode import read_gcode_stats
+
+FILAMENT_DIAMETER = 1.75  # mm
+# PrusaSlicer's CLI prints slicing status as "<percent> => <message>"
+PROGRESS_RE = re.compile(r"^\s*(\d{1,3}) => (.*)$")
+# A pathological mesh must not hold a slicer slot (or eat the machine's memory) forever
+SLICE_TIMEOUT_SECONDS = float(os.getenv("SLICE_TIMEOUT_SECONDS", "300"))
+# Opt-in cap on a slicer's heap, 0 for none. PrusaSlicer gets it as RLIMIT_DATA (set by util-linux
+# prlimit before exec): unlike RLIMIT_AS it ignores the AppImage mount and reserved address space
+SLICE_MEMORY_LIMIT_MB = int(os.getenv("SLICE_MEMORY_LIMIT_MB", "0"))
+PRLIMIT_BIN = shutil.which("prlimit")
+# A path or a name on PATH; benchmarks point this at bench/fake_slicer.py
+PRUSA_SLICER_BIN = os.getenv("PRUSA_SLICER_BIN", "prusa-slicer")
+# Which backend prices orderable quotes, and which one answers previews
+SLICE_BACKEND = os.getenv("SLICE_BACKEND", "prusa")
+PREVIEW_SLICE_BACKEND = os.getenv("PREVIEW_SLICE_BACKEND", "kiri")
+
+NODE_BIN = os.getenv("NODE_BIN", "node")
+KIRI_ROOT = Path(os.getenv("KIRI_ROOT", Path(__file__).resolve().parent.parent / "slicer"))
+KIRI_WORKER_SCRIPT = KIRI_ROOT / "src" / "kiri-run" / "quote-worker.js"
+KIRI_WORKERS = int(os.getenv("KIRI_WORKERS", "2"))
+KIRI_WORKER_MAX_JOBS = int(os.getenv("KIRI_WORKER_MAX_JOBS", "200"))
+KIRI_STARTUP_TIMEOUT_SECONDS = 30
+KIRI_LINE_LIMIT = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+class SliceTimeout(TimeoutError):
+    def __init__(self, seconds):
+        super().__init__(f"Slicing took longer than {seconds:g}s")
+        self.seconds = seconds
+
+
+class SliceOutOfMemory(RuntimeError):
+    """The slicer needed more memory than SLICE_MEMORY_LIMIT_MB (or the machine) allows."""
+
+
+def filament_length_for_volume(volume_cm3):
+    cross_section_mm2 = math.pi * (FILAMENT_DIAMETER / 2) ** 2
+    return volume_cm3 * 1000 / cross_section_mm2
+
+
+async def slice_filament(stl_path, infill_density=20, layer_height=0.2, nozzle_diameter=0.4, on_progress=None, backend=None):
+    """
+    Slice the model and return its filament usage as {"volume_cm3", "length_mm"},
+    plus print time, layer count and support flag from the G-code footer when sliced.
+    Usage doesn't depend on the material, so callers convert to grams with the filament density.
+    on_progress(percent, message) is called as the slicer reports progress.
+    `backend` is a SliceBackend or its name; the SLICE_BACKEND policy applies when omitted.
+    """
+    if not isinstance(backend, SliceBackend):
+        backend = get_backend(backend)
+    return await backend.slice(stl_path, infill_density, layer_height, nozzle_diameter, on_progress)
+
+
+class SliceBackend:
+    """Something that turns an STL and FDM settings into filament usage."""
+
+    name = None
+    # True when the backend limits its own concurrency instead of running on the slice pool
+    bounded = False
+    # True when slice() can leave the G-code at `gcode_path` for the artifact archive
+    gcode = False
+
+    def available(self):
+        return True
+
+    async def warm(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def slice(self, stl_path, infill_density, layer_height, nozzle_diameter, on_progress=None, gcode_path=None):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"available": self.available()}
+
+
+class PrusaSlicerBackend(SliceBackend):
+    """One prusa-slicer process per slice, reading the usage back from the G-code it writes."""
+
+    name = "prusa"
+    gcode = True
+
+    def __init__(self):
+        self._binary = None  # PRUSA_SLICER_BIN resolved on PATH, "" when missing
+
+    @property
+    def binary(self):
+        # Looked up once per process rather than before every slice; restart after installing it
+        if self._binary is None:
+            self._binary = shutil.which(PRUSA_SLICER_BIN) or ""
+        return self._binary or None
+
+    def available(self):
+        return self.binary is not None
+
+    async def warm(self):
+        if not self.available():
+            log.warning("PrusaSlicer not found, quotes will be estimated from the mesh", extra={"binary": PRUSA_SLICER_BIN})
+        if SLICE_MEMORY_LIMIT_MB > 0 and PRLIMIT_BIN is None:
+            log.warning("prlimit not found, slices run without SLICE_MEMORY_LIMIT_MB")
+
+    async def slice(self, stl_path, infill_density, layer_height, nozzle_diameter, on_progress=None, gcode_path=None):
+        if on_progress:
+            on_progress(0, "Starting slicer")
+
+        # Check if we're in development mode (no prusa-slicer available)
+        if not self.available():
+            log.warning("DEV MODE: PrusaSlicer not found, estimating filament usage from the mesh")
+            try:
+                usage = await asyncio.to_thread(_estimate_from_mesh, stl_path, infill_density, nozzle_diameter)
+                log.info("Mesh estimate", extra={"volume_cm3": round(usage["volume_cm3"], 2)})
+                return usage
+            except Exception as e:
+                log.error("Mesh estimate failed: %s", e)
+                volume_cm3 = 25.0 / 1.24  # Default fallback: 25g of PLA
+                return {"volume_cm3": volume_cm3, "length_mm": filament_length_for_volume(volume_cm3)}
+
+        # Production mode: use actual PrusaSlicer
+        with tempfile.TemporaryDirectory() as tempdir:
+            # Written where the caller wants to keep it, if anywhere
+            gcode_path = str(gcode_path or os.path.join(tempdir, "output.gcode"))
+
+            cmd = [
+                self.binary, "-g", stl_path,
+                "--output", gcode_path,
+                f"--layer-height={layer_height}",
+                f"--fill-density={min(infill_density, 99)}%",
+                f"--filament-diameter={FILAMENT_DIAMETER}",
+                "--support-material=1",
+                "--support-material-style=organic",
+                "--support-material-angle=30",
+                "--support-material-extruder=0",
+                "--support-material-interface-extruder=0",
+                "--fill-pattern=gyroid",
+                f"--nozzle-diameter={nozzle_diameter}",
+                f"--first-layer-height={layer_height}",
+            ]
+
+            # Run the slicer without blocking the event loop, in its own process group
+            # so it can be killed together with anything it spawns
+            proc = await asyncio.create_subprocess_exec(
+                *_memory_limited(cmd), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            try:
+                stderr = await asyncio.wait_for(_communicate(proc, on_progress), SLICE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                await _kill(proc)
+                raise SliceTimeout(SLICE_TIMEOUT_SECONDS)
+            except BaseException:
+                # Cancelled: the client went away or asked for a different quote
+                await _kill(proc)
+                raise
+
+            if proc.returncode != 0:
+                message = stderr.decode(errors="replace")
+                if "bad_alloc" in message:
+                    # Not the model's fault, so not reported as an invalid file
+                    raise SliceOutOfMemory(f"Slicer ran out of memory: {message[-500:]}")
+                raise RuntimeError(f"Slicer error: {message}")
+
+            with metrics.span("gcode_parse"):
+                return await asyncio.to_thread(_read_filament_usage, gcode_path)
+
+
+class KiriWorkerError(RuntimeError):
+    """The Node worker died or answered with something other than the protocol."""
+
+
+class _KiriWorker:
+    """One Node process running slicer/src/kiri-run/quote-worker.js; slices one model at a time."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.jobs = 0
+
+    @classmethod
+    async def start(cls):
+        proc = await asyncio.create_subprocess_exec(
+            # RLIMIT_AS would break V8's address space reservations, so cap the heap instead
+            NODE_BIN, *_node_memory_flags(), str(KIRI_WORKER_SCRIPT), cwd=str(KIRI_ROOT),
+            env={**os.environ, "KIRI_ROOT": str(KIRI_ROOT)},
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            # Engine logs go straight to our stderr
+            start_new_session=True, limit=KIRI_LINE_LIMIT,
+        )
+        worker = cls(proc)
+        try:
+            hello = await asyncio.wait_for(worker._read_message(), KIRI_STARTUP_TIMEOUT_SECONDS)
+        except BaseException:
+            await worker.kill()
+            raise
+        if not hello.get("ready"):
+            await worker.kill()
+            raise KiriWorkerError(f"Kiri worker failed to start: {hello.get('error')}")
+        log.info("Started Kiri worker", extra={"pid": proc.pid, "engine": hello.get("version")})
+        return worker
+
+    @property
+    def alive(self):
+        return self.proc.returncode is None
+
+    async def _read_message(self):
+        line = await self.proc.stdout.readline()
+        if not line:
+            raise KiriWorkerError(f"Kiri worker {self.proc.pid} exited")
         try:
-            file_size_mb = os.path.getsize(stl_path) / (1024 * 1024)  # File size in MB
-            base_weight = file_size_mb * 10  # Rough estimate: 10g per MB
-            infill_multiplier = (infill_density / 100) * 0.7 + 0.3  # 30% base + 70% infill
-            estimated_weight = base_weight * infill_multiplier * (filament_density / 1.24)
-            print(f"📊 Mock calculation: {file_size_mb:.2f}MB file → {estimated_weight:.2f}g estimated weight")
-            return max(1.0, estimated_weight)  # Minimum 1g
-        except Exception as e:
-            print(f"❌ Mock calculation failed: {e}")
-            return 25.0  # Default fallback weight
-    
-    # Production mode: use actual PrusaSlicer
-    with tempfile.TemporaryDirectory() as tempdir:
-        gcode_path = os.path.join(tempdir, "output.gcode")
-
-        cmd = [
-            "prusa-slicer", "-g", stl_path,
-            "--output", gcode_path,
-            f"--layer-height={layer_height}",
-            f"--fill-density={min(infill_density, 99)}%",
-            "--filament-diameter=1.75",
-            f"--filament-density={filament_density}",
-            "--support-material=1",
-            "--support-material-style=organic",
-            "--support-material-angle=30",
-            "--support-material-extruder=0",
-            "--support-material-interface-extruder=0",
-            "--fill-pattern=gyroid",
-            f"--nozzle-diameter={nozzle_diameter}",
-            f"--first-layer-height={layer_height}",
-        ]
-
-        result = subprocess.run(cmd, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            raise RuntimeError(f"Slicer error: {result.stderr}")
-
-        # Extract weight from the G-code
-        with open(gcode_path, "r") as f:
-            for line in f:
-                if "total filament used [g]" in line:
-                    match = re.search(r"([\d.]+)", line)
-                    if match:
-                        return float(match.group(1))
-
-        raise ValueError("Could not extract filament weight from G-code.")
\ No newline at end of file
+            return json.loads(line)
+        except json.JSONDecodeError:
+            raise KiriWorkerError(f"Unexpected output from Kiri worker: {line[:200]!r}")
+
+    async def slice(self, stl, infill_density, layer_height, nozzle_diameter, on_progress):
+        self.jobs += 1
+        job_id = self.jobs
+        header = {"id": job_id, "bytes": len(stl), "infill": infill_density, "layer_height": layer_height, "nozzle": nozzle_diameter}
+        self.proc.stdin.write(json.dumps(header).encode() + b"\n")
+        self.proc.stdin.write(stl)
+        await self.proc.stdin.drain()
+        while True:
+            message = await self._read_message()
+            if message.get("id") != job_id:
+                raise KiriWorkerError(f"Kiri worker answered job {message.get('id')} while running {job_id}")
+            if "progress" in message:
+                if on_progress:
+                    on_progress(message["progress"], "Slicing")
+                continue
+            if "error" in message:
+                raise RuntimeError(f"Slicer error: {message['error']}")
+            return message
+
+    async def kill(self):
+        await _kill(self.proc)
+
+
+class KiriBackend(SliceBackend):
+    """
+    Kiri:Moto's FDM engine in a pool of long-lived Node processes. Models are
+    piped over stdin, so a slice pays neither process startup nor G-code on
+    disk. Much faster than PrusaSlicer but less exact, which suits previews.
+    """
+
+    name = "kiri"
+    bounded = True
+
+    def __init__(self, workers=KIRI_WORKERS):
+        self.size = max(1, workers)
+        self._idle = []
+        self._started = 0  # processes alive or starting
+        self._available = None
+        self._condition = None
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+
+    def available(self):
+        if self._available is None:
+            self._available = shutil.which(NODE_BIN) is not None and KIRI_WORKER_SCRIPT.exists()
+        return self._available
+
+    async def slice(self, stl_path, infill_density, layer_height, nozzle_diameter, on_progress=None, gcode_path=None):
+        if on_progress:
+            on_progress(0, "Starting slicer")
+        stl = await asyncio.to_thread(Path(stl_path).read_bytes)
+        with metrics.span("kiri_checkout"):
+            worker = await self._checkout()
+        try:
+            with metrics.span("kiri_slicing"):
+                result = await asyncio.wait_for(
+                    worker.slice(stl, infill_density, layer_height, nozzle_diameter, on_progress), SLICE_TIMEOUT_SECONDS
+                )
+        except asyncio.TimeoutError:
+            self.failed += 1
+            await self._discard(worker)
+            raise SliceTimeout(SLICE_TIMEOUT_SECONDS)
+        except KiriWorkerError:
+            self.failed += 1
+            await self._discard(worker)
+            raise
+        except RuntimeError:
+            # The engine rejected this model; the worker itself is fine
+            self.failed += 1
+            await self._checkin(worker)
+            raise
+        except BaseException:
+            # Cancelled mid-slice: the engine can't be interrupted, so the process goes
+            await self._discard(worker)
+            raise
+        self.completed += 1
+        await self._checkin(worker)
+
+        length_mm = result["filament_mm"]
+        return {
+            "volume_cm3": length_mm * math.pi * (FILAMENT_DIAMETER / 2) ** 2 / 1000,
+            "length_mm": length_mm,
+            "print_time_s": result.get("print_time_s"),
+            "layers": result.get("layers"),
+        }
+
+    async def warm(self):
+        """Start the whole pool now so the first previews don't wait for the engine to load."""
+        if not self.available():
+            return
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        missing = self.size - self._started
+        self._started += missing
+        results = await asyncio.gather(*(_KiriWorker.start() for _ in range(missing)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                self._started -= 1
+                if isinstance(result, KiriWorkerError):
+                    self._disable(result)
+                else:
+                    log.error("Failed to start Kiri worker: %s", result)
+            else:
+                self._idle.append(result)
+        await self._notify()
+
+    async def _checkout(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            while not self._idle and self._started >= self.size:
+                await self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return await _KiriWorker.start()
+        except BaseException as e:
+            if isinstance(e, KiriWorkerError):
+                self._disable(e)
+            async with self._condition:
+                self._started -= 1
+                self._condition.notify()
+            raise
+
+    def _disable(self, error):
+        # An engine that can't load (e.g. the slicer's npm setup never ran) won't load next time either
+        if self._available:
+            log.error("Disabling the Kiri backend: %s", error)
+        self._available = False
+
+    async def _checkin(self, worker):
+        if not worker.alive or worker.jobs >= KIRI_WORKER_MAX_JOBS:
+            # Recycled now and then in case the engine holds on to memory between models
+            await self._discard(worker)
+            return
+        self._idle.append(worker)
+        await self._notify()
+
+    async def _discard(self, worker):
+        self.restarts += 1
+        self._started -= 1
+        await self._notify()
+        await worker.kill()
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify()
+
+    async def close(self):
+        workers, self._idle = self._idle, []
+        for worker in workers:
+            await worker.kill()
+            self._started -= 1
+
+    def stats(self):
+        return {
+            "available": self.available(),
+            "workers": self.size,
+            "started": self._started,
+            "idle": len(self._idle),
+            "completed": self.completed,
+            "failed": self.failed,
+            "restarts": self.restarts,
+        }
+
+
+backends = {backend.name: backend for backend in (PrusaSlicerBackend(), KiriBackend())}
+
+
+def get_backend(name=None, preview=False):
+    """
+    The backend called `name`, or the policy's choice: PREVIEW_SLICE_BACKEND for
+    previews, SLICE_BACKEND for quotes customers can order from. A preview
+    backend that can't run here falls back to the quoting one.
+    """
+    if name is None:
+        name = PREVIEW_SLICE_BACKEND if preview else SLICE_BACKEND
+        if preview and not backends[name].available():
+            name = SLICE_BACKEND
+    try:
+        return backends[name]
+    except KeyError:
+        raise ValueError(f"Unknown slicer backend {name!r}; expected one of {', '.join(backends)}")
+
+
+def backend_stats():
+    return {
+        "policy": {"quote": SLICE_BACKEND, "preview": PREVIEW_SLICE_BACKEND},
+        **{name: backend.stats() for name, backend in backends.items()},
+    }
+
+
+async def warm_backends():
+    for backend in backends.values():
+        await backend.warm()
+
+
+async def close_backends():
+    for backend in backends.values():
+        await backend.close()
+
+
+async def _communicate(proc, on_progress):
+    # Startup (loading the binary, config and mesh) lasts until PrusaSlicer reports its first step
+    started = time.perf_counter()
+    slicing_since = None
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    try:
+        async for raw_line in proc.stdout:
+            if slicing_since is None:
+                slicing_since = time.perf_counter()
+                metrics.observe_stage("slicer_startup", slicing_since - started)
+            match = PROGRESS_RE.match(raw_line.decode(errors="replace"))
+            if match and on_progress:
+                on_progress(min(int(match.group(1)), 99), match.group(2).strip())
+        stderr = await stderr_task
+    finally:
+        stderr_task.cancel()
+    await proc.wait()
+    if slicing_since is not None:
+        metrics.observe_stage("slicing", time.perf_counter() - slicing_since)
+    return stderr
+
+
+def _memory_limited(cmd):
+    # prlimit sets the limit in the child before exec; a preexec_fn isn't safe with threads running
+    if SLICE_MEMORY_LIMIT_MB <= 0 or PRLIMIT_BIN is None:
+        return cmd
+    return [PRLIMIT_BIN, f"--data={SLICE_MEMORY_LIMIT_MB * 1024 * 1024}", "--", *cmd]
+
+
+def _node_memory_flags():
+    return [f"--max-old-space-size={SLICE_MEMORY_LIMIT_MB}"] if SLICE_MEMORY_LIMIT_MB > 0 else []
+
+
+async def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+def _estimate_from_mesh(stl_path, infill_density, nozzle_diameter):
+    from mesh import analyse_stl, estimate_filament
+    return estimate_filament(analyse_stl(stl_path), infill_density=infill_density, nozzle_diameter=nozzle_diameter)
+
+
+def _read_filament_usage(gcode_path):
+    stats = read_gcode_stats(gcode_path)
+    if stats["volume_cm3"] is None:
+        raise ValueError("Could not extract filament usage from G-code.")
+    if stats["length_mm"] is None:
+        stats["length_mm"] = filament_length_for_volume(stats["volume_cm3"])
+    # Grams depend on the material, which callers apply themselves
+    del stats["grams"]
+    return stats
@@ -0,0 +1,99 @@
+import json
+import os
+import secrets
+import shutil
+import time
+from pathlib import Path
+
+from db import Database
+
+# Quoted uploads wait here, keyed by content hash, until save-model claims them
+STAGING_DIR = Path(os.getenv("STAGING_DIR", "staging"))
+STAGING_TTL = int(os.getenv("STAGING_TTL", str(24 * 3600)))
+
+
+class StagedQuote:
+    def __init__(self, token, path, filename, quote):
+        self.token = token
+        self.path = path
+        self.filename = filename
+        self.quote = quote
+
+
+class Staging:
+    """
+    Keeps quoted uploads so save-model can reuse them: get-quote stages the file
+    and its server-computed quote under a random token, save-model claims it.
+    Files are stored once per digest; tokens (and then their files) expire after `ttl`.
+    Identical quote jobs share one token, so claiming a token doesn't consume it.
+    """
+
+    def __init__(self, directory=STAGING_DIR, ttl=STAGING_TTL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.db = Database(self.directory / "tokens.sqlite3")
+        with self.db.transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tokens (
+                    token TEXT PRIMARY KEY,
+                    blob TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    quote TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at)")
+
+    def stage_file(self, model):
+        """Move (or copy) an upload into staging under its digest and return the blob name."""
+        blob = model.digest + model.path.suffix.lower()
+        target = self.directory / blob
+        if target.exists():
+            # Refresh the timestamp so the sweeper keeps it as long as its newest token
+            os.utime(target)
+        else:
+            tmp = target.with_name(f"{blob}.{secrets.token_hex(4)}.tmp")
+            shutil.copyfile(model.path, tmp)
+            os.replace(tmp, target)
+        return blob
+
+    def issue(self, blob, filename, quote):
+        token = secrets.token_urlsafe(24)
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO tokens VALUES (?, ?, ?, ?, ?)",
+                (token, blob, filename or blob, json.dumps(quote), time.time() + self.ttl),
+            )
+        return token
+
+    def stage(self, model, quote):
+        return self.issue(self.stage_file(model), model.filename, quote)
+
+    def get(self, token):
+        with self.db.read() as conn:
+            row = conn.execute(
+                "SELECT blob, filename, quote FROM tokens WHERE token = ? AND expires_at > ?",
+                (token, time.time()),
+            ).fetchone()
+        if row is None or not (self.directory / row[0]).exists():
+            return None
+        return StagedQuote(token, self.directory / row[0], row[1], json.loads(row[2]))
+
+    def sweep(self):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM tokens WHERE expires_at <= ?", (now,))
+            referenced = {row[0] for row in conn.execute("SELECT DISTINCT blob FROM tokens")}
+        removed = 0
+        for path in self.directory.iterdir():
+            if path.name.startswith("tokens.sqlite3") or path.name in referenced:
+                continue
+            # Leave files alone that a request may be staging right now
+            if path.stat().st_mtime < now - 3600:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+
+staging = Staging()
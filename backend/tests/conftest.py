@@ -0,0 +1,58 @@
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+# The backend's modules open their databases and directories relative to the working
+# directory when imported, so tests run from a scratch one
+os.environ.setdefault("SHOPIFY_TOKEN", "test")
+os.chdir(tempfile.mkdtemp(prefix="backend-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def cube_stl(size=10.0):
+    """A binary STL of an axis-aligned cube."""
+    s = size
+    v = [(0, 0, 0), (s, 0, 0), (s, s, 0), (0, s, 0), (0, 0, s), (s, 0, s), (s, s, s), (0, s, s)]
+    faces = [(0, 2, 1), (0, 3, 2), (4, 5, 6), (4, 6, 7), (0, 1, 5), (0, 5, 4),
+             (1, 2, 6), (1, 6, 5), (2, 3, 7), (2, 7, 6), (3, 0, 4), (3, 4, 7)]
+    out = bytearray(80) + struct.pack("<I", len(faces))
+    for face in faces:
+        out += struct.pack("<3f", 0, 0, 0)
+        for i in face:
+            out += struct.pack("<3f", *v[i])
+        out += b"\0\0"
+    return bytes(out)
+
+
+def large_stl(path, divisions=130, size=40.0):
+    """A binary STL of a closed cube with each face split into a grid, 12 * divisions**2 triangles."""
+    step = size / divisions
+    grid = np.stack(np.meshgrid(np.arange(divisions), np.arange(divisions), indexing="ij"), -1).reshape(-1, 2) * step
+    corners = np.array([[0, 0], [step, 0], [step, step], [0, step]])
+    quads = grid[:, None, :] + corners  # (n, 4, 2) in face coordinates
+    faces = []
+    for axis in range(3):
+        u, v = [a for a in range(3) if a != axis]
+        for side in (0.0, size):
+            points = np.zeros(quads.shape[:2] + (3,))
+            points[..., u], points[..., v], points[..., axis] = quads[..., 0], quads[..., 1], side
+            # Wound counter-clockwise seen from outside, so the volume comes out right
+            outward = (side > 0) == (axis != 1)
+            faces += [points[:, [0, 1, 2]], points[:, [0, 2, 3]]] if outward else [points[:, [0, 2, 1]], points[:, [0, 3, 2]]]
+    triangles = np.concatenate(faces)
+    records = np.zeros(len(triangles), dtype=[("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attr", "<u2")])
+    records["vertices"] = triangles
+    with open(path, "wb") as f:
+        f.write(bytes(80) + struct.pack("<I", len(triangles)))
+        f.write(records.tobytes())
+
+
+@pytest.fixture
+def stl_path(tmp_path):
+    path = tmp_path / "cube.stl"
+    path.write_bytes(cube_stl())
+    return path
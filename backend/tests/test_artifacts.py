@@ -0,0 +1,67 @@
+import pytest
+
+from artifacts import RangeNotSatisfiable, artifact_store, byte_range
+from blobstore import model_manifest
+
+GCODE = b"".join(b"G1 X%d Y%d E0.05\n" % (n, n) for n in range(1000))
+
+
+def test_byte_range():
+    size = len(GCODE)
+    assert byte_range("bytes=0-99", size) == (0, 99)
+    assert byte_range("bytes=-100", size) == (size - 100, size - 1)
+    assert byte_range("bytes=100-", size) == (100, size - 1)
+    # Several ranges are answered with the whole file
+    assert byte_range("bytes=0-9, 20-29", size) is None
+    with pytest.raises(RangeNotSatisfiable):
+        byte_range(f"bytes={size}-", size)
+
+
+def test_read_decompresses_just_the_range(tmp_path):
+    gcode = tmp_path / "part.gcode"
+    gcode.write_bytes(GCODE)
+    digest, _ = artifact_store.put("range-read", gcode, {})
+
+    assert b"".join(artifact_store.read(digest, 0, 99)) == GCODE[:100]
+    assert b"".join(artifact_store.read(digest, len(GCODE) - 100, len(GCODE) - 1)) == GCODE[-100:]
+
+
+@pytest.fixture
+def order_with_gcode(tmp_path):
+    gcode = tmp_path / "order.gcode"
+    gcode.write_bytes(GCODE)
+    artifact_store.put("range-order", gcode, {})
+    model_id = model_manifest.add("customer", "Part", "part.stl", "0" * 64, 1, "range-order-id", gcode_key="range-order")
+    yield "range-order-id"
+    model_manifest.remove(model_id)
+
+
+@pytest.fixture
+def client():
+    pytest.importorskip("PIL")  # main renders thumbnails with Pillow
+    from fastapi.testclient import TestClient
+
+    import main
+
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("header, status, start, end", [
+    ("bytes=0-99", 206, 0, 99),
+    ("bytes=-100", 206, len(GCODE) - 100, len(GCODE) - 1),
+    ("bytes=0-9, 20-29", 200, 0, len(GCODE) - 1),
+])
+def test_order_gcode_ranges(client, order_with_gcode, header, status, start, end):
+    resp = client.get(f"/api/orders/{order_with_gcode}/gcode", headers={"Range": header})
+
+    assert resp.status_code == status
+    assert resp.content == GCODE[start:end + 1]
+    if status == 206:
+        assert resp.headers["Content-Range"] == f"bytes {start}-{end}/{len(GCODE)}"
+
+
+def test_unsatisfiable_range(client, order_with_gcode):
+    resp = client.get(f"/api/orders/{order_with_gcode}/gcode", headers={"Range": f"bytes={len(GCODE)}-"})
+
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == f"bytes */{len(GCODE)}"
@@ -0,0 +1,48 @@
+import asyncio
+import hashlib
+import json
+
+import httpx
+
+from artifacts import artifact_store
+from cluster import RemoteBackend
+from quotes import get_filament_usage
+from slicer import backends
+from uploads import ModelUpload
+
+USAGE = {"volume_cm3": 1.0, "length_mm": 420.0}
+
+
+def remote_backend(handler):
+    backend = RemoteBackend(["http://worker"], backends["prusa"])
+    backend._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    node = backend.nodes[0]
+    node.healthy = True
+    node.slots = 1
+    return backend
+
+
+def test_failed_gcode_fetch_keeps_the_quote(stl_path):
+    def handler(request):
+        if request.method == "HEAD":
+            return httpx.Response(200)
+        if request.url.path == "/internal/slice":
+            return httpx.Response(200, text=json.dumps({"usage": USAGE, "gcode": "a" * 32}) + "\n")
+        if request.url.path.startswith("/internal/gcode/"):
+            return httpx.Response(500, text="disk full")
+        return httpx.Response(404)
+
+    digest = hashlib.sha256(stl_path.read_bytes()).hexdigest()
+    model = ModelUpload(stl_path, digest, stl_path.stat().st_size, "cube.stl")
+    backend = remote_backend(handler)
+
+    async def quote():
+        try:
+            return await get_filament_usage(model, 20, 0.2, 0.4, backend=backend)
+        finally:
+            await backend._client.aclose()
+
+    usage = asyncio.run(quote())
+
+    assert usage["volume_cm3"] == USAGE["volume_cm3"]
+    assert list(artifact_store.incoming.iterdir()) == []
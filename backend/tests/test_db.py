@@ -0,0 +1,34 @@
+import threading
+import time
+
+from db import Database
+
+
+def test_reads_dont_wait_for_a_writer(tmp_path):
+    db = Database(tmp_path / "test.sqlite3")
+    with db.transaction() as conn:
+        conn.execute("CREATE TABLE items (name TEXT)")
+        conn.execute("INSERT INTO items VALUES ('old')")
+
+    writing = threading.Event()
+    done = threading.Event()
+
+    def write():
+        with db.transaction() as conn:
+            conn.execute("INSERT INTO items VALUES ('new')")
+            writing.set()
+            done.wait(5)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    writing.wait(5)
+    try:
+        started = time.monotonic()
+        with db.read() as conn:
+            names = [row[0] for row in conn.execute("SELECT name FROM items")]
+        assert time.monotonic() - started < 1
+        # The uncommitted insert isn't visible
+        assert names == ["old"]
+    finally:
+        done.set()
+        writer.join()
@@ -0,0 +1,23 @@
+from gcode import read_gcode_stats, read_tail
+
+FOOTER = b"; filament used [mm] = 1234.5\n; filament used [cm3] = 2.9\n; estimated printing time (normal mode) = 1h 2m 3s\n"
+
+
+def test_stats_are_read_from_the_footer(tmp_path):
+    path = tmp_path / "part.gcode"
+    path.write_bytes(b"G1 X1 Y1 E0.1\n" * 100_000 + FOOTER)
+
+    stats = read_gcode_stats(path)
+
+    assert (stats["length_mm"], stats["volume_cm3"], stats["print_time_s"]) == (1234.5, 2.9, 3723)
+
+
+def test_tail_stays_bounded_without_a_footer(tmp_path):
+    path = tmp_path / "other.gcode"
+    path.write_bytes(b"G1 X1 Y1 E0.1\n" * 100_000)
+
+    tail = read_tail(path, block_size=4096, max_bytes=64 * 1024)
+
+    assert 0 < len(tail) <= 64 * 1024
+    assert tail.startswith(b"G1 ")
+    assert read_gcode_stats(path)["length_mm"] is None
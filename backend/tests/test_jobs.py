@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import jobs
+from jobs import JobManager, JobStore, SessionTracker
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_PUBLISH_SECONDS", 0.05)
+
+
+def worker(path):
+    """A JobManager as one uvicorn worker process has it, sharing the store's database with the others."""
+    store = JobStore(path)
+    return JobManager(store, SessionTracker(store))
+
+
+async def settle():
+    # Snapshots are written in the background and other workers poll
+    await asyncio.sleep(jobs.JOB_PUBLISH_SECONDS * 4)
+
+
+async def slice_forever(job):
+    await asyncio.sleep(3600)
+
+
+def test_identical_job_is_found_from_another_worker(tmp_path):
+    first, second = worker(tmp_path / "jobs.sqlite3"), worker(tmp_path / "jobs.sqlite3")
+
+    async def run():
+        job = first.submit(("key", "material", "variant"), slice_forever)
+        await first.watch(job, "a")
+        await settle()
+        try:
+            found = await second.find(("key", "material", "variant"))
+            assert found is not None and found.id == job.id
+            assert await second.find(("other", "material", "variant")) is None
+        finally:
+            job.task.cancel()
+            await settle()
+
+    asyncio.run(run())
+
+
+def test_session_supersedes_a_job_on_another_worker(tmp_path):
+    first, second = worker(tmp_path / "jobs.sqlite3"), worker(tmp_path / "jobs.sqlite3")
+
+    async def run():
+        old = first.submit(("old", "m", "v"), slice_forever)
+        await first.watch(old, "a")
+        await settle()
+        new = second.submit(("new", "m", "v"), slice_forever)
+        await second.watch(new, "a")
+        await settle()
+        try:
+            assert old.state == "cancelled"
+            assert new.state == "queued"
+        finally:
+            new.task.cancel()
+            await settle()
+
+    asyncio.run(run())
+
+
+def test_job_watched_from_another_worker_survives(tmp_path):
+    first, second = worker(tmp_path / "jobs.sqlite3"), worker(tmp_path / "jobs.sqlite3")
+
+    async def run():
+        job = first.submit(("key", "m", "v"), slice_forever)
+        await first.watch(job, "a")
+        await settle()
+        await second.watch(await second.find(("key", "m", "v")), "b")
+        # Session "a" moves on to another quote; "b", on the other worker, still wants this one
+        other = first.submit(("other", "m", "v"), slice_forever)
+        await first.watch(other, "a")
+        await settle()
+        try:
+            assert job.state == "queued"
+            # Once "b" moves on too, nobody is left
+            await second.watch(second.submit(("third", "m", "v"), slice_forever), "b")
+            await settle()
+            assert job.state == "cancelled"
+        finally:
+            for manager in (first, second):
+                for running in manager.jobs.values():
+                    running.task.cancel()
+            await settle()
+
+    asyncio.run(run())
@@ -0,0 +1,68 @@
+import numpy as np
+
+from conftest import cube_stl, large_stl
+from mesh import analyse_stl, is_binary_stl, prepare_for_quote, read_stl
+
+
+def ascii_stl(triangles):
+    facets = "".join(
+        "facet normal 0 0 0\n outer loop\n"
+        + "".join(f"  vertex {x} {y} {z}\n" for x, y, z in triangle)
+        + " endloop\nendfacet\n"
+        for triangle in triangles
+    )
+    return f"solid cube\n{facets}endsolid cube\n".encode()
+
+
+def test_ascii_and_binary_stls_read_the_same(tmp_path):
+    binary = tmp_path / "binary.stl"
+    binary.write_bytes(cube_stl())
+    ascii = tmp_path / "ascii.stl"
+    ascii.write_bytes(ascii_stl(read_stl(binary)))
+
+    assert is_binary_stl(binary) and not is_binary_stl(ascii)
+    np.testing.assert_array_equal(read_stl(ascii), read_stl(binary))
+    # Only the ASCII file gets a binary copy to slice
+    _, prepared = prepare_for_quote(ascii, tmp_path / "ascii.prepared.stl")
+    assert prepared == {"triangles": 12, "volume_error": 0.0, "decimated": False}
+    assert is_binary_stl(tmp_path / "ascii.prepared.stl")
+    assert prepare_for_quote(binary, tmp_path / "binary.prepared.stl")[1] is None
+
+
+def test_padded_binary_stl_is_read_as_binary(tmp_path):
+    path = tmp_path / "padded.stl"
+    # A "solid" header, as some exporters write, plus trailing bytes after the last triangle
+    data = bytearray(cube_stl())
+    data[:11] = b"solid model"
+    path.write_bytes(bytes(data) + b"\0" * 100)
+
+    assert is_binary_stl(path)
+    stats = analyse_stl(path)
+    assert stats["triangles"] == 12
+    assert abs(stats["volume_mm3"] - 1000) < 1e-3
+
+
+def test_cube_volume(tmp_path):
+    path = tmp_path / "cube.stl"
+    path.write_bytes(cube_stl(size=20.0))
+
+    stats = analyse_stl(path)
+
+    assert stats["volume_mm3"] == 8000.0
+    assert stats["surface_area_mm2"] == 2400.0
+    assert stats["size_mm"] == [20.0, 20.0, 20.0]
+    assert stats["manifold"] and not stats["inverted"]
+
+
+def test_decimation_meets_the_triangle_budget(tmp_path):
+    path = tmp_path / "dense.stl"
+    large_stl(path, divisions=40)
+    out = tmp_path / "dense.prepared.stl"
+
+    stats, prepared = prepare_for_quote(path, out, budget=2000, tolerance=0.05)
+
+    assert stats["triangles"] == 12 * 40 ** 2
+    assert prepared["decimated"]
+    assert 0 < prepared["triangles"] <= 2000
+    assert len(read_stl(out)) == prepared["triangles"]
+    assert prepared["volume_error"] <= 0.05
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+from outbox import OUTBOX_POLL_SECONDS, Outbox
+
+
+def test_enqueue_from_a_thread_wakes_the_workers(tmp_path):
+    outbox = Outbox(tmp_path / "orders.sqlite3")
+
+    async def run():
+        handled = asyncio.Event()
+
+        async def handler(order_id, params):
+            handled.set()
+            return {"product_id": params["name"]}
+
+        workers = outbox.start(handler, workers=1)
+        # Let the worker find the outbox empty and start waiting
+        await asyncio.sleep(0.1)
+        # A plain thread: completing an asyncio.to_thread() call would wake the loop by itself
+        threading.Thread(target=outbox.enqueue, args=({"name": "Part"}, "order-1")).start()
+        try:
+            await asyncio.wait_for(handled.wait(), OUTBOX_POLL_SECONDS / 2)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    asyncio.run(run())
+    assert outbox.get("order-1")["status"] in ("running", "done")
+
+
+def test_job_whose_worker_keeps_dying_is_dead_lettered(tmp_path, monkeypatch):
+    outbox = Outbox(tmp_path / "orders.sqlite3", max_attempts=3)
+    outbox.enqueue({"name": "Part"}, "order-1")
+    # Every claim's lease has already run out by the next one, as if its worker had died
+    monkeypatch.setattr("outbox.OUTBOX_LEASE_SECONDS", -1)
+
+    claims = [outbox.claim() for _ in range(4)]
+
+    assert [claim[2] if claim else None for claim in claims] == [0, 1, 2, None]
+    order = outbox.get("order-1")
+    assert (order["status"], order["attempts"]) == ("dead", 3)
+
+
+def test_lease_is_renewed_while_the_handler_runs(tmp_path, monkeypatch):
+    outbox = Outbox(tmp_path / "orders.sqlite3")
+    monkeypatch.setattr("outbox.OUTBOX_LEASE_SECONDS", 0.3)
+    outbox.enqueue({"name": "Part"}, "order-1")
+
+    async def run():
+        async def slow_handler(order_id, params):
+            await asyncio.sleep(1)
+            # Long past the first lease, but nobody else can claim the job
+            assert outbox.claim() is None
+            return {"product_id": "1"}
+
+        workers = outbox.start(slow_handler, workers=1)
+        for _ in range(40):
+            await asyncio.sleep(0.05)
+            if outbox.get("order-1")["status"] == "done":
+                break
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    asyncio.run(run())
+    order = outbox.get("order-1")
+    assert (order["status"], order["attempts"]) == ("done", 0)
+
+
+def test_idle_claim_doesnt_take_the_write_lock(tmp_path):
+    outbox = Outbox(tmp_path / "orders.sqlite3")
+    holding = threading.Event()
+    done = threading.Event()
+
+    def write():
+        with outbox.db.transaction():
+            holding.set()
+            done.wait(5)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    holding.wait(5)
+    try:
+        assert outbox.claim() is None
+    finally:
+        done.set()
+        writer.join()
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from quote_cache import QuoteCache
+
+USAGE = {"volume_cm3": 2.5, "length_mm": 840.0, "print_time_s": 600}
+
+
+def test_lookups_are_counted_in_batches(tmp_path):
+    cache = QuoteCache(tmp_path / "quotes.sqlite3")
+    cache.put("a", USAGE)
+
+    assert cache.get("a") == USAGE
+    assert cache.get("a") == USAGE
+    assert cache.get("b") is None
+    assert cache.get("b", count=False) is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+
+
+def test_hits_dont_wait_for_a_writer(tmp_path):
+    cache = QuoteCache(tmp_path / "quotes.sqlite3")
+    cache.put("a", USAGE)
+
+    writing = threading.Event()
+    done = threading.Event()
+
+    def write():
+        with cache.db.transaction():
+            writing.set()
+            done.wait(5)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    writing.wait(5)
+    try:
+        started = time.monotonic()
+        assert cache.get("a") == USAGE
+        assert time.monotonic() - started < 1
+    finally:
+        done.set()
+        writer.join()
@@ -0,0 +1,70 @@
+import asyncio
+
+import slice_pool
+from slice_pool import SlicePool
+
+
+async def start_jobs(pool, jobs, pause=0):
+    """
+    Queue (name, client, cost) jobs on a one-worker `pool` behind a running one,
+    `pause` seconds apart, let them go, and return the names in the order they started.
+    """
+    started = []
+    gate = asyncio.Event()
+
+    async def work(name):
+        started.append(name)
+        await gate.wait()
+
+    blocker = asyncio.create_task(pool.run(work, "blocker"))
+    await asyncio.sleep(0)
+    tasks = []
+    for name, client, cost in jobs:
+        tasks.append(asyncio.create_task(pool.run(work, name, cost=cost, client=client)))
+        await asyncio.sleep(pause)
+    gate.set()
+    await asyncio.gather(blocker, *tasks)
+    return started[1:]
+
+
+def test_short_job_overtakes_a_long_one():
+    pool = SlicePool(workers=1)
+
+    started = asyncio.run(start_jobs(pool, [("long", "a", 100.0), ("short", "b", 1.0)]))
+
+    assert started == ["short", "long"]
+    assert pool.reordered == 1
+
+
+def test_one_client_cannot_starve_another():
+    pool = SlicePool(workers=2, client_share=0.5)
+    running = []
+    gate = asyncio.Event()
+
+    async def work(name):
+        running.append(name)
+        await gate.wait()
+
+    async def run():
+        # "a" queues cheap jobs first, yet "b" still gets the second worker
+        tasks = [asyncio.create_task(pool.run(work, f"a{n}", cost=1.0, client="a")) for n in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(pool.run(work, "b", cost=50.0, client="b")))
+        await asyncio.sleep(0)
+        try:
+            assert running == ["a0", "b"]
+        finally:
+            gate.set()
+            await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+
+def test_aging_promotes_a_waiting_long_job(monkeypatch):
+    # Waiting 50ms is then worth 50 seconds of estimate
+    monkeypatch.setattr(slice_pool, "SLICE_AGING_RATE", 1000.0)
+    pool = SlicePool(workers=1)
+
+    started = asyncio.run(start_jobs(pool, [("long", "a", 10.0), ("short", "b", 1.0)], pause=0.05))
+
+    assert started == ["long", "short"]
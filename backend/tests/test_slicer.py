@@ -0,0 +1,49 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+import slicer
+from conftest import large_stl
+from slicer import PRLIMIT_BIN, PrusaSlicerBackend, SliceOutOfMemory
+
+FAKE_SLICER = Path(__file__).resolve().parent.parent / "bench" / "fake_slicer.py"
+LIMIT_MB = 2048
+
+
+@pytest.mark.skipif(PRLIMIT_BIN is None, reason="needs util-linux prlimit")
+def test_large_model_slices_under_the_memory_limit(tmp_path, monkeypatch):
+    # Reports the limit it was started with, then slices like PrusaSlicer would
+    wrapper = tmp_path / "prusa-slicer"
+    wrapper.write_text(
+        f"#!{sys.executable}\n"
+        "import os, resource, sys\n"
+        f"open({str(tmp_path / 'limit')!r}, 'w').write(str(resource.getrlimit(resource.RLIMIT_DATA)[0]))\n"
+        f"os.execv({sys.executable!r}, [{sys.executable!r}, {str(FAKE_SLICER)!r}, *sys.argv[1:]])\n"
+    )
+    wrapper.chmod(0o755)
+    monkeypatch.setattr(slicer, "PRUSA_SLICER_BIN", str(wrapper))
+    monkeypatch.setattr(slicer, "SLICE_MEMORY_LIMIT_MB", LIMIT_MB)
+    monkeypatch.setenv("FAKE_SLICER_STARTUP_SECONDS", "0")
+    monkeypatch.setenv("FAKE_SLICER_SECONDS_PER_MTRI", "0")
+    stl = tmp_path / "large.stl"
+    large_stl(stl)
+
+    usage = asyncio.run(PrusaSlicerBackend().slice(str(stl), 20, 0.2, 0.4))
+
+    assert usage["length_mm"] > 0
+    assert int((tmp_path / "limit").read_text()) == LIMIT_MB * 1024 * 1024
+
+
+def test_running_out_of_memory_isnt_an_invalid_model(tmp_path, monkeypatch):
+    wrapper = tmp_path / "prusa-slicer"
+    wrapper.write_text("#!/bin/sh\necho \"terminate called after throwing an instance of 'std::bad_alloc'\" >&2\nexit 134\n")
+    wrapper.chmod(0o755)
+    monkeypatch.setattr(slicer, "PRUSA_SLICER_BIN", str(wrapper))
+    stl = tmp_path / "model.stl"
+    large_stl(stl, divisions=1)
+
+    with pytest.raises(SliceOutOfMemory):
+        asyncio.run(PrusaSlicerBackend().slice(str(stl), 20, 0.2, 0.4))
+
@@ -0,0 +1,56 @@
+import io
+import zipfile
+
+import pytest
+
+from uploads import UploadTooLarge, extract_models
+
+
+def zip_of(members):
+    """An in-memory ZIP archive of {name: bytes}."""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    archive.seek(0)
+    return archive
+
+
+def test_models_are_extracted_and_other_files_skipped(tmp_path):
+    archive = zip_of({"a.stl": b"solid a", "parts/b.STL": b"solid b", "README.txt": b"hi", "__MACOSX/._a.stl": b""})
+
+    models = extract_models(archive, tmp_path)
+
+    assert [model.filename for model in models] == ["a.stl", "parts/b.STL"]
+    assert [model.path.read_bytes() for model in models] == [b"solid a", b"solid b"]
+
+
+def test_too_many_members(tmp_path):
+    archive = zip_of({f"{n}.stl": b"solid" for n in range(3)})
+
+    with pytest.raises(ValueError, match="At most 2 models"):
+        extract_models(archive, tmp_path, max_files=2)
+
+
+def test_total_size_is_counted_as_members_decompress(tmp_path):
+    archive = zip_of({"a.stl": b"x" * 600, "b.stl": b"y" * 600})
+
+    with pytest.raises(UploadTooLarge):
+        extract_models(archive, tmp_path, max_total=1000)
+
+
+def test_member_size(tmp_path):
+    archive = zip_of({"a.stl": b"x" * 2000})
+
+    with pytest.raises(UploadTooLarge):
+        extract_models(archive, tmp_path, max_bytes=1000)
+
+
+def test_compression_ratio(tmp_path):
+    # 2 MB of zeros deflates to a couple of KB
+    archive = zip_of({"bomb.stl": bytes(2 * 1024 * 1024)})
+
+    with pytest.raises(ValueError, match="expands more than 100 times"):
+        extract_models(archive, tmp_path, max_ratio=100)
+    # Under a looser limit the same member unpacks
+    assert len(extract_models(zip_of({"part.stl": bytes(2 * 1024 * 1024)}), tmp_path, max_ratio=10_000)) == 1
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import os
+import zipfile
+from pathlib import Path, PurePosixPath
+
+from fastapi.responses import JSONResponse
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "200")) * 1024 * 1024
+MAX_SCREENSHOT_BYTES = int(os.getenv("MAX_SCREENSHOT_MB", "20")) * 1024 * 1024
+# Whole multipart body: model + screenshot + form fields
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + MAX_SCREENSHOT_BYTES + 1024 * 1024
+# Batch quotes: models per batch, and their combined size once unpacked
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "100"))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_MB", "1024")) * 1024 * 1024
+MAX_BATCH_REQUEST_BYTES = MAX_BATCH_BYTES + 1024 * 1024
+# Most a ZIP member may expand over its compressed size; checked past ZIP_RATIO_MIN_BYTES, as small files compress absurdly well
+MAX_ZIP_RATIO = int(os.getenv("MAX_ZIP_RATIO", "100"))
+ZIP_RATIO_MIN_BYTES = 1024 * 1024
+# Members of a ZIP archive that get quoted; anything else (readmes, drawings) is skipped
+MODEL_SUFFIXES = {".stl", ".3mf", ".obj", ".amf", ".step", ".stp"}
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__(f"File too large. Maximum upload size is {max_bytes // (1024 * 1024)} MB.")
+        self.max_bytes = max_bytes
+
+
+class ModelUpload:
+    """An uploaded file written to disk, with the SHA-256 digest computed while it streamed in."""
+
+    def __init__(self, path, digest, size, filename):
+        self.path = Path(path)
+        self.digest = digest
+        self.size = size
+        self.filename = filename
+        self.mesh = None  # mesh statistics, once analysed
+        self.slice_path = self.path  # a lighter copy used for quoting, once prepared
+        self.prepared = None  # statistics of that copy
+
+
+class RequestSizeLimit:
+    """
+    ASGI middleware answering 413 to requests whose Content-Length exceeds
+    max_bytes, or limits[path] for the paths listed there.
+    """
+
+    def __init__(self, app, max_bytes=MAX_REQUEST_BYTES, limits=None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.limits = limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            max_bytes = self.limits.get(scope["path"], self.max_bytes)
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if content_length.isdigit() and int(content_length) > max_bytes:
+                response = JSONResponse(
+                    status_code=413,
+                    content={"error": f"Request too large. Maximum upload size is {max_bytes // (1024 * 1024)} MB."}
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+def safe_filename(filename, default="model.stl"):
+    # Only keep the final path component of client-supplied names
+    return os.path.basename(filename or "") or default
+
+
+async def save_upload(upload, dest, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Stream an UploadFile to `dest` in fixed-size chunks, hashing as we go, so memory
+    use stays constant regardless of file size. Raises UploadTooLarge (and removes
+    the partial file) once more than max_bytes have been read.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest, "wb") as f:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        Path(dest).unlink(missing_ok=True)
+        raise
+    return ModelUpload(dest, digest.hexdigest(), size, upload.filename)
+
+
+def extract_models(archive_path, dest_dir, first_index=0, max_files=MAX_BATCH_FILES, max_bytes=MAX_UPLOAD_BYTES,
+                   max_total=MAX_BATCH_BYTES, max_ratio=MAX_ZIP_RATIO):
+    """
+    Unpack the model files of a ZIP archive (a path or file object) into dest_dir
+    one member at a time, in fixed-size chunks, hashing as they stream. Sizes are
+    counted as members decompress rather than trusted from the archive's headers,
+    so a zip bomb stops at the limit: UploadTooLarge past max_bytes for one member
+    or max_total for all of them. ValueError for a broken archive, more than
+    max_files models or a member expanding more than max_ratio times. Files are
+    numbered from first_index to keep names unique.
+    """
+    models = []
+    total = 0
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                name = PurePosixPath(info.filename.replace("\\", "/"))
+                if info.is_dir() or "__MACOSX" in name.parts or name.name.startswith(".") or name.suffix.lower() not in MODEL_SUFFIXES:
+                    continue
+                if len(models) >= max_files:
+                    raise ValueError(f"At most {max_files} models can be quoted at once")
+                dest = Path(dest_dir) / f"{first_index + len(models):03d}_{name.name}"
+                digest = hashlib.sha256()
+                size = 0
+                with archive.open(info) as src, open(dest, "wb") as f:
+                    while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        total += len(chunk)
+                        if size > max_bytes:
+                            raise UploadTooLarge(max_bytes)
+                        if total > max_total:
+                            raise UploadTooLarge(max_total)
+                        if size > ZIP_RATIO_MIN_BYTES and size > max_ratio * info.compress_size:
+                            raise ValueError(f"{name.name} expands more than {max_ratio} times; it doesn't look like a model")
+                        digest.update(chunk)
+                        f.write(chunk)
+                models.append(ModelUpload(dest, digest.hexdigest(), size, str(name)))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, RuntimeError) as e:
+        # RuntimeError: encrypted members; NotImplementedError: unsupported compression
+        raise ValueError(f"Couldn't read the ZIP archive: {e}")
+    return models
+
+
+async def save_batch(uploads, dest_dir, max_files=MAX_BATCH_FILES, max_total=MAX_BATCH_BYTES):
+    """
+    Save the files of a batch quote to dest_dir, unpacking ZIP archives among
+    them (see extract_models), and return a ModelUpload per model in upload
+    order. Raises UploadTooLarge or ValueError like extract_models.
+    """
+    models = []
+    total = 0
+    for upload in uploads:
+        name = safe_filename(upload.filename)
+        if name.lower().endswith(".zip"):
+            archive = await save_upload(upload, Path(dest_dir) / f"batch-{len(models):03d}.zip", max_bytes=max_total)
+            try:
+                extracted = await asyncio.to_thread(
+                    extract_models, archive.path, dest_dir, len(models), max_files - len(models), max_total=max_total - total
+                )
+            finally:
+                archive.path.unlink(missing_ok=True)
+        else:
+            if len(models) >= max_files:
+                raise ValueError(f"At most {max_files} models can be quoted at once")
+            extracted = [await save_upload(upload, Path(dest_dir) / f"{len(models):03d}_{name}")]
+        models.extend(extracted)
+        total += sum(model.size for model in extracted)
+        if total > max_total:
+            raise UploadTooLarge(max_total)
+    if not models:
+        raise ValueError("No model files found in the upload")
+    return models
@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+from logs import configure_logging
+configure_logging()
+
+import metrics
+from slice_pool import slice_pool, SlicerBusy
+from slicer import SliceOutOfMemory, SliceTimeout, get_backend, backends, warm_backends, close_backends
+from uploads import MAX_UPLOAD_BYTES
+
+# Slice-worker mode: `uvicorn worker:app` on a slicing node, with the front API's
+# SLICE_WORKERS listing it. Several can share one machine on different ports.
+
+# Meshes sent by the front API, by content hash, and how much of them to keep
+WORKER_MESH_DIR = Path(os.getenv("WORKER_MESH_DIR", "worker-meshes"))
+WORKER_MESH_CACHE_MB = int(os.getenv("WORKER_MESH_CACHE_MB", "2048"))
+# Shared with the front API; when unset the internal API trusts its network
+SLICE_WORKER_TOKEN = os.getenv("SLICE_WORKER_TOKEN")
+
+MESH_NAME_RE = re.compile(r"^[0-9a-f]{64}\.(stl|3mf|obj|amf|step|stp)$")
+GCODE_TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+# G-code the front API never came back for
+GCODE_TTL_SECONDS = 3600
+
+log = logging.getLogger("worker")
+
+
+class MeshStore:
+    """
+    Content-addressed meshes on disk, named `<sha256>.<ext>`. The least recently
+    used are deleted once the store outgrows max_bytes, except those being sliced.
+    """
+
+    def __init__(self, directory=WORKER_MESH_DIR, max_bytes=WORKER_MESH_CACHE_MB * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._in_use = collections.Counter()
+        self.received = 0
+        self.received_bytes = 0
+        self.evicted = 0
+
+    def path(self, name):
+        return self.directory / name
+
+    def gcode_path(self, token):
+        return self.directory / "gcode" / f"{token}.gcode"
+
+    def new_gcode_path(self):
+        """A fresh place for a slice to leave its G-code, clearing out any left uncollected."""
+        directory = self.directory / "gcode"
+        directory.mkdir(parents=True, exist_ok=True)
+        cutoff = time.time() - GCODE_TTL_SECONDS
+        for path in directory.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+        return self.gcode_path(uuid.uuid4().hex)
+
+    def has(self, name):
+        path = self.path(name)
+        try:
+            # Touched so eviction sees it as recently used
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    async def receive(self, name, request):
+        """Stream a request body into the store, checking it hashes to the name it was sent under."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.path(f"{name}.{os.getpid()}.{time.monotonic_ns()}.tmp")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                async for chunk in request.stream():
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_BYTES:
+                        raise ValueError(f"Mesh larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if digest.hexdigest() != name.split(".", 1)[0]:
+                raise ValueError("Mesh content doesn't match its hash")
+            os.replace(tmp, self.path(name))
+        finally:
+            tmp.unlink(missing_ok=True)
+        self.received += 1
+        self.received_bytes += size
+        await asyncio.to_thread(self.evict)
+
+    def evict(self):
+        entries = []
+        for path in self.directory.iterdir():
+            if MESH_NAME_RE.match(path.name):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._in_use[path.name]:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evicted += 1
+
+    def acquire(self, name):
+        self._in_use[name] += 1
+
+    def release(self, name):
+        self._in_use[name] -= 1
+        if self._in_use[name] <= 0:
+            del self._in_use[name]
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "received_bytes": self.received_bytes,
+            "evicted": self.evicted,
+            "in_use": len(self._in_use),
+        }
+
+
+mesh_store = MeshStore()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    slicers = asyncio.create_task(warm_backends())
+    yield
+    slicers.cancel()
+    await close_backends()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.register_stats(
+    "slice_pool", slice_pool.stats,
+    counters=("completed", "failed", "rejected", "cancelled", "abandoned", "timed_out", "reordered"),
+)
+metrics.register_stats("worker_meshes", mesh_store.stats, counters=("received", "received_bytes", "evicted"))
+
+
+def authorized(request):
+    if not SLICE_WORKER_TOKEN:
+        return True
+    return hmac.compare_digest(request.headers.get("x-worker-token", ""), SLICE_WORKER_TOKEN)
+
+
+def forbidden():
+    return JSONResponse(status_code=401, content={"error": "Missing or wrong X-Worker-Token"})
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+
+@app.get("/internal/health")
+async def health(request: Request):
+    """Liveness plus the load the front API routes by."""
+    if not authorized(request):
+        return forbidden()
+    return {
+        "status": "ok",
+        "slots": slice_pool.workers,
+        "running": slice_pool.running,
+        "queued": slice_pool.queued,
+        "backends": {name: backend.available() for name, backend in backends.items()},
+        "meshes": mesh_store.stats(),
+    }
+
+
+@app.head("/internal/meshes/{name}")
+async def has_mesh(name: str, request: Request):
+    if not authorized(request):
+        return forbidden()
+    return Response(status_code=200 if MESH_NAME_RE.match(name) and mesh_store.has(name) else 404)
+
+
+@app.put("/internal/meshes/{name}", status_code=201)
+async def put_mesh(name: str, request: Request):
+    if not authorized(request):
+        return forbidden()
+    if not MESH_NAME_RE.match(name):
+        return JSONResponse(status_code=400, content={"error": "Meshes are named <sha256>.<stl|3mf|obj|amf|step|stp>"})
+    try:
+        await mesh_store.receive(name, request)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return {"name": name}
+
+
+@app.post("/internal/slice")
+async def slice_mesh(request: Request):
+    """
+    Slice a mesh previously PUT here. Answers with NDJSON: {"progress", "message"}
+    lines while slicing, then {"usage": {...}} or {"error", "type"}. Closing the
+    connection cancels the slice.
+    """
+    if not authorized(request):
+        return forbidden()
+    try:
+        job = await request.json()
+        name = job["mesh"]
+        args = (float(job["infill_density"]), float(job["layer_height"]), float(job["nozzle_diameter"]))
+        backend = get_backend(job.get("backend"))
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Bad slice job: {e}"})
+    if not MESH_NAME_RE.match(name) or not mesh_store.has(name):
+        return JSONResponse(status_code=404, content={"error": "Unknown mesh", "mesh": name})
+    infill = int(args[0]) if args[0].is_integer() else args[0]
+    # The front API archives the G-code of quotes for the print farm, and fetches it afterwards
+    gcode_path = mesh_store.new_gcode_path() if job.get("gcode") and backend.gcode else None
+
+    async def lines():
+        mesh_store.acquire(name)
+        progress = asyncio.Queue()
+
+        def on_progress(percent, message):
+            progress.put_nowait({"progress": percent, "message": message})
+
+        slice_args = (str(mesh_store.path(name)), infill, args[1], args[2], on_progress, gcode_path)
+        if backend.bounded:
+            task = asyncio.create_task(backend.slice(*slice_args))
+        else:
+            task = asyncio.create_task(slice_pool.run(backend.slice, *slice_args))
+        getter = None
+        try:
+            while not task.done():
+                getter = asyncio.create_task(progress.get())
+                await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield json.dumps(getter.result()) + "\n"
+                else:
+                    getter.cancel()
+            try:
+                result = {"usage": task.result()}
+                if gcode_path is not None and gcode_path.exists():
+                    result["gcode"] = gcode_path.stem
+            except SliceTimeout as e:
+                result = {"error": str(e), "type": "timeout", "seconds": e.seconds}
+            except SlicerBusy as e:
+                result = {"error": str(e), "type": "busy", "retry_after": e.retry_after}
+            except SliceOutOfMemory as e:
+                result = {"error": str(e), "type": "memory"}
+            except Exception as e:
+                log.exception("Slicing failed", extra={"mesh": name, "backend": backend.name})
+                result = {"error": str(e), "type": "slicer"}
+            if gcode_path is not None and "gcode" not in result:
+                gcode_path.unlink(missing_ok=True)
+            yield json.dumps(result) + "\n"
+        finally:
+            # The front API hung up (or we're done): don't keep slicing for nobody
+            task.cancel()
+            if getter is not None:
+                getter.cancel()
+            mesh_store.release(name)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/internal/gcode/{token}")
+async def get_gcode(token: str, request: Request):
+    """The G-code a slice left behind, sent once and then deleted."""
+    if not authorized(request):
+        return forbidden()
+    path = mesh_store.gcode_path(token) if GCODE_TOKEN_RE.match(token) else None
+    if path is None or not path.exists():
+        return JSONResponse(status_code=404, content={"error": "Unknown or already collected G-code"})
+    return FileResponse(path, media_type="text/x-gcode", background=BackgroundTask(path.unlink, missing_ok=True))
@@ -0,0 +1,218 @@
+/**
+ * Long-lived Kiri:Moto FDM slicer for quoting, driven by backend/slicer.py.
+ *
+ * Loads the engine once, then slices one model at a time from stdin:
+ * a JSON header line {id, bytes, infill, layer_height, nozzle} followed by
+ * `bytes` bytes of STL. Replies on stdout with JSON lines: {id, progress}
+ * while slicing, then {id, filament_mm, print_time_s, layers} or {id, error}.
+ * G-code is generated in memory only to measure extrusion and is discarded.
+ * Everything the engine logs goes to stderr so stdout stays the protocol.
+ */
+let fs = require('fs');
+let dir = process.env.KIRI_ROOT || process.cwd();
+let verbose = !!process.env.KIRI_VERBOSE;
+let opts = {
+    source: "src/cli/kiri-source.json",
+    process: "src/cli/kiri-fdm-process.json",
+    device: "src/cli/kiri-fdm-device.json"
+};
+
+let stdout = process.stdout;
+console.log = console.info = console.warn = console.error;
+
+let exports_save = exports,
+    navigator = { userAgent: "" },
+    module_save = module,
+    THREE = {},
+    gapp = {},
+    geo = {},
+    noop = () => { },
+    self = this.self = {
+        gapp,
+        THREE,
+        location: { hostname: 'local', port: 0, protocol: 'fake' },
+        postMessage: (msg) => {
+            self.kiri.client.onmessage({data:msg});
+        }
+    };
+
+// same fakes as cli.js: the engine expects a browser with a web worker
+let fetch = function(url, opts = {}) {
+    if (verbose) console.log({fetch: url});
+    if (!url.startsWith('/')) {
+        url = `${dir}/${url}`;
+    }
+    let buf = fs.readFileSync(url);
+    return Promise.resolve(new Promise((resolve, reject) => {
+        if (opts.format === 'string') {
+            return resolve(buf.toString());
+        }
+        if (opts.format === 'buffer') {
+            return resolve(buf);
+        }
+        if (opts.format === 'eval') {
+            return resolve(eval('(' + buf + ')'));
+        }
+        resolve({
+            arrayBuffer: function() {
+                return buf;
+            }
+        });
+    }));
+};
+
+class Worker {
+    constructor(url) {
+        if (verbose) console.log({worker: url});
+    }
+
+    postMessage(msg) {
+        setImmediate(() => {
+            self.kiri.worker.onmessage({data:msg});
+        });
+    }
+
+    onmessage(msg) {
+        console.trace('worker-recv', msg);
+    }
+
+    terminate() {
+        console.trace('worker terminate');
+    }
+}
+
+function atob(a) {
+    return Buffer.from(a).toString('base64');
+}
+
+function btoa(b) {
+    return Buffer.from(b, 'base64').toString();
+}
+
+async function load() {
+    let files = await fetch(opts.source, { format: "eval" } );
+    for (let file of files.map(p => `${dir}/src/${p}.js`)) {
+        let isPNG = file.indexOf("/pngjs") > 0;
+        let isClip = file.indexOf("/clip") > 0;
+        let isEarcut = file.indexOf("/earcut") > 0;
+        let isTHREE = file.indexOf("/three") > 0;
+        if (isTHREE) {
+            exports = {};
+        }
+        if (isEarcut) {
+            module = { exports: {} };
+        }
+        if (isPNG || isClip) {
+            module = undefined;
+        }
+        if (verbose) console.log(`loading ... ${file}`);
+        eval(fs.readFileSync(`${file}`).toString());
+        if (isClip) {
+            ClipperLib = self.ClipperLib;
+        }
+        if (isTHREE) {
+            Object.assign(THREE, exports);
+            exports = exports_save;
+        }
+        if (isEarcut) {
+            self.earcut = module.exports;
+        }
+        if (isPNG || isClip || isEarcut) {
+            module = module_save;
+        }
+    }
+    return {
+        kiri: self.kiri,
+        device: await fetch(opts.device, { format: "eval" }),
+        process: await fetch(opts.process, { format: "eval" })
+    };
+}
+
+function reply(msg) {
+    stdout.write(JSON.stringify(msg) + "\n");
+}
+
+async function quote(base, job, stl) {
+    let { kiri } = base;
+    let engine = kiri.newEngine();
+    let device = JSON.parse(JSON.stringify(base.device));
+    let extruder = device.extruders[0];
+    extruder.extNozzle = job.nozzle;
+    extruder.extFilament = 1.75;
+
+    let lastProgress = -1;
+    engine.setListener(msg => {
+        let update = msg.slice && msg.slice.update;
+        if (typeof update === 'number') {
+            let progress = Math.min(99, Math.round(update * 100));
+            if (progress > lastProgress) {
+                lastProgress = progress;
+                reply({id: job.id, progress});
+            }
+        }
+    });
+
+    await engine.parse(stl.buffer.slice(stl.byteOffset, stl.byteOffset + stl.byteLength));
+    engine.setDevice(device).setProcess(Object.assign({}, base.process, {
+        sliceHeight: job.layer_height,
+        firstSliceHeight: job.layer_height,
+        sliceFillSparse: Math.min(job.infill, 99) / 100,
+        sliceFillType: "gyroid",
+        // closest match to the supports PrusaSlicer is run with
+        sliceSupportEnable: true,
+        sliceSupportAngle: 30
+    })).setMode("FDM");
+    await engine.slice();
+    await engine.prepare();
+
+    let output = await new Promise((accept, reject) => {
+        kiri.client.export(engine.settings, noop, (output, error) => {
+            if (error) reject(error); else accept(output);
+        });
+    });
+    return {
+        id: job.id,
+        filament_mm: output.distance,
+        print_time_s: Math.round(output.time),
+        layers: engine.widget.slices ? engine.widget.slices.length : null
+    };
+}
+
+async function serve(base) {
+    let pending = Buffer.alloc(0);
+    let header = null;
+    let busy = Promise.resolve();
+
+    process.stdin.on('data', chunk => {
+        pending = Buffer.concat([pending, chunk]);
+        while (true) {
+            if (!header) {
+                let eol = pending.indexOf(10);
+                if (eol < 0) return;
+                header = JSON.parse(pending.subarray(0, eol).toString());
+                pending = pending.subarray(eol + 1);
+            }
+            if (pending.length < header.bytes) return;
+            let job = header;
+            let stl = Buffer.from(pending.subarray(0, job.bytes));
+            pending = pending.subarray(job.bytes);
+            header = null;
+            // the engine keeps global state, so jobs run strictly one after another
+            busy = busy
+                .then(() => quote(base, job, stl))
+                .then(reply)
+                .catch(error => reply({id: job.id, error: String(error && error.message || error)}));
+        }
+    });
+    process.stdin.on('end', () => busy.then(() => process.exit(0)));
+}
+
+load()
+    .then(base => {
+        reply({ready: true, version: base.kiri.version});
+        return serve(base);
+    })
+    .catch(error => {
+        reply({error: String(error && error.message || error)});
+        process.exit(1);
+    });
@@ -2116,6 +2116,9 @@ gapp.register("kiri.init", (root, exports) => {
         });
 
         let finalFormData;
+        // Lets the server cancel a slice this tab no longer needs when a newer quote is requested
+        const quoteSession = crypto.randomUUID();
+        let quoteController = null;
         const finalSubmitButton = document.querySelector("#final-submit-button");
         document.querySelector("#login-form").addEventListener("submit", async e => {
             e.preventDefault();
@@ -2153,10 +2156,50 @@ gapp.register("kiri.init", (root, exports) => {
             }
 
             const data = await response.json();
-            window.location.href = `https://adbits.ca/pages/add-to-cart?variant=${data.variant_id.split('/').pop()}`;
             console.log(data);
+
+            // The product is created in the background; wait for its variant
+            const order = await waitForOrder(data.order_id);
+            if (!order) {
+                alert("Your model was saved, but we couldn't finish setting it up. Please contact us with order " + data.order_id + ".");
+                return;
+            }
+            window.location.href = `https://adbits.ca/pages/add-to-cart?variant=${order.variant_id.split('/').pop()}`;
         });
 
+        // Creating the product normally takes seconds; past this, or on an error that retrying
+        // won't fix, the customer gets the fallback message instead of a page that spins forever
+        const ORDER_WAIT_MS = 2 * 60 * 1000;
+
+        async function waitForOrder(orderId) {
+            const url = `${devEnv ? "http://127.0.0.1:8282" : "https://api.slicer.adbits.ca"}/api/orders/${orderId}`;
+            const deadline = Date.now() + ORDER_WAIT_MS;
+            for (let delay = 500; Date.now() + delay < deadline; delay = Math.min(delay * 1.5, 5000)) {
+                await new Promise(resolve => setTimeout(resolve, delay));
+                let response;
+                try {
+                    response = await fetch(url, { headers: { Accept: "application/json" } });
+                } catch (err) {
+                    // Network hiccup: try again until the deadline
+                    continue;
+                }
+                if (response.status >= 400 && response.status < 500 && response.status !== 429) {
+                    return null;
+                }
+                if (!response.ok) {
+                    continue;
+                }
+                const order = await response.json();
+                if (order.status === "done") {
+                    return order;
+                }
+                if (order.status === "dead" || order.status === "failed") {
+                    return null;
+                }
+            }
+            return null;
+        }
+
         const finalDialog = document.querySelector("#login");
 
         function resetDialogs() {
@@ -2195,17 +2238,38 @@ gapp.register("kiri.init", (root, exports) => {
             formData.append("layerHeight", form.quality.value || "0.2");
             formData.append("nozzleSize", form.nozzleSize.value || "0.4");
             formData.append("complex", isComplex);
+            formData.append("session", quoteSession);
 
             finalFormData = formData;
 
             space.view.home();
 
+            // Abandon a quote still in progress; the server stops slicing it
+            if (quoteController) {
+                quoteController.abort();
+            }
+            quoteController = new AbortController();
+
             // Send to backend
-            const response = await fetch(`${devEnv ? "http://127.0.0.1:8282" : "https://api.slicer.adbits.ca"}/api/get-quote`, {
-                method: "POST",
-                headers: { Accept: "application/json" },
-                body: formData
-            });
+            let response;
+            try {
+                response = await fetch(`${devEnv ? "http://127.0.0.1:8282" : "https://api.slicer.adbits.ca"}/api/get-quote`, {
+                    method: "POST",
+                    headers: { Accept: "application/json" },
+                    body: formData,
+                    signal: quoteController.signal
+                });
+            } catch (err) {
+                if (err.name === "AbortError") {
+                    return;
+                }
+                throw err;
+            }
+
+            if (response.status === 409) {
+                // Superseded by a newer quote from this tab
+                return;
+            }
 
             if (response.status === 400) {
                 resetDialogs();
@@ -2225,6 +2289,12 @@ gapp.register("kiri.init", (root, exports) => {
             finalFormData.append("price", data.price);
             finalFormData.append("weight", data.grams);
 
+            if (data.quote_token) {
+                // The server kept the quoted upload, so don't send the model again
+                finalFormData.delete("file");
+                finalFormData.append("quote_token", data.quote_token);
+            }
+
             console.log(finalFormData);
 
             dialog.querySelector(".quote-dialog").classList.add("done");